@@ -1,106 +1,150 @@
 
 from dotenv import load_dotenv
 import os
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import docx
 import requests
+import re
+import calendar
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import charts
+import embeddings
+from completion_cache import CompletionCache
 
 load_dotenv()  # This method will load the .env file
 
-openai_api_key = os.getenv('OPENAI_API_KEY')  # Now you can access the API key
 from openai import OpenAI
+from openai.types.chat import ChatCompletionMessage
 import tiktoken
-client = OpenAI(api_key=openai_api_key)
 embedding_model = "text-embedding-3-large"
 gpt4 = "gpt-4-0125-preview"
 gpt3 = "gpt-3.5-turbo-0125"
+# bounds for the concurrent context summaries in get_completion
+summary_max_workers = 5
+summary_timeout = 30
+# responses to identical memo requests are reused from here
+completion_cache_path = 'downloads/completion_cache.sqlite'
+_completion_cache = None
+# months the period in the Summary header may differ from the span of the violation dates before the dates win,
+# both count the first and last month so they agree exactly on a consistent upload
+month_tolerance = 0
+# codes starting with this are city ordinances (local), all others are state statutes
+local_code_prefix = '154'
 
 from docx import Document
 
-# Load the Word documents
-performance_task_description_doc = Document('files/Data Analyst Performance Task_v2.docx')
-performance_task_example_doc = Document('files/Sample Memo - BZA Fees-2.docx')
-
-
-
-
-# Read the text of the document
-performance_task_description_text = []
-for paragraph in performance_task_description_doc.paragraphs:
-    performance_task_description_text.append(paragraph.text)
-
-performance_task_example_text = []
-for paragraph in performance_task_example_doc.paragraphs:
-    performance_task_example_text.append(paragraph.text)
-
-# Join the text into a single string
-performance_task_description = '\n'.join(performance_task_description_text)
-performance_task_example = '\n'.join(performance_task_example_text)
-
-def classify_column(row):
-    code = row['Violation Cited (State/Local Code Reference)']
-    if code.startswith('154:383'):
-        return 257.50, 'Careless operation of a vehicle', 'local'
-    elif code.startswith('32:58'):
-        return 302.50, 'Careless operation of a vehicle', 'state'
-    elif code.startswith('154:303'):
-        return 207.50, 'D/L not on person', 'local'
-    elif code.startswith('32:411.1'):
-        return 302.50, 'D/L not on person', 'state'
-    elif code.startswith('154:236'):
-        return 227.50, 'Disregard red light', 'local'
-    elif code.startswith('32:232'):
-        return 302.50, 'Disregard red light', 'state'
-    elif code.startswith('154:400'):
-        return 207.50, 'Drivers to use reasonable vigilance', 'local'
-    elif code.startswith('154:401'):
-        return 227.50, 'Following too closely', 'local'
-    elif code.startswith('32:81'):
-        return 302.50, 'Following too closely', 'state'
-    elif code.startswith('154:240'):
-        return 157.50, 'Improper lane use', 'local'
-    elif code.startswith('32:79'):
-        return 302.50, 'Improper lane use', 'state'
-    elif code.startswith('154:436'):
-        return 157.50, 'Improper turn', 'local'
-    elif code.startswith('32:101'):
-        return 302.50, 'Improper turn', 'state'
-    elif code.startswith('154:307'):
-        return 157.50, 'License plates', 'local'
-    elif code.startswith('32:53A'):
-        return 302.50, 'License plates', 'state'
-    elif code.startswith('154:1298'):
-        return 207.50, 'No/expired brake tag', 'local'
-    elif code.startswith('32:53D'):
-        return 302.50, 'No/expired brake tag', 'state'
-    elif code.startswith('154:304'):
-        return 607.50, 'Unlawful use of license', 'local'
-    elif code.startswith('32:414.1'):
-        return 627.50, 'Unlawful use of license', 'state'
-    elif code.startswith('154:482'):
-        return 227.50, 'Yield right of way', 'local'
-    else:
-        return 302.50, 'Yield right of way', 'state'
-
-
-def chart_citations(ws, chart_title):
-    # Gather data from 'ws' into a list of lists (rows)
-    data_rows = []
-    for row in ws.iter_rows(values_only=True):
-        data_rows.append(list(row))
-
-    # The first row typically contains the column headers
-    column_headers = data_rows.pop(0)  # This removes the first row and saves it as column headers
-
-    # Create a DataFrame from the rows of data
-    df = pd.DataFrame(data_rows, columns=column_headers)
-
-    # Apply the function to each row and create a new DataFrame with the results
-    classifications = df.apply(classify_column, axis=1)
-
-    # The result is a Series of tuples. We can convert this Series into a new DataFrame
-    classifications_df = pd.DataFrame(classifications.tolist(), columns=['Revenue', 'Violation Type', 'Scope'])
+# the performance task and its example memo, read on first use
+_performance_task = None
+
+
+def get_client() -> OpenAI:
+    """Return the OpenAI client, shared with embeddings.py and created on first use."""
+    return embeddings.get_client()
+
+
+def get_performance_task():
+    """Return the text of the performance task description and of its example memo, read on first use."""
+    global _performance_task
+    if _performance_task is None:
+        # Load the Word documents and read their text
+        description_doc = Document('files/Data Analyst Performance Task_v2.docx')
+        example_doc = Document('files/Sample Memo - BZA Fees-2.docx')
+        _performance_task = ('\n'.join(paragraph.text for paragraph in description_doc.paragraphs),
+                             '\n'.join(paragraph.text for paragraph in example_doc.paragraphs))
+    return _performance_task
+
+
+# system prompt shared by the completions that answer questions about the project
+project_assistant_prompt = ("You are a data scientist, you respond in a casual to the point manner. "
+                            "You are working on a data analysis project for the city of New Orleans. "
+                            "You are analyzing the effects of New Orleans Police Department Traffic Citations "
+                            "on the annual budget. "
+                            "Answer questions about the memo, math sheet, and table provided in a "
+                            "slightly casual, but professional manner. "
+                            "You also answer questions about the methods analysis, and telegram bot used in the project. "
+                            "the code used for the methods and analysis is in the python files provided. "
+                            "feel free to provide examples but dont reveal any api keys."
+                            "You can also answer questions about the telegram bot used to communicate with you. "
+                            "if the answer to a question isn't related to the project, "
+                            "just say so, and then answer the question as best you can anyways. ")
+
+def build_violation_table(violation_types_ws, summary_ws):
+    """
+    Build the lookup table used to classify citations from the workbook
+    :param violation_types_ws: 'Violation Types' sheet, code in column A and violation in column B
+    :param summary_ws: 'Summary' sheet, violation in column A with its local and state fines in columns B and C
+    :return: DataFrame with a row per code and columns 'code', 'Violation Type', 'Scope' and 'Revenue'
+    """
+    fines = {}
+    for name, local_fine, state_fine in summary_ws.iter_rows(min_row=3, max_col=3, values_only=True):
+        if name is None or str(name).strip().upper() == 'TOTALS':
+            break
+        fines[str(name).strip()] = {'local': local_fine, 'state': state_fine}
+
+    rows = []
+    for code, violation in violation_types_ws.iter_rows(min_row=2, max_col=2, values_only=True):
+        if code is None:
+            break
+        code = str(code).strip()
+        violation = str(violation).strip()
+        scope = 'local' if code.startswith(local_code_prefix) else 'state'
+        if violation not in fines:
+            raise ValueError(f"'{violation}' ({code}) is in Violation Types but has no fines in the Summary sheet")
+        rows.append((code, violation, scope, float(fines[violation][scope])))
+    return pd.DataFrame(rows, columns=['code', 'Violation Type', 'Scope', 'Revenue'])
+
+
+def classify_codes(codes, violation_table):
+    """
+    Classify citation codes by the longest code in the violation table they start with
+    Each distinct code is matched once and mapped back to the rows, so the cost grows with the number of distinct
+    codes rather than the number of citations. Codes that match nothing are reported and left empty.
+    :param codes: Series of citation codes
+    :param violation_table: DataFrame from build_violation_table
+    :return: DataFrame with the 'Revenue', 'Violation Type' and 'Scope' of each code, in the same order
+    """
+    codes = pd.Series(codes)
+    row_codes, unique_codes = pd.factorize(codes.astype('string').str.strip())
+    # Longest codes first so that 154:1298 is not taken for a shorter code
+    prefixes = sorted(violation_table['code'], key=len, reverse=True)
+    pattern = '^(' + '|'.join(re.escape(prefix) for prefix in prefixes) + ')'
+    matched = pd.Series(unique_codes, dtype='string').str.extract(pattern, expand=False)
+    table_rows = pd.Index(violation_table['code']).get_indexer(matched)
+
+    unknown = np.flatnonzero(table_rows == -1)
+    if len(unknown):
+        counts = np.bincount(row_codes[row_codes >= 0], minlength=len(unique_codes))
+        report = {str(unique_codes[i]): int(counts[i]) for i in unknown}
+        print(f"Warning: {sum(report.values())} citations have codes that aren't in Violation Types: {report}")
+    if (row_codes == -1).any():
+        print(f"Warning: {int((row_codes == -1).sum())} citations have no code")
+
+    rows = np.where(row_codes >= 0, table_rows[row_codes], -1)
+    violation_codes, violations = pd.factorize(violation_table['Violation Type'])
+    scope_codes, scopes = pd.factorize(violation_table['Scope'])
+    revenue = violation_table['Revenue'].to_numpy(dtype=float)
+    return pd.DataFrame({
+        'Revenue': np.where(rows >= 0, revenue[rows], np.nan),
+        'Violation Type': pd.Categorical.from_codes(np.where(rows >= 0, violation_codes[rows], -1), violations),
+        'Scope': pd.Categorical.from_codes(np.where(rows >= 0, scope_codes[rows], -1), scopes),
+    }, index=codes.index)
+
+
+def chart_citations(df, chart_title, violation_table):
+    """
+    Classify the citations and start drawing their charts
+    :param df: citations DataFrame, from workbooks.stream_data_sheet
+    :param chart_title: prefix of the revenue chart's title
+    :param violation_table: DataFrame from build_violation_table
+    :return: (the citations with their classification and month, Future of the charts)
+    """
+    df = df.reset_index(drop=True)
+
+    # Look up the fine, violation type and scope of every citation's code
+    classifications_df = classify_codes(df['Violation Cited (State/Local Code Reference)'], violation_table)
 
     # Now, concatenate this new DataFrame with the original 'df'
     df = pd.concat([df, classifications_df], axis=1)
@@ -115,59 +159,17 @@ def chart_citations(ws, chart_title):
     # Add a column for month-year
     df['Month-Year'] = df['Violation Date'].dt.to_period('M')
 
-    # Group by 'Violation Type' and 'Scope', and count the number of citations
-    total_violations_by_type = df.groupby(['Violation Type', 'Scope'])['Violation Type'].count().unstack()
-
-    # Plotting the total number of violations per violation type
-    plt.figure(figsize=(10, 5))  # Adjusts the size of the plot
-
-    # Use kind='bar' to create a bar chart with separate bars for 'State' and 'Local'
-    total_violations_by_type.plot(kind='bar', stacked=False)
-
-    # Add titles and labels
-    plt.title('Number of Citations by Violation Type')
-    plt.xlabel('Violation Type')
-    plt.ylabel('Number of Citations')
-
-    # Shorten or rotate x-axis labels for better readability
-    plt.xticks(rotation=45, ha='right')  # Rotate the labels and align them right for better fit
-
-    # Add legend to distinguish between 'State' and 'Local' totals
-    plt.legend(title='Scope')
-
-    # Save the plot
-    plt.savefig(f'files/{chart_title}_citations_plot.png', bbox_inches='tight')
-
-    plt.savefig(f'files/{chart_title}_citations_plot.png', bbox_inches='tight')
-
-    # Group by 'Month-Year' and 'Scope', then calculate the total revenue
-    total_revenue = df.groupby(['Violation Type', 'Scope'])['Revenue'].sum().unstack()
-
-    total_revenue.plot(kind='bar', stacked=False)  # Use kind='bar' to create a bar chart
-    # total_monthly_revenue['local'].plot(kind='line', marker='o', label='Total Local Revenue')
-    # total_monthly_revenue['state'].plot(kind='line', marker='x', label='Total State Revenue')
+    # Draw the charts in the worker process while the memo is being written
+    charts_future = charts.render_charts_in_background(chart_title, df)
 
-    # Add titles and labels
-    plt.title(f'{chart_title} Citation Revenue by Violation Type')
-    plt.xlabel('Violation Type')
-    plt.ylabel('Total Revenue ($)')
-
-    # Rotate date labels for better readability
-    plt.xticks(rotation=45, ha='right')
-
-    # Add legend to distinguish between local and state totals
-    plt.legend()
-
-    plt.savefig(f'files/{chart_title}_revenue_plot.png', bbox_inches='tight')
-
-    return df
+    return df, charts_future
 
 
 
 def get_embedding(text, model="text-embedding-3-large"):
     print(text)
     text = text.replace("\n", " ")
-    emb = client.embeddings.create(input = [text], model=model).data[0].embedding
+    emb = get_client().embeddings.create(input = [text], model=model).data[0].embedding
     df = pd.DataFrame({'text': text, 'embeddings': emb})
     return df
 
@@ -223,8 +225,85 @@ def get_text_from_ws(worksheet):
     return text
 
 
+month_numbers = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+month_numbers.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+month_numbers['sept'] = 9
+# "Aug 2017-Aug 2018", "August 2017 to August 2018", "Aug-Dec 2017", "08/2017 - 08/2018"
+named_period_pattern = re.compile(r'\b([a-z]{3,9})\.?,?\s*(\d{4})?\s*(?:-|\u2013|\u2014|to|through|thru|until)\s*'
+                                  r'([a-z]{3,9})\.?,?\s*(\d{4})\b', re.IGNORECASE)
+numeric_period_pattern = re.compile(r'\b(\d{1,2})/(\d{4})\s*(?:-|\u2013|\u2014|to|through|thru|until)\s*(\d{1,2})/(\d{4})\b',
+                                    re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def parse_months(cell_value):
+    """
+    Return the number of months in a period such as "Citations (Aug 2017-Aug 2018)", or None if none is found
+    Both the first and the last month are counted: Aug 2017 to Aug 2018 is 13 months, Jan to Dec 2018 is 12.
+    """
+    text = str(cell_value or '')
+    # Skip matches whose words aren't months, e.g. "Citations to August 2018", trying again from the next word
+    match = named_period_pattern.search(text)
+    while match and not (match.group(1).lower() in month_numbers and match.group(3).lower() in month_numbers):
+        match = named_period_pattern.search(text, match.end(1))
+    if match:
+        start_month, end_month = month_numbers[match.group(1).lower()], month_numbers[match.group(3).lower()]
+        end_year = int(match.group(4))
+        # "Aug-Dec 2017" shares the end year, "Nov-Feb 2018" starts the year before
+        start_year = int(match.group(2)) if match.group(2) else end_year - (start_month > end_month)
+    else:
+        match = numeric_period_pattern.search(text)
+        if not match:
+            return None
+        start_month, start_year, end_month, end_year = (int(group) for group in match.groups())
+        if not (1 <= start_month <= 12 and 1 <= end_month <= 12):
+            return None
+    months = (end_year - start_year) * 12 + end_month - start_month + 1
+    return months if months > 0 else None
+
+
+def months_spanned(dates):
+    """Return the number of calendar months from the first to the last of a series of dates, or None without dates."""
+    dates = pd.to_datetime(dates, errors='coerce').dropna()
+    if dates.empty:
+        return None
+    first, last = dates.min(), dates.max()
+    return (last.year - first.year) * 12 + last.month - first.month + 1
+
+
+@lru_cache(maxsize=256)
+def months_from_llm(cell_value):
+    """Ask the LLM for the number of months in a period, only used when it can't be parsed or checked locally."""
+    reply = get_months(cell_value).content
+    number = re.search(r'\d+', reply or '')
+    if not number:
+        raise ValueError(f"Could not get the number of months from '{cell_value}', the model replied '{reply}'")
+    return int(number.group())
+
+
+def get_number_of_months(cell_value, violation_dates=None):
+    """
+    Return the number of months the data covers, from the Summary header checked against the violation dates
+    :param cell_value: header text such as "Citations (Aug 2017-Aug 2018)"
+    :param violation_dates: the parsed Violation Date column, used to check the header
+    :return: number of months
+    """
+    months = parse_months(cell_value)
+    data_months = months_spanned(violation_dates) if violation_dates is not None else None
+    if months is not None and data_months is not None and abs(months - data_months) > month_tolerance:
+        print(f"Warning: '{cell_value}' implies {months} months but the violation dates span {data_months}, "
+              f"using the dates")
+        months = data_months
+    if months is None:
+        months = data_months
+    if months is None:
+        months = months_from_llm(cell_value)
+    print(f"The data spans {months} months")
+    return months
+
+
 def get_months(cell_value):
-    completion = client.chat.completions.create(
+    completion = get_client().chat.completions.create(
         model=gpt4,
         messages=[
             {"role": "system", "content": "you will return only the number of months implied by given text."
@@ -235,8 +314,10 @@ def get_months(cell_value):
     return completion.choices[0].message
 
 
-def get_summarized_context(prompt, model, text):
-    completion = client.chat.completions.create(
+def get_summarized_context(prompt, model, text, timeout=None):
+    # timeout (seconds) applies to this request only, instead of the client's default
+    request_client = get_client().with_options(timeout=timeout, max_retries=0) if timeout else get_client()
+    completion = request_client.chat.completions.create(
         model=model,
         messages=[
             {"role": "system", "content": "you are trying to reduce token usage by sumarizing relvant parts of a given text. "
@@ -252,8 +333,31 @@ def get_summarized_context(prompt, model, text):
     )
     return completion.choices[0].message
 
+def get_summaries_concurrently(prompt, model, texts, max_workers=summary_max_workers, timeout=summary_timeout):
+    """
+    Summarize several texts for the same prompt at the same time
+    :param prompt: the user's question
+    :param model: model used for the summaries
+    :param texts: dict of name -> text to summarize
+    :param max_workers: maximum number of summary requests in flight
+    :param timeout: seconds each request may take, a request that times out or fails gives an empty summary
+    :return: dict of name -> summary text
+    """
+    summaries = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {name: executor.submit(get_summarized_context, prompt, model, text, timeout)
+                   for name, text in texts.items()}
+        for name, future in futures.items():
+            try:
+                summaries[name] = future.result().content
+            except Exception as e:
+                print(f"Error: {name} summary failed... {e}")
+                summaries[name] = ""
+    return summaries
+
+
 def is_question_relevant(prompt, model, text):
-    completion = client.chat.completions.create(
+    completion = get_client().chat.completions.create(
         model=model,
         messages=[
             {"role": "system", "content": "you will check if the users question could be interpreted to be about "
@@ -272,29 +376,67 @@ def is_question_relevant(prompt, model, text):
     return completion.choices[0].message
 
 
-def get_completion(prompt, model, text, math_sheet, table, messager, methods, analysis):
+def print_usage(completion):
+    # Print the number of tokens used in the completion and what they cost
+    completion_tokens = completion.usage.completion_tokens
+    completion_price = completion_tokens * (0.03/1000)
+    print(f"Number of completion tokens: {completion_tokens} ${completion_price}\n")
 
-    memo_summary = get_summarized_context(prompt, model, text)
+    prompt_tokens = completion.usage.prompt_tokens
+    prompt_price = prompt_tokens * (0.01/1000)
+    print(f"Number of prompt tokens: {prompt_tokens} ${prompt_price}\n")
 
-    relevant = is_question_relevant(prompt, gpt3, memo_summary.content)
-    print(f"Is the question relevant to the project? {relevant}")
+    tokens_used = completion.usage.total_tokens
+    total_price = completion_price + prompt_price
+    print(f"\nNumber of tokens used: {tokens_used}\nTotal Price: ${total_price}\n")
 
-    if relevant.content == "True":
 
-        math_sheet_summary = get_summarized_context(prompt, gpt3, math_sheet)
-        math_sheet_summary = math_sheet_summary.content
+def create_completion(model, messages, on_text=None):
+    """
+    Run a chat completion, streaming it when on_text is given
+    :param model: model used for the answer
+    :param messages: chat messages
+    :param on_text: called with the text received so far each time more of the answer arrives
+    :return: the completion message
+    """
+    if on_text is None:
+        completion = get_client().chat.completions.create(model=model, messages=messages)
+        print_usage(completion)
+        return completion.choices[0].message
+
+    stream = get_client().chat.completions.create(model=model, messages=messages, stream=True,
+                                            stream_options={"include_usage": True})
+    text = ''
+    for chunk in stream:
+        # The last chunk carries the usage and no choices
+        if chunk.usage is not None:
+            print_usage(chunk)
+        if chunk.choices and chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            on_text(text)
+    return ChatCompletionMessage(role='assistant', content=text)
 
-        table_summary = get_summarized_context(prompt, gpt3, table)
-        table_summary = table_summary.content
 
-        messager_summary = get_summarized_context(prompt, gpt3, messager)
-        messager_summary = messager_summary.content
+def get_completion(prompt, model, text, math_sheet, table, messager, methods, analysis, on_text=None):
 
-        methods_summary = get_summarized_context(prompt, gpt3, methods)
-        methods_summary = methods_summary.content
+    memo_summary = get_summarized_context(prompt, model, text)
 
-        analysis_summary = get_summarized_context(prompt, gpt3, analysis)
-        analysis_summary = analysis_summary.content
+    relevant = is_question_relevant(prompt, gpt3, memo_summary.content)
+    print(f"Is the question relevant to the project? {relevant}")
+
+    if relevant.content == "True":
+
+        # The five summaries are independent, so run them at the same time
+        summaries = get_summaries_concurrently(prompt, gpt3, {'math_sheet': math_sheet,
+                                                              'table': table,
+                                                              'messager': messager,
+                                                              'methods': methods,
+                                                              'analysis': analysis})
+        math_sheet_summary = summaries['math_sheet']
+        table_summary = summaries['table']
+        messager_summary = summaries['messager']
+        methods_summary = summaries['methods']
+        analysis_summary = summaries['analysis']
 
     else:
         text = memo_summary.content
@@ -304,91 +446,141 @@ def get_completion(prompt, model, text, math_sheet, table, messager, methods, an
         methods_summary = ""
         analysis_summary = ""
 
-    completion = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": "You are a data scientist, you respond in a casual to the point manner. "
-                                          "You are working on a data analysis project for the city of New Orleans. "
-                                          "You are analyzing the effects of New Orleans Police Department Traffic Citations "
-                                          "on the annual budget. "
-                                          "Answer questions about the memo, math sheet, and table provided in a "
-                                          "slightly casual, but professional manner. "
-                                          "You also answer questions about the methods analysis, and telegram bot used in the project. "
-                                          "the code used for the methods and analysis is in the python files provided. "
-                                          "feel free to provide examples but dont reveal any api keys."
-                                          "You can also answer questions about the telegram bot used to communicate with you. "
-                                          "if the answer to a question isn't related to the project, "
-                                          "just say so, and then answer the question as best you can anyways. "
-                                          "Below are summarized Project Details specific to the question: \n"
-                                          f"Memo: {text} \n"
-                                          f"Math Sheet: {math_sheet_summary} \n"
-                                          f"Table: {table_summary} \n"
-                                          f"Messager: {messager_summary} \n"
-                                          f"Methods: {methods_summary} \n"
-                                          f"Analysis: {analysis_summary} \n"
-            },
-            {"role": "user", "content": prompt}
-        ]
-    )
-    # Retrieve the number of tokens used in the completion
-
-    completion_tokens = completion.usage.completion_tokens
-    completion_price = completion_tokens * (0.03/1000)
-    print(f"Number of completion tokens: {completion_tokens} ${completion_price}\n")
-
-    prompt_tokens = completion.usage.prompt_tokens
-    prompt_price = prompt_tokens * (0.01/1000)
-    print(f"Number of prompt tokens: {prompt_tokens} ${prompt_price}\n")
-
-    tokens_used = completion.usage.total_tokens
-    total_price = completion_price + prompt_price
-    print(f"\nNumber of tokens used: {tokens_used}\nTotal Price: ${total_price}\n")
-    return completion.choices[0].message
+    return create_completion(model, [
+        {"role": "system", "content": project_assistant_prompt +
+                                      "Below are summarized Project Details specific to the question: \n"
+                                      f"Memo: {text} \n"
+                                      f"Math Sheet: {math_sheet_summary} \n"
+                                      f"Table: {table_summary} \n"
+                                      f"Messager: {messager_summary} \n"
+                                      f"Methods: {methods_summary} \n"
+                                      f"Analysis: {analysis_summary} \n"
+        },
+        {"role": "user", "content": prompt}
+    ], on_text)
+
+
+def get_context_completion(prompt, model, context, on_text=None):
+    """
+    Answer a question from project context retrieved ahead of time (see artifacts.retrieve_context),
+    in a single completion instead of summarizing every project file first
+    :param prompt: the user's question
+    :param model: model used for the answer
+    :param context: the most relevant chunks of the memo, math sheet, workbook and code
+    :param on_text: streams the answer, called with the text received so far (see create_completion)
+    :return: the completion message
+    """
+    return create_completion(model, [
+        {"role": "system", "content": project_assistant_prompt +
+                                      "Below are the parts of the project files most relevant to the question: \n"
+                                      f"{context}"},
+        {"role": "user", "content": prompt}
+    ], on_text)
+
+
+memo_instructions = ("You are a data scientist text completion bot for the city of new orleans, "
+                     "skilled in analyzing data and conveying important findings concisely. "
+                     "You respond in first person in a casual, easily understandable, but professional manner. "
+                     "Dont use word that are too complex, and keep the memo simple and to the point. "
+                     "You are writing a memo to your manager about the findings of your analysis "
+                     "of effects of New Orleans Police Department Traffic Citations "
+                     "on the annual budget. The memo should be clear, concise, and informative."
+                     "The memo will demonstrate your ability to communicate, "
+                     "complex data in a simple and understandable way. "
+                     "Remember that the task is the analyze the NOPD Citation data, "
+                     "and that the columns in the dataset that are not "
+                     "specified as nopd were submitted by state police, "
+                     "and therefore should not be considered as NOPD citations in the analysis. "
+                     "The user will indicate which part of the prompt that needs to be completed. "
+                     "The formatting of the memo is already completed, "
+                     "so you must always leave out all section titles, additional formatting, "
+                     "and asterisks like **...**. "
+                     "Make sure the memo in its entirety is coherent, flows well, and isn't redundant. "
+                     "No need to label the section with a title such as BACKGROUND, "
+                     "as that has already been accounted for. ")
+
+
+def serialize_dataframe(df, decimals=2) -> str:
+    """
+    Write a DataFrame as compact CSV for a prompt
+    Leaves out the index and empty columns, rounds numbers to cents and writes whole numbers without decimals.
+    """
+    compact = {}
+    for column in df.columns:
+        values = df[column]
+        if values.isna().all() or (values.astype(str).str.strip() == '').all():
+            continue
+        numbers = pd.to_numeric(values, errors='coerce')
+        # Only treat the column as numeric if every value in it is a number
+        if numbers.notna().sum() == values.notna().sum() and not values.map(lambda value: isinstance(value, bool)).any():
+            numbers = numbers.round(decimals)
+            values = numbers.astype('Int64') if (numbers.dropna() % 1 == 0).all() else numbers
+        compact[column] = values
+    return pd.DataFrame(compact).to_csv(index=False, lineterminator='\n').strip()
+
+
+def serialize_for_prompt(*frames) -> list[str]:
+    """Serialize DataFrames with serialize_dataframe and print how many tokens that saved over their default repr."""
+    serialized = [serialize_dataframe(frame) if isinstance(frame, pd.DataFrame) else str(frame) for frame in frames]
+    before = sum(embeddings.num_tokens(str(frame)) for frame in frames)
+    after = sum(embeddings.num_tokens(text) for text in serialized)
+    print(f"Prompt data: {after} tokens, {before - after} saved over the default DataFrame repr")
+    return serialized
+
+
+def memo_system_prompt(violation_types, totals, results):
+    """
+    Build the part of the memo prompt shared by every section, most static material first
+    The instructions, task and example never change and the data only changes with the workbook, so consecutive
+    requests share a byte-identical prefix the provider can cache.
+    """
+    violation_types, totals, results = serialize_for_prompt(violation_types, totals, results)
+    performance_task_description, performance_task_example = get_performance_task()
+    return (f"{memo_instructions}"
+            "The memo will be based off of the following prompt:"
+            f"{performance_task_description}.\n"
+            "The memo will be based off of the following example, but dont include "
+            "the to: from: section or any formatting, or chat-like responses"
+            "as the final product may end up being redundant:"
+            f"{performance_task_example}.\n"
+            "The memo will be based off of the following data:"
+            f"\n{violation_types}\ncontains the number of citations and revenue for each violation type.\n"
+            f"\n{totals}\ncontains the total number of citations and the total revenue. \n"
+            f"\n{results}\ncontains the required budget impact analysis. "
+            "Make sure to discuss the budget impact in detail\n")
+
+
+def get_completion_cache() -> CompletionCache:
+    """Return the local cache of memo completions, opened on first use."""
+    global _completion_cache
+    if _completion_cache is None:
+        _completion_cache = CompletionCache(completion_cache_path)
+    return _completion_cache
 
 
 def get_memo_completion(prompt, violation_types, totals, results, model, previous_text):
-    completion = client.chat.completions.create(
+    messages = [
+        {"role": "system", "content": memo_system_prompt(violation_types, totals, results)},
+        # The parts that change with every section go last so they don't break the shared prefix
+        {"role": "system", "content": "Since your purpose is to complete the memo section by section, "
+                                      "the sections that are previously written have been provided below: \n"
+                                      f"{previous_text}.\n "
+                                      "Do not include previous_text in the response, it is only for "
+                                      "reference so the final memo is not redundant. "},
+        {"role": "user", "content": prompt}
+    ]
+    cache = get_completion_cache()
+    request = cache.request_key(model, messages)
+    content = cache.get(request)
+    if content is not None:
+        print(f"Using the cached response for this memo section\n{content}")
+        return ChatCompletionMessage(role='assistant', content=content)
+
+    completion = get_client().chat.completions.create(
         model=model,
-        messages=[
-            {"role": "system", "content": "You are a data scientist text completion bot for the city of new orleans, "
-                                          "skilled in analyzing data and conveying important findings concisely. "
-                                          "You respond in first person in a casual, easily understandable, but professional manner. "
-                                          "Dont use word that are too complex, and keep the memo simple and to the point. "
-                                          "You are writing a memo to your manager about the findings of your analysis "
-                                          "of effects of New Orleans Police Department Traffic Citations "
-                                          "on the annual budget. The memo should be clear, concise, and informative."
-                                          "The memo will demonstrate your ability to communicate, "
-                                          "complex data in a simple and understandable way. "
-                                          "Remember that the task is the analyze the NOPD Citation data, "
-                                          "and that the columns in the dataset that are not "
-                                          "specified as nopd were submitted by state police, "
-                                          "and therefore should not be considered as NOPD citations in the analysis. "
-                                          "The user will indicate which part of the prompt that needs to be completed. "
-                                          "The formatting of the memo is already completed, "
-                                          "so you must always leave out all section titles, additional formatting, "
-                                          "and asterisks like **...**. "
-                                          "Additionally since your purpose is to complete the memo section by section, "
-                                          "the sections that are previously written have been provided below: \n"
-                                          f"{previous_text}.\n "
-                                          f"Do not include previous_text in the response, it is only for "
-                                          f"reference so the final memo is not redundant. "
-                                          "Make sure the memo in its entirety is coherent, flows well, and isn't redundant. "
-                                          "No need to label the section with a title such as BACKGROUND, "
-                                          "as that has already been accounted for"
-                                          "The memo will be based off of the following prompt:"
-                                          f"{performance_task_description}.\n"
-                                          "The memo will be based off of the following data:"
-                                          f"{violation_types} contains the number of citations and revenue for each violation type.\n"
-                                          f"{totals} contains the total number of citations and the total revenue. \n"
-                                          f"{results} contains the required budget impact analysis. "
-                                          "Make sure to discuss the budget impact in detail\n"
-                                          "The memo will be based off of the following example, but dont include "
-                                          "the to: from: section or any formatting, or chat-like responses"
-                                          "as the final product may end up being redundant:"
-                                          f"{performance_task_example}.\n"},
-            {"role": "user", "content": prompt}
-        ]
+        messages=messages
     )
+    cache.put(request, model, completion.choices[0].message.content)
     print(completion.choices[0].message.content)
     return completion.choices[0].message
 
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+
+
+class IVFIndex:
+    """
+    An approximate nearest-neighbour index over normalized embeddings (inverted file with a k-means coarse quantizer)
+    Every row is assigned to its closest centroid. A query only scores the rows in the n_probe lists whose
+    centroids are closest to it, so n_probe trades recall (higher) against latency (lower).
+    """
+    def __init__(self, centroids, offsets, rows):
+        # centroids: (n_lists, dimensions), rows of list i are rows[offsets[i]:offsets[i + 1]]
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, iterations=10, sample_size=50000, chunk_size=10000, seed=0):
+        """
+        Train the coarse quantizer with spherical k-means and assign every row to a list
+        :param matrix: normalized float32 embedding matrix (can be memory-mapped)
+        :param n_lists: number of lists, defaults to 4 * sqrt(rows)
+        :param iterations: k-means iterations
+        :param sample_size: number of rows k-means is trained on
+        :param chunk_size: rows assigned at a time, bounds the memory used for scoring
+        :param seed: random seed for the sample and the initial centroids
+        :return: IVFIndex
+        """
+        n = matrix.shape[0]
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(seed)
+
+        # Train on a sample, the centroids barely move with more data
+        sample_rows = np.sort(rng.choice(n, size=min(sample_size, n), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Keep the old centroid for lists that ended up empty
+            filled = norms[:, 0] > 0
+            centroids[filled] = sums[filled] / norms[filled]
+
+        assignments = np.empty(n, dtype=np.int32)
+        for start in range(0, n, chunk_size):
+            chunk = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+            assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+
+        # Stable sort keeps each list's rows in corpus order
+        rows = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, offsets, rows)
+
+    def save(self, directory):
+        # Written to temporary names first so a reader never loads a mix of old and new files
+        os.makedirs(directory, exist_ok=True)
+        for name, array in (('centroids', self.centroids), ('offsets', self.offsets), ('rows', self.rows)):
+            path = os.path.join(directory, f'{name}.npy')
+            with open(f'{path}.tmp', 'wb') as file:
+                np.save(file, array)
+            os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        mode = 'r' if mmap else None
+        return cls(np.load(os.path.join(directory, 'centroids.npy')),
+                   np.load(os.path.join(directory, 'offsets.npy')),
+                   np.load(os.path.join(directory, 'rows.npy'), mmap_mode=mode))
+
+    def candidates(self, query, n_probe):
+        """Return the rows in the n_probe lists closest to a normalized query, in corpus order."""
+        n_probe = min(n_probe, self.n_lists)
+        closest = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        rows = np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in closest])
+        return np.sort(rows)
@@ -0,0 +1,97 @@
+import os
+import time
+import sqlite3
+import threading
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    A semantic cache of answers: a question close enough to one asked before gets the stored answer back
+    Entries belong to a version of the project artifacts, and only entries of the version being asked about are
+    ever returned. Storing an answer for a new version deletes the entries of older versions.
+    """
+    def __init__(self, path, threshold=0.95, max_entries=1000):
+        """
+        :param path: sqlite file the answers are stored in
+        :param threshold: minimum cosine similarity between two questions for the stored answer to be reused
+        :param max_entries: answers kept per version before the least recently used are evicted
+        """
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # (version, rowids, normalized question matrix) of the version last looked up
+        self.loaded = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # The bot calls in from worker threads, every access goes through self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS answers ('
+                                'version TEXT, question TEXT, embedding BLOB, answer TEXT, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS answers_version ON answers (version)')
+        self.connection.commit()
+
+    def get(self, version, embedding):
+        """
+        Return (answer, question, similarity) of the closest question asked about this version, or None when no
+        question is at least threshold similar
+        """
+        query = self._normalize(embedding)
+        with self.lock:
+            rowids, matrix = self._load(version)
+            if len(rowids) == 0:
+                self.misses += 1
+                return None
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            rowid = int(rowids[best])
+            answer, question = self.connection.execute('SELECT answer, question FROM answers WHERE rowid = ?',
+                                                       (rowid,)).fetchone()
+            self.connection.execute('UPDATE answers SET last_used = ? WHERE rowid = ?', (time.time(), rowid))
+            self.connection.commit()
+            self.hits += 1
+            return answer, question, float(similarities[best])
+
+    def put(self, version, question, embedding, answer):
+        """Store the answer to a question about this version, dropping the answers about any other version."""
+        embedding = self._normalize(embedding)
+        with self.lock:
+            self.connection.execute('DELETE FROM answers WHERE version != ?', (version,))
+            self.connection.execute('INSERT INTO answers VALUES (?, ?, ?, ?, ?)',
+                                    (version, question, embedding.tobytes(), answer, time.time()))
+            self.connection.execute('DELETE FROM answers WHERE rowid IN (SELECT rowid FROM answers WHERE version = ? '
+                                    'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (version, self.max_entries))
+            self.connection.commit()
+            self.loaded = None
+
+    def stats(self):
+        """Return the hit/miss counters and the number of stored answers."""
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': entries}
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _load(self, version):
+        # Keep the question matrix of the current version in memory until an answer is added
+        if self.loaded is None or self.loaded[0] != version:
+            rows = self.connection.execute('SELECT rowid, embedding FROM answers WHERE version = ?',
+                                           (version,)).fetchall()
+            rowids = np.array([rowid for rowid, _ in rows], dtype=np.int64)
+            matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows]) if rows \
+                else np.empty((0, 0), dtype=np.float32)
+            self.loaded = (version, rowids, matrix)
+        return self.loaded[1], self.loaded[2]
@@ -0,0 +1,212 @@
+import os
+import hashlib
+import threading
+
+import numpy as np
+from openpyxl import load_workbook
+
+import analysis
+import embeddings
+from answer_cache import AnswerCache
+
+# store holding the embedded chunks of the memo, math sheet, workbook and code
+artifact_store_path = 'downloads/artifacts'
+# maximum tokens per chunk, and the tokens of retrieved chunks sent with each question
+chunk_tokens = 300
+context_token_budget = 3000
+# similarity to the centroid of the project artifacts below relevance_low is unrelated, at or above
+# relevance_high is related, and anything in between is left to the LLM check in analysis.is_question_relevant
+relevance_low = 0.15
+relevance_high = 0.30
+# answers to questions at least this similar to an earlier question about the same artifacts are reused
+answer_cache_path = 'downloads/answer_cache.sqlite'
+answer_similarity_threshold = 0.95
+
+# name -> (kind, path) of every project artifact a question can be answered from
+artifact_sources = {
+    'Memo': ('word', 'files/memo.docx'),
+    'Math Sheet': ('word', 'files/Math_Calculations_Work.docx'),
+    'Table': ('workbook', 'files/excel.xlsx'),
+    'Messager': ('python', 'messager.py'),
+    'Methods': ('python', 'methods.py'),
+    'Analysis': ('python', 'analysis.py'),
+}
+
+_index = None
+_centroid = None
+_answer_cache = None
+_index_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+
+
+def load_artifact_texts() -> dict:
+    """Read the text of every artifact that exists, as a dict of name -> text."""
+    texts = {}
+    for name, (kind, path) in artifact_sources.items():
+        if not os.path.exists(path):
+            continue
+        if kind == 'word':
+            texts[name] = analysis.get_text_from_word(path)
+        elif kind == 'workbook':
+            wb = load_workbook(path, read_only=True)
+            texts[name] = analysis.get_text_from_ws(wb['Summary'])
+            wb.close()
+        else:
+            texts[name] = analysis.get_text_from_python(path)
+    return texts
+
+
+def chunk_text(text, max_tokens=chunk_tokens) -> list[str]:
+    """
+    Split text into chunks of at most max_tokens, breaking between lines where possible
+    :param text: text to split
+    :param max_tokens: maximum tokens per chunk
+    :return: list of chunks
+    """
+    encoding = embeddings.encoding_for(embeddings.GPT_MODEL)
+    chunks = []
+    lines = []
+    size = 0
+    for line in text.splitlines():
+        encoded = encoding.encode(line)
+        # A single line longer than a chunk is cut by tokens
+        pieces = [encoded[i:i + max_tokens - 1] for i in range(0, len(encoded), max_tokens - 1)] or [encoded]
+        for piece in pieces:
+            tokens = len(piece) + 1  # plus the newline joining it to the previous line
+            if size + tokens > max_tokens and lines:
+                chunks.append('\n'.join(lines))
+                lines = []
+                size = 0
+            lines.append(encoding.decode(piece) if len(pieces) > 1 else line)
+            size += tokens
+    if any(line.strip() for line in lines):
+        chunks.append('\n'.join(lines))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def refresh_artifacts() -> dict:
+    """
+    Chunk and embed the project artifacts, only embedding chunks that changed since the last refresh
+    :return: the store's manifest
+    """
+    with _refresh_lock:
+        chunks = []
+        for name, text in load_artifact_texts().items():
+            # Label each chunk with its artifact so the answer can tell where it came from
+            chunks.extend(f'{name}:\n{chunk}' for chunk in chunk_text(text))
+        manifest = embeddings.sync_embedding_store(chunks, artifact_store_path, source='project artifacts')
+        index = embeddings.load_embedding_store(artifact_store_path) if chunks else None
+        global _index
+        with _index_lock:
+            _index = index
+        return manifest
+
+
+def refresh_artifacts_in_background() -> threading.Thread:
+    """Run refresh_artifacts in a daemon thread."""
+    def refresh():
+        try:
+            refresh_artifacts()
+        except Exception as e:
+            print(f"Error: refreshing project artifacts failed... {e}")
+    thread = threading.Thread(target=refresh, name='artifacts-refresh', daemon=True)
+    thread.start()
+    return thread
+
+
+def get_artifact_index():
+    """Return the EmbeddingIndex over the artifact chunks, or None if they haven't been embedded yet."""
+    global _index
+    with _index_lock:
+        if _index is None and os.path.exists(os.path.join(artifact_store_path, 'embeddings.npy')):
+            _index = embeddings.load_embedding_store(artifact_store_path)
+        return _index
+
+
+def retrieve_context(prompt, token_budget=context_token_budget, top_n=50):
+    """
+    Return the artifact chunks most related to a question that fit in token_budget, or None if there are none yet
+    :param prompt: the user's question
+    :param token_budget: maximum tokens of context
+    :param top_n: number of ranked chunks considered
+    :return: the chunks joined into one string, most related first
+    """
+    index = get_artifact_index()
+    if index is None:
+        return None
+    strings, relatednesses = embeddings.strings_ranked_by_relatedness(prompt, index, top_n=top_n)
+    chosen = embeddings.pack_articles(index.token_counts(strings), token_budget, fill_budget=True)
+    return '\n\n'.join(strings[i] for i in chosen)
+
+
+def topic_centroid(index):
+    """Return the normalized mean of the artifact embeddings, computed once per index."""
+    global _centroid
+    if _centroid is None or _centroid[0] is not index:
+        _centroid = (index, embeddings.normalize_embeddings(np.asarray(index.matrix).mean(axis=0))[0])
+    return _centroid[1]
+
+
+def relevance_score(prompt):
+    """Return the cosine similarity of a question to the centroid of the project artifacts, or None without them."""
+    index = get_artifact_index()
+    if index is None:
+        return None
+    # The question's embedding is usually already cached by retrieve_context
+    query = embeddings.normalize_embeddings(embeddings.embed_query(prompt))[0]
+    return float(topic_centroid(index) @ query)
+
+
+def is_question_relevant(prompt, context, low=relevance_low, high=relevance_high):
+    """
+    Decide locally whether a question is about the project, only asking the LLM when the score is uncertain
+    :param prompt: the user's question
+    :param context: project text the LLM check compares the question against
+    :param low: scores below this are unrelated
+    :param high: scores at or above this are related
+    :return: True if the question is about the project
+    """
+    score = relevance_score(prompt)
+    if score is not None and score >= high:
+        relevant = True
+    elif score is not None and score < low:
+        relevant = False
+    else:
+        relevant = analysis.is_question_relevant(prompt, analysis.gpt3, context).content == "True"
+        print(f"Relevance score {score} is uncertain, asked the LLM")
+    print(f"Is the question relevant to the project? {relevant} (score {score})")
+    return relevant
+
+
+def artifact_version() -> str:
+    """Identify the current version of the project artifacts by the size and modification time of their files."""
+    digest = hashlib.sha256()
+    for name, (kind, path) in artifact_sources.items():
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+
+def get_answer_cache() -> AnswerCache:
+    """Return the semantic cache of answers, opened on first use."""
+    global _answer_cache
+    with _index_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(answer_cache_path, threshold=answer_similarity_threshold)
+        return _answer_cache
+
+
+def cached_answer(prompt):
+    """Return the stored answer to a question like this one about the current artifacts, or None."""
+    cached = get_answer_cache().get(artifact_version(), embeddings.embed_query(prompt))
+    if cached is None:
+        return None
+    answer, question, similarity = cached
+    print(f"Answering from the cache, '{question}' is {similarity:.3f} similar")
+    return answer
+
+
+def remember_answer(prompt, answer):
+    """Store the answer to a question about the current artifacts for cached_answer."""
+    get_answer_cache().put(artifact_version(), prompt, embeddings.embed_query(prompt), answer)
@@ -0,0 +1,106 @@
+import os
+import io
+import hashlib
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')  # headless, the bot has no display
+import matplotlib.pyplot as plt
+import pandas as pd
+
+# rendered PNGs, named by a hash of the data they were drawn from
+chart_cache_path = 'downloads/charts'
+chart_names = ('citations', 'revenue')
+
+_executor = None
+
+
+def aggregate_citations(df) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Return the citation counts and revenue by violation type (rows) and scope (columns) that the charts show."""
+    grouped = df.groupby(['Violation Type', 'Scope'], observed=True)
+    return grouped['Violation Type'].count().unstack(), grouped['Revenue'].sum().unstack()
+
+
+def chart_key(chart_title, counts, revenue) -> str:
+    """Hash the chart title and the aggregated data, charts of the same data are only drawn once."""
+    digest = hashlib.sha256(chart_title.encode())
+    for table in (counts, revenue):
+        digest.update(table.to_csv().encode())
+    return digest.hexdigest()
+
+
+def _bar_chart(table, title, ylabel, legend_title=None) -> bytes:
+    fig, ax = plt.subplots()
+    try:
+        table.plot(kind='bar', stacked=False, ax=ax)
+        ax.set_title(title)
+        ax.set_xlabel('Violation Type')
+        ax.set_ylabel(ylabel)
+        # Rotate the labels and align them right for better fit
+        plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
+        ax.legend(title=legend_title)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png', bbox_inches='tight')
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def render_charts(chart_title, counts, revenue) -> dict:
+    """Draw the citation and revenue bar charts, returns name -> PNG bytes."""
+    return {
+        'citations': _bar_chart(counts, 'Number of Citations by Violation Type', 'Number of Citations', 'Scope'),
+        'revenue': _bar_chart(revenue, f'{chart_title} Citation Revenue by Violation Type', 'Total Revenue ($)',
+                              'Scope'),
+    }
+
+
+def _cached_paths(key) -> dict:
+    return {name: os.path.join(chart_cache_path, f'{key}-{name}.png') for name in chart_names}
+
+
+def _save_charts(key, future):
+    # Runs in the parent once the worker has finished
+    if future.exception() is not None:
+        return
+    os.makedirs(chart_cache_path, exist_ok=True)
+    for name, path in _cached_paths(key).items():
+        with open(f'{path}.tmp', 'wb') as file:
+            file.write(future.result()[name])
+        os.replace(f'{path}.tmp', path)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Return the worker process charts are drawn in, started on first use."""
+    global _executor
+    if _executor is None:
+        # The bot has threads, an HTTP client and sqlite connections open by now, which a fork would copy mid-use.
+        # A spawned worker starts a fresh interpreter, which re-imports the bot's main module (messager.py) and its
+        # imports before running render_charts. Those only define functions and settings at import, the bot, its log
+        # file, the OpenAI client and the project files are set up in main() or on first use.
+        _executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def render_charts_in_background(chart_title, df) -> Future:
+    """
+    Draw the charts for a classified citations DataFrame in the worker process, unless they are cached
+    :param chart_title: prefix of the revenue chart's title
+    :param df: DataFrame from analysis.chart_citations
+    :return: Future resolving to name -> PNG bytes
+    """
+    counts, revenue = aggregate_citations(df)
+    key = chart_key(chart_title, counts, revenue)
+    paths = _cached_paths(key)
+    if all(os.path.exists(path) for path in paths.values()):
+        future = Future()
+        charts = {}
+        for name, path in paths.items():
+            with open(path, 'rb') as file:
+                charts[name] = file.read()
+        future.set_result(charts)
+        return future
+    future = get_executor().submit(render_charts, chart_title, counts, revenue)
+    future.add_done_callback(lambda done: _save_charts(key, done))
+    return future
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class CompletionCache:
+    """
+    A sqlite cache of chat completions keyed on a hash of the full request, so identical requests are only paid once
+    """
+    def __init__(self, path, max_disk_bytes=64 * 1024 * 1024):
+        """
+        :param path: sqlite file the responses are stored in
+        :param max_disk_bytes: total size of the stored responses before the least recently used are evicted
+        """
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # The bot calls in from worker threads, every access goes through self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS completions ('
+                                'request TEXT PRIMARY KEY, model TEXT, content TEXT, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)')
+        self.connection.commit()
+
+    @staticmethod
+    def request_key(model, messages, **options):
+        """Return the SHA-256 of a request's model, messages and any other options."""
+        request = json.dumps({'model': model, 'messages': messages, **options}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get(self, request):
+        """Return the cached response content for a request key, or None."""
+        with self.lock:
+            row = self.connection.execute('SELECT content FROM completions WHERE request = ?', (request,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE completions SET last_used = ? WHERE request = ?', (time.time(), request))
+            self.connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, request, model, content):
+        """Store the response content for a request key."""
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)',
+                                    (request, model, content, time.time()))
+            self._evict()
+            self.connection.commit()
+
+    def stats(self):
+        """Return the hit/miss counters and the number of cached responses."""
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': entries}
+
+    def _evict(self):
+        # Delete the least recently used responses until they fit in max_disk_bytes
+        total = self.connection.execute('SELECT COALESCE(SUM(LENGTH(content)), 0) FROM completions').fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self.connection.execute('SELECT rowid, LENGTH(content) FROM completions ORDER BY last_used')
+        expired = []
+        for rowid, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            expired.append((rowid,))
+            total -= size
+        self.connection.executemany('DELETE FROM completions WHERE rowid = ?', expired)
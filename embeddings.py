@@ -2,59 +2,535 @@ import os
 import re
 import string
 import dotenv
+import numpy as np
 import pandas as pd
-from scipy import spatial
-import ast
+import json
+import shutil
+import hashlib
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from numpy.lib.format import open_memmap
 from openai import OpenAI
 import tiktoken
+from query_cache import QueryEmbeddingCache
+from ann import IVFIndex
+from quantize import QuantizedIndex
+from lexical import BM25Index, code_references, reciprocal_rank_fusion
 
-dotenv.load_dotenv()
-openai_api_key = os.getenv('OPENAI_API_KEY')  # Now you can access the API key
-client = OpenAI(api_key=openai_api_key)
 token_budget = 2000
 embedding_model = "text-embedding-3-large"
+# limits of the embeddings endpoint: tokens per input, tokens per request and inputs per request
+embedding_input_token_limit = 8191
+embedding_request_token_limit = 300000
+embedding_request_input_limit = 2048
+# number of IVF lists scanned per query when an approximate index is available, higher is slower but more accurate
+default_n_probe = 16
+# number of candidates a quantized index picks for the float32 re-rank
+default_rerank_candidates = 400
+# rows taken from each of the vector and BM25 rankings before reciprocal rank fusion, and the fusion constant
+hybrid_candidates = 100
+rrf_k = 60
 gpt4 = "gpt-4-0125-preview"
 gpt3 = "gpt-3.5-turbo-0125"
 GPT_MODEL = gpt3
-# Set display options to show all columns and rows
-pd.set_option('display.max_columns', None)
-pd.set_option('display.max_rows', None)
 
 filepath = 'text/NewOrleansCodes.xlsx'
+# legacy CSV of texts and stringified embeddings, only read to convert it to the binary store
 embedding_path = 'downloads/cityembeddings.csv'
+# directory holding embeddings.npy (float32 matrix) and texts.csv (one row per embedding)
+store_path = 'downloads/cityembeddings'
+# sqlite file caching embeddings of past queries, so repeated questions skip the embeddings API
+query_cache_path = 'downloads/query_cache.sqlite'
+
+# The client, corpus and query cache are created on first use (or by warm_up) so importing this module is cheap
+_client = None
+_corpus = None
+_query_cache = None
+_init_lock = threading.Lock()
+# Loading (or converting) the corpus takes seconds, so it has its own lock rather than holding up the client
+_corpus_lock = threading.Lock()
+
+
+def get_client() -> OpenAI:
+    """Return the shared OpenAI client, creating it on first use."""
+    global _client
+    with _init_lock:
+        if _client is None:
+            dotenv.load_dotenv()
+            # OPENAI_BASE_URL points the client at another server, such as the stub embeddings server in the tests
+            _client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), base_url=os.getenv('OPENAI_BASE_URL'))
+        return _client
+
+
+def get_query_cache() -> QueryEmbeddingCache:
+    """Return the shared query embedding cache, opening it on first use."""
+    global _query_cache
+    with _init_lock:
+        if _query_cache is None:
+            _query_cache = QueryEmbeddingCache(query_cache_path)
+        return _query_cache
+
+
+@functools.lru_cache(maxsize=None)
+def encoding_for(model: str):
+    """Return the tiktoken encoding for a model, loading it only once."""
+    return tiktoken.encoding_for_model(model)
 
-# create_embedding_df(filepath, embedding_path)
-print('loading embeddings...')
-df = pd.read_csv(embedding_path)
 
-# convert embeddings from CSV str type back to list type
-df['embedding'] = df['embedding'].apply(ast.literal_eval)
-print('embeddings loaded')
-print(df.head())
+def num_tokens(text: str, model: str = GPT_MODEL) -> int:
+    """Return the number of tokens in a string."""
+    return len(encoding_for(model).encode(text))
+
+
+def normalize_embeddings(embeddings) -> np.ndarray:
+    """Stack embeddings into a float32 matrix with unit-length rows so cosine similarity is a dot product."""
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # leave all-zero rows as zeros instead of dividing by zero
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, top_n: int) -> np.ndarray:
+    """Return the indices of the top_n highest scores, best first; ties keep their original order."""
+    n = scores.shape[0]
+    top_n = min(top_n, n)
+    if top_n <= 0:
+        return np.empty(0, dtype=np.intp)
+    if top_n < n:
+        # only partially sort the corpus, then order the few survivors
+        candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+    else:
+        candidates = np.arange(n)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order]
+
+
+class EmbeddingIndex:
+    """
+    A search index holding the texts and a pre-normalized float32 embedding matrix
+    """
+    def __init__(self, texts, embeddings, normalized=False, metadata=None):
+        self.texts = np.asarray(texts, dtype=object)
+        # Normalize once up front so every query is a single matrix-vector product
+        self.matrix = embeddings if normalized else normalize_embeddings(embeddings)
+        # One row per embedding, the text plus anything else stored alongside it
+        self.metadata = metadata if metadata is not None else pd.DataFrame({'text': self.texts})
+        self._token_counts = None
+        # Optional approximate index (IVFIndex) and compressed copy (QuantizedIndex), exact search is used without them
+        self.ann = None
+        self.quantized = None
+        self._lexical = None
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame):
+        # Build the index from a dataframe with 'text' and 'embedding' columns
+        return cls(df['text'].to_numpy(), np.vstack(df['embedding'].to_numpy()))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def token_counts(self, texts) -> list[int]:
+        """Return the GPT_MODEL token count of each text, using the counts stored with the embeddings."""
+        if self._token_counts is None:
+            self._token_counts = dict(zip(self.metadata['text'], self.metadata['n_tokens'])) \
+                if 'n_tokens' in self.metadata.columns else {}
+        counts = []
+        for text in texts:
+            if text not in self._token_counts:
+                # Stores written before token counts were saved get counted once, on first use
+                self._token_counts[text] = num_tokens(text)
+            counts.append(int(self._token_counts[text]))
+        return counts
+
+    def scores(self, query_embedding) -> np.ndarray:
+        # Cosine similarity of the query against every row
+        return self.matrix @ normalize_embeddings(query_embedding)[0]
+
+    @property
+    def lexical(self) -> BM25Index:
+        """BM25 inverted index over the same texts, built on first use."""
+        if self._lexical is None:
+            self._lexical = BM25Index(self.texts)
+        return self._lexical
+
+    def search_rows(self, query_embedding, top_n: int = 100, n_probe: int = None,
+                    rerank: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rows and relatednesses of the top_n matches for one query embedding, most related first
+        With n_probe set and an approximate index loaded, only the rows in the n_probe closest IVF lists are scored.
+        Otherwise, with rerank set and a quantized index loaded, the quantized vectors pick rerank candidates.
+        Candidates are always scored with the float32 matrix.
+        """
+        if n_probe is not None and self.ann is not None:
+            candidates = self.ann.candidates(normalize_embeddings(query_embedding)[0], n_probe)
+        elif rerank is not None and self.quantized is not None:
+            candidates = self.quantized.candidates(normalize_embeddings(query_embedding)[0], max(rerank, top_n))
+        else:
+            scores = self.scores(query_embedding)
+            indices = top_k_indices(scores, top_n)
+            return indices, scores[indices]
+        scores = self.matrix[candidates] @ normalize_embeddings(query_embedding)[0]
+        best = top_k_indices(scores, top_n)
+        return candidates[best], scores[best]
+
+    def search(self, query_embedding, top_n: int = 100, n_probe: int = None,
+               rerank: int = None) -> tuple[tuple[str], tuple[float]]:
+        """Returns the top_n strings and relatednesses for one query embedding, most related first (see search_rows)."""
+        indices, scores = self.search_rows(query_embedding, top_n=top_n, n_probe=n_probe, rerank=rerank)
+        return tuple(self.texts[indices]), tuple(scores.tolist())
+
+    def search_batch(self, query_embeddings, top_n: int = 100, n_probe: int = None,
+                     rerank: int = None) -> list[tuple[tuple[str], tuple[float]]]:
+        """Scores many query embeddings in one matrix product and returns a (strings, relatednesses) pair for each."""
+        if (n_probe is not None and self.ann is not None) or (rerank is not None and self.quantized is not None):
+            return [self.search(query_embedding, top_n=top_n, n_probe=n_probe, rerank=rerank)
+                    for query_embedding in query_embeddings]
+        scores = normalize_embeddings(query_embeddings) @ self.matrix.T
+        results = []
+        for row in scores:
+            indices = top_k_indices(row, top_n)
+            results.append((tuple(self.texts[indices]), tuple(row[indices].tolist())))
+        return results
+
+
+# Indexes built from dataframes, kept so the matrix is only normalized once per dataframe. DataFrames can't be
+# weak dictionary keys (they are unhashable), so entries hold a weak reference and are dropped with their dataframe
+_index_cache = {}
+
+
+def index_for(df) -> EmbeddingIndex:
+    """Return the EmbeddingIndex for a dataframe of texts and embeddings, building it on first use."""
+    if isinstance(df, EmbeddingIndex):
+        return df
+    key = id(df)
+    cached = _index_cache.get(key)
+    # A dead reference means the id was reused by another dataframe
+    if cached is None or cached[0]() is not df:
+        cached = (weakref.ref(df, lambda _, key=key: _index_cache.pop(key, None)), EmbeddingIndex.from_df(df))
+        _index_cache[key] = cached
+    return cached[1]
+
+
+def _replace_file(path, write, mode='w'):
+    # Write to a temporary file first so readers never see a half written store
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, mode) as file:
+        write(file)
+    os.replace(tmp_path, path)
+
+
+def text_hash(text) -> str:
+    """Return the SHA-256 hex digest identifying a text's content."""
+    return hashlib.sha256(str(text).encode('utf-8')).hexdigest()
+
+
+def save_embedding_store(store_dir, texts, embeddings, metadata=None, model=embedding_model):
+    """
+    Save texts and embeddings as a float32 .npy matrix plus a texts.csv table
+    :param store_dir: directory to write embeddings.npy, texts.csv and info.json to
+    :param texts: one text per embedding
+    :param embeddings: list of embeddings or a 2D array
+    :param metadata: optional dataframe of extra columns stored with the texts
+    :param model: name of the embedding model, recorded in info.json
+    :return:
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    # Approximate and quantized indexes refer to rows by position, so they are stale once the rows change
+    for name, builder in (('ivf', 'build_ann_index'), ('quantized', 'build_quantized_index')):
+        if os.path.exists(os.path.join(store_dir, name)):
+            shutil.rmtree(os.path.join(store_dir, name))
+            print(f'removed {name} in {store_dir}, rebuild it with {builder}')
+    # Rows are stored normalized so searching can use the memory-mapped file as is
+    matrix = normalize_embeddings(embeddings)
+    table = metadata.reset_index(drop=True) if metadata is not None else pd.DataFrame()
+    if 'text' not in table.columns:
+        table.insert(0, 'text', list(texts))
+    if 'hash' not in table.columns:
+        # Content hashes let update_embedding_store tell which rows changed
+        table.insert(1, 'hash', [text_hash(text) for text in table['text']])
+    if 'n_tokens' not in table.columns:
+        # Token counts let query_message pack articles without re-tokenizing them
+        table['n_tokens'] = [num_tokens(str(text)) for text in table['text']]
+    if len(table) != matrix.shape[0]:
+        raise ValueError(f"{len(table)} texts but {matrix.shape[0]} embeddings")
+
+    _replace_file(os.path.join(store_dir, 'embeddings.npy'), lambda file: np.save(file, matrix), mode='wb')
+    _replace_file(os.path.join(store_dir, 'texts.csv'), lambda file: table.to_csv(file, index=False))
+    info = {'model': model, 'rows': int(matrix.shape[0]), 'dimensions': int(matrix.shape[1])}
+    _replace_file(os.path.join(store_dir, 'info.json'), lambda file: json.dump(info, file))
+
+
+def load_embedding_store(store_dir, mmap=True) -> EmbeddingIndex:
+    """
+    Load an embedding store written by save_embedding_store
+    :param store_dir: directory containing embeddings.npy and texts.csv
+    :param mmap: memory-map the matrix read-only instead of reading it into memory,
+                 so every process searching the store shares the same page-cached copy
+    :return: EmbeddingIndex over the stored texts
+    """
+    matrix = np.load(os.path.join(store_dir, 'embeddings.npy'), mmap_mode='r' if mmap else None)
+    table = pd.read_csv(os.path.join(store_dir, 'texts.csv'), keep_default_na=False)
+    if len(table) != matrix.shape[0]:
+        raise ValueError(f"{store_dir} is inconsistent: {len(table)} texts but {matrix.shape[0]} embeddings")
+    index = EmbeddingIndex(table['text'].to_numpy(), matrix, normalized=True, metadata=table)
+    if os.path.exists(os.path.join(store_dir, 'ivf', 'rows.npy')):
+        index.ann = IVFIndex.load(os.path.join(store_dir, 'ivf'), mmap=mmap)
+    if os.path.exists(os.path.join(store_dir, 'quantized', 'quantized.json')):
+        index.quantized = QuantizedIndex.load(os.path.join(store_dir, 'quantized'), mmap=mmap)
+    return index
+
+
+def build_ann_index(store_dir, n_lists=None, iterations=10) -> IVFIndex:
+    """
+    Build the approximate (IVF) index for an embedding store and save it in the store's ivf directory
+    :param store_dir: embedding store directory
+    :param n_lists: number of k-means lists, defaults to 4 * sqrt(rows)
+    :param iterations: k-means iterations
+    :return: the IVFIndex
+    """
+    index = load_embedding_store(store_dir)
+    ann = IVFIndex.build(index.matrix, n_lists=n_lists, iterations=iterations)
+    ann.save(os.path.join(store_dir, 'ivf'))
+    print(f'built an approximate index with {ann.n_lists} lists over {len(index)} embeddings')
+    return ann
+
+
+def build_quantized_index(store_dir, mode='int8', dimensions=1024) -> QuantizedIndex:
+    """
+    Build a truncated and/or quantized copy of an embedding store and save it in the store's quantized directory
+    Searches then pick candidates with the compressed vectors and re-rank them with the float32 matrix.
+    :param store_dir: embedding store directory
+    :param mode: 'float32' (truncation only), 'int8' or 'binary'
+    :param dimensions: number of leading dimensions kept, None keeps all of them
+    :return: the QuantizedIndex
+    """
+    index = load_embedding_store(store_dir)
+    quantized = QuantizedIndex.build(index.matrix, mode=mode, dimensions=dimensions)
+    quantized.save(os.path.join(store_dir, 'quantized'))
+    print(f'built a {mode} index with {quantized.dimensions} dimensions, '
+          f'{quantized.bytes_per_vector} bytes per vector instead of {index.matrix.shape[1] * 4}')
+    return quantized
+
+
+def convert_csv_to_store(csv_path, store_dir, chunksize=1000):
+    """
+    Convert a CSV of texts and stringified embeddings (the old cityembeddings.csv format) into an embedding store
+    :param csv_path: CSV with 'text' and 'embedding' columns
+    :param store_dir: directory to write the store to
+    :param chunksize: number of rows parsed at a time
+    :return:
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    # Texts such as 'NA' or 'null' are kept as text, like load_embedding_store reads them
+    rows = sum(len(chunk) for chunk in pd.read_csv(csv_path, usecols=['text'], chunksize=chunksize,
+                                                   keep_default_na=False))
+    matrix_path = os.path.join(store_dir, 'embeddings.npy')
+    texts = []
+    matrix = None
+    start = 0
+    # Parse the CSV a chunk at a time, straight into the memory-mapped output
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, keep_default_na=False):
+        # The embeddings are stored as JSON-compatible lists, which json parses far faster than literal_eval
+        vectors = normalize_embeddings([json.loads(value) for value in chunk['embedding']])
+        if matrix is None:
+            matrix = open_memmap(f'{matrix_path}.tmp', mode='w+', dtype=np.float32, shape=(rows, vectors.shape[1]))
+        matrix[start:start + len(chunk)] = vectors
+        start += len(chunk)
+        texts.extend(chunk['text'].tolist())
+    if matrix is None:
+        raise ValueError(f"{csv_path} has no embeddings to convert")
+    matrix.flush()
+    dimensions = matrix.shape[1]
+    del matrix
+    os.replace(f'{matrix_path}.tmp', matrix_path)
+
+    _replace_file(os.path.join(store_dir, 'texts.csv'),
+                  lambda file: pd.DataFrame({'text': texts,
+                                             'hash': [text_hash(text) for text in texts],
+                                             'n_tokens': [num_tokens(str(text)) for text in texts]})
+                  .to_csv(file, index=False))
+    info = {'model': embedding_model, 'rows': rows, 'dimensions': dimensions}
+    _replace_file(os.path.join(store_dir, 'info.json'), lambda file: json.dump(info, file))
+    print(f'converted {rows} embeddings from {csv_path} to {store_dir}')
+
+
+def get_corpus() -> EmbeddingIndex:
+    """Return the ordinance embedding store, loading it on first use."""
+    global _corpus
+    with _corpus_lock:
+        if _corpus is None:
+            print('loading embeddings...')
+            if not os.path.exists(os.path.join(store_path, 'embeddings.npy')) and os.path.exists(embedding_path):
+                # One-time conversion from the old CSV format
+                convert_csv_to_store(embedding_path, store_path)
+            _corpus = load_embedding_store(store_path)
+            print(f'{len(_corpus)} embeddings loaded')
+        return _corpus
+
+
+def corpus_available() -> bool:
+    """Return True if the ordinance store, or the CSV it is converted from, exists."""
+    return os.path.exists(os.path.join(store_path, 'embeddings.npy')) or os.path.exists(embedding_path)
+
+
+def warm_up():
+    """Create the client, query cache and corpus (when there is one) ahead of the first search."""
+    try:
+        get_client()
+        get_query_cache()
+        if corpus_available():
+            get_corpus()
+    except Exception as e:
+        print(f"Error: warming up the embeddings failed... {e}")
+
+
+def warm_up_in_background() -> threading.Thread:
+    """Run warm_up in a daemon thread, so a caller (like the bot) isn't held up by it."""
+    thread = threading.Thread(target=warm_up, name='embeddings-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def normalize_query(query: str) -> str:
+    """Return the cache key for a query: remove_stuff, lowercased, with whitespace collapsed."""
+    return ' '.join(remove_stuff(query).lower().split())
+
+
+def embed_query(query: str) -> np.ndarray:
+    """Return the embedding of a search query, from query_cache when it has been asked before."""
+    key = normalize_query(query)
+    query_embedding = get_query_cache().get(embedding_model, key)
+    if query_embedding is None:
+        # The normalized query is embedded, so every query sharing the key gets the same vector
+        query_embedding_response = get_client().embeddings.create(
+            model=embedding_model,
+            input=key,
+        )
+        query_embedding = get_query_cache().put(embedding_model, key, query_embedding_response.data[0].embedding)
+    return query_embedding
 
 
 # search function
 def strings_ranked_by_relatedness(
     query: str,
     df: pd.DataFrame,
-    relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y),
-    top_n: int = 100
+    relatedness_fn=None,
+    top_n: int = 100,
+    n_probe: int = default_n_probe,
+    exact: bool = False,
+    rerank: int = default_rerank_candidates
 ) -> tuple[list[str], list[float]]:
-    """Returns a list of strings and relatednesses, sorted from most related to least."""
-    query_embedding_response = client.embeddings.create(
-        model=embedding_model,
-        input=query,
-    )
-    query_embedding = query_embedding_response.data[0].embedding
+    """
+    Returns a list of strings and relatednesses, sorted from most related to least.
+    Uses the approximate index when the store has one, scanning n_probe lists, or else the quantized index,
+    re-ranking its top rerank candidates; exact=True always scans every row.
+    """
+    query_embedding = embed_query(query)
+    if relatedness_fn is None:
+        # Cosine similarity over the whole corpus (or the probed lists) in one matrix-vector product
+        return index_for(df).search(query_embedding, top_n=top_n, n_probe=None if exact else n_probe,
+                                    rerank=None if exact else rerank)
+    # A custom relatedness function has to be applied row by row
+    index = index_for(df)
     strings_and_relatednesses = [
-        (row["text"], relatedness_fn(query_embedding, row["embedding"]))
-        for i, row in df.iterrows()
+        (text, relatedness_fn(query_embedding, embedding))
+        for text, embedding in zip(index.texts, index.matrix)
     ]
     strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
     strings, relatednesses = zip(*strings_and_relatednesses)
     return strings[:top_n], relatednesses[:top_n]
 
 
+def strings_ranked_by_relatedness_batch(
+    queries: list[str],
+    df: pd.DataFrame,
+    top_n: int = 100,
+    n_probe: int = default_n_probe,
+    exact: bool = False,
+    rerank: int = default_rerank_candidates
+) -> list[tuple[tuple[str], tuple[float]]]:
+    """Ranks the corpus against several queries at once, embedding the uncached ones in a single request."""
+    keys = [normalize_query(query) for query in queries]
+    query_embeddings = [get_query_cache().get(embedding_model, key) for key in keys]
+    missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+    if missing:
+        response = get_client().embeddings.create(
+            model=embedding_model,
+            input=[keys[i] for i in missing],
+        )
+        for i, item in zip(missing, sorted(response.data, key=lambda item: item.index)):
+            query_embeddings[i] = get_query_cache().put(embedding_model, keys[i], item.embedding)
+    return index_for(df).search_batch(query_embeddings, top_n=top_n, n_probe=None if exact else n_probe,
+                                      rerank=None if exact else rerank)
+
+
+def lookup_code_reference(
+    query: str,
+    df: pd.DataFrame,
+    top_n: int = 100
+) -> tuple[tuple[str], tuple[float]] | None:
+    """
+    Answers queries that cite code sections (e.g. "154:383") from the inverted index alone, with no API call
+    Returns the texts containing every cited reference, ranked by BM25, or None if the query cites none or nothing matches.
+    """
+    references = code_references(query)
+    if not references:
+        return None
+    index = index_for(df)
+    rows = index.lexical.rows_with_references(references)
+    if not len(rows):
+        return None
+    scores = index.lexical.scores(query)[rows]
+    order = np.lexsort((rows, -scores))[:top_n]
+    return tuple(index.texts[rows[order]]), tuple(scores[order].tolist())
+
+
+def strings_ranked_by_bm25(
+    query: str,
+    df: pd.DataFrame,
+    top_n: int = 100
+) -> tuple[tuple[str], tuple[float]]:
+    """Returns strings and BM25 scores for a query, ranked by the inverted index only."""
+    index = index_for(df)
+    rows, scores = index.lexical.search(query, top_n=top_n)
+    return tuple(index.texts[rows]), tuple(scores.tolist())
+
+
+def hybrid_ranked_by_relatedness(
+    query: str,
+    df: pd.DataFrame,
+    top_n: int = 100,
+    candidates: int = hybrid_candidates,
+    k: int = rrf_k
+) -> tuple[tuple[str], tuple[float]]:
+    """
+    Returns strings and fused scores combining the vector and BM25 rankings with reciprocal rank fusion.
+    Queries citing code sections that the index can match are answered by lookup_code_reference, skipping the embedding.
+    """
+    exact_matches = lookup_code_reference(query, df, top_n=top_n)
+    if exact_matches is not None:
+        return exact_matches
+    index = index_for(df)
+    vector_rows, _ = index.search_rows(embed_query(query), top_n=candidates, n_probe=default_n_probe,
+                                       rerank=default_rerank_candidates)
+    lexical_rows, _ = index.lexical.search(query, top_n=candidates)
+    rows, scores = reciprocal_rank_fusion([vector_rows, lexical_rows], k=k, top_n=top_n)
+    return tuple(index.texts[rows]), tuple(scores.tolist())
+
+
+# ranking functions query_message can retrieve articles with
+retrieval_modes = {
+    'vector': strings_ranked_by_relatedness,
+    'hybrid': hybrid_ranked_by_relatedness,
+    'lexical': strings_ranked_by_bm25,
+}
+
+
 def relatedness_score(text, _df):
     # examples
     strings, relatednesses = strings_ranked_by_relatedness(text, _df, top_n=3)
@@ -100,83 +576,271 @@ def remove_stuff(text: str) -> str:
 def get_embedding(text_to_embed):
     text_to_embed = remove_stuff(text_to_embed)
     # Embed a line of text
-    response = client.embeddings.create(
+    response = get_client().embeddings.create(
         model=embedding_model,
         input=[text_to_embed]
     )
     # Extract the AI output embedding as a list of floats
     embedding = response.data[0].embedding
-    print(f"---\nEmbedding: {embedding} \nText: {text_to_embed}")
+    print(f"---\nEmbedded {len(embedding)} dimensions \nText: {text_to_embed}")
 
     return embedding
 
 
-def create_embedding_df(excel_path, embedding_path):
-    # Create a new DataFrame to store the text and its embedding
-    _df = pd.DataFrame()
-
+def pack_batches(token_counts, max_tokens=embedding_request_token_limit,
+                 max_inputs=embedding_request_input_limit) -> list[tuple[int, int]]:
+    """
+    Group consecutive rows into (start, stop) batches that stay under the per-request limits
+    :param token_counts: number of tokens in each row
+    :param max_tokens: maximum total tokens in one request
+    :param max_inputs: maximum number of inputs in one request
+    :return: list of (start, stop) row ranges
+    """
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for i, count in enumerate(token_counts):
+        if i > start and (batch_tokens + count > max_tokens or i - start >= max_inputs):
+            batches.append((start, i))
+            start = i
+            batch_tokens = 0
+        batch_tokens += count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+def _prepare_inputs(texts, model):
+    # Clean the texts the same way get_embedding does, and truncate anything over the per-input limit
+    encoding = encoding_for(model)
+    inputs = []
+    token_counts = []
+    for text in texts:
+        text = remove_stuff(str(text)) or ' '  # the API rejects empty inputs
+        tokens = encoding.encode(text)
+        if len(tokens) > embedding_input_token_limit:
+            tokens = tokens[:embedding_input_token_limit]
+            text = encoding.decode(tokens)
+        inputs.append(text)
+        token_counts.append(len(tokens))
+    return inputs, token_counts
+
+
+def _embed_batch(client, model, inputs):
+    response = client.embeddings.create(model=model, input=inputs)
+    # The API may return the items out of order, so sort them by their index
+    data = sorted(response.data, key=lambda item: item.index)
+    return np.asarray([item.embedding for item in data], dtype=np.float32)
+
+
+def embed_texts(texts, work_dir, client=None, model=embedding_model, max_in_flight=4,
+                max_tokens=embedding_request_token_limit, max_inputs=embedding_request_input_limit) -> np.ndarray:
+    """
+    Embed many texts with multi-input requests, keeping a bounded number of requests in flight
+    Each finished batch is saved to work_dir straight away, so rerunning after a crash only embeds
+    the batches that are missing. Point the client at a local stub server (e.g. OpenAI(base_url=...))
+    to run the pipeline without the real API.
+    :param texts: texts to embed
+    :param work_dir: directory for the per-batch .npy files
+    :param client: OpenAI client used for the requests, defaults to get_client()
+    :param model: embedding model
+    :param max_in_flight: maximum number of concurrent requests
+    :param max_tokens: maximum tokens per request
+    :param max_inputs: maximum inputs per request
+    :return: float32 matrix with one row per text
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    client = client or get_client()
+    inputs, token_counts = _prepare_inputs(texts, model)
+    batches = pack_batches(token_counts, max_tokens=max_tokens, max_inputs=max_inputs)
+
+    def batch_path(start, stop):
+        # Name batches by their contents so a changed corpus never reuses a stale batch
+        digest = hashlib.sha256('\n'.join(inputs[start:stop]).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(work_dir, f'{start:09d}-{stop:09d}-{digest}.npy')
+
+    pending = [(start, stop) for start, stop in batches if not os.path.exists(batch_path(start, stop))]
+    print(f'embedding {len(inputs)} texts in {len(batches)} batches, {len(batches) - len(pending)} already done')
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {executor.submit(_embed_batch, client, model, inputs[start:stop]): (start, stop)
+                   for start, stop in pending}
+        for done, future in enumerate(as_completed(futures), start=1):
+            start, stop = futures[future]
+            path = batch_path(start, stop)
+            _replace_file(path, lambda file: np.save(file, future.result()), mode='wb')
+            print(f'batch {done}/{len(pending)} embedded (rows {start}-{stop - 1})')
+
+    return np.concatenate([np.load(batch_path(start, stop)) for start, stop in batches])
+
+
+def read_ordinance_texts(excel_path) -> pd.Series:
+    """Read the ordinance workbook and concatenate each row into a single text."""
     # Read the Excel file and set row 0 as the header
     review_df = pd.read_excel(excel_path, header=None)
     # First, let's set the correct headers if they are present in the second row (row index 1)
     review_df.columns = review_df.iloc[1]  # This sets the second row as the header
     review_df = review_df.drop([0, 1])  # This drops the first two rows which are now redundant
 
-    # Now concatenate all the text in each row into a single cell in a new column called 'text'
-    _df['text'] = review_df.apply(lambda x: ' '.join(x.dropna().astype(str)), axis=1)
-    _df.reset_index(drop=True, inplace=True)
-    # Display the DataFrame with the concatenated column
-    print(_df.head())
-    # _df = _df.sample(10)
-    _df["embedding"] = _df["text"].astype(str).apply(get_embedding)
-    print(_df.head())
-
-    _df.to_csv(embedding_path, index=False)
-
-
-
+    # Now concatenate all the text in each row into a single cell
+    texts = review_df.apply(lambda x: ' '.join(x.dropna().astype(str)), axis=1)
+    return texts.reset_index(drop=True)
 
 
+def create_embedding_df(excel_path, embedding_path, max_in_flight=4):
+    # Create a new DataFrame to store the text and its embedding
+    _df = pd.DataFrame()
+    _df['text'] = read_ordinance_texts(excel_path)
+    # Display the DataFrame with the concatenated column
+    print(_df.head())
 
-def num_tokens(text: str, model: str = GPT_MODEL) -> int:
-    """Return the number of tokens in a string."""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    # Embed in batches, keeping finished batches next to the store until it is written
+    work_dir = os.path.join(embedding_path, 'batches')
+    matrix = embed_texts(_df['text'].astype(str).tolist(), work_dir, max_in_flight=max_in_flight)
+
+    save_embedding_store(embedding_path, _df['text'], matrix)
+    shutil.rmtree(work_dir)
+
+
+def update_embedding_store(excel_path, embedding_path, max_in_flight=4) -> dict:
+    """
+    Bring an embedding store up to date with the ordinance workbook, only embedding rows whose text changed
+    See sync_embedding_store; the manifest is written to manifest.json in the store.
+    :param excel_path: ordinance workbook
+    :param embedding_path: store directory, created from scratch if it doesn't exist yet
+    :param max_in_flight: maximum number of concurrent embedding requests
+    :return: the manifest
+    """
+    texts = read_ordinance_texts(excel_path).astype(str).tolist()
+    return sync_embedding_store(texts, embedding_path, source=excel_path, max_in_flight=max_in_flight)
+
+
+def sync_embedding_store(texts, embedding_path, source='', max_in_flight=4) -> dict:
+    """
+    Make an embedding store hold exactly the given texts, only embedding texts it doesn't already have
+    Rows are matched by the SHA-256 of their text: new or edited rows are embedded, rows that are no longer
+    in texts are dropped, and everything else reuses its stored vector. A manifest of what changed is
+    written to manifest.json in the store.
+    :param texts: texts the store should contain, in order
+    :param embedding_path: store directory, created from scratch if it doesn't exist yet
+    :param source: where the texts came from, recorded in the manifest
+    :param max_in_flight: maximum number of concurrent embedding requests
+    :return: the manifest
+    """
+    texts = [str(text) for text in texts]
+    hashes = [text_hash(text) for text in texts]
+
+    if os.path.exists(os.path.join(embedding_path, 'embeddings.npy')):
+        existing = load_embedding_store(embedding_path)
+        existing_hashes = existing.metadata['hash'].tolist() if 'hash' in existing.metadata.columns \
+            else [text_hash(text) for text in existing.texts]
+        existing_matrix = existing.matrix
+    else:
+        existing_hashes = []
+        existing_matrix = None
+
+    # Map each stored hash to its row so unchanged texts keep their vector
+    stored_rows = {}
+    for row, digest in enumerate(existing_hashes):
+        stored_rows.setdefault(digest, row)
+    new_rows = [row for row, digest in enumerate(hashes) if digest not in stored_rows]
+    current = set(hashes)
+    removed = [row for row, digest in enumerate(existing_hashes) if digest not in current]
+
+    manifest = {
+        'source': source,
+        'updated': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'rows': len(texts),
+        'unchanged': len(texts) - len(new_rows),
+        'added': [{'row': row, 'hash': hashes[row], 'text': texts[row][:80]} for row in new_rows],
+        'removed': [{'hash': existing_hashes[row], 'text': str(existing.texts[row])[:80]} for row in removed],
+    }
+    print(f"{len(new_rows)} new or changed rows, {len(removed)} removed, {manifest['unchanged']} unchanged")
+
+    if hashes != existing_hashes:
+        work_dir = os.path.join(embedding_path, 'batches')
+        new_matrix = embed_texts([texts[row] for row in new_rows], work_dir, max_in_flight=max_in_flight) \
+            if new_rows else None
+
+        # Assemble the matrix in order from stored and freshly embedded rows
+        dimensions = new_matrix.shape[1] if new_matrix is not None else existing_matrix.shape[1]
+        matrix = np.empty((len(texts), dimensions), dtype=np.float32)
+        fresh = {row: i for i, row in enumerate(new_rows)}
+        for row, digest in enumerate(hashes):
+            matrix[row] = new_matrix[fresh[row]] if row in fresh else existing_matrix[stored_rows[digest]]
+
+        save_embedding_store(embedding_path, texts, matrix, metadata=pd.DataFrame({'text': texts, 'hash': hashes}))
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(embedding_path, exist_ok=True)
+    _replace_file(os.path.join(embedding_path, 'manifest.json'), lambda file: json.dump(manifest, file, indent=2))
+    return manifest
+
+
+def pack_articles(token_counts, token_budget: int, fill_budget: bool = False) -> list[int]:
+    """
+    Choose which ranked articles fit in a token budget, keeping a running total instead of re-tokenizing
+    :param token_counts: token count of each article, in ranked order
+    :param token_budget: tokens available for the articles
+    :param fill_budget: keep adding shorter lower ranked articles after the first one that doesn't fit,
+                        instead of stopping there
+    :return: indices of the chosen articles, in ranked order
+    """
+    chosen = []
+    total = 0
+    for i, count in enumerate(token_counts):
+        if total + count > token_budget:
+            if fill_budget:
+                continue
+            break
+        chosen.append(i)
+        total += count
+    return chosen
 
 
 def query_message(
     query: str,
     df: pd.DataFrame,
     model: str,
-    token_budget: int
+    token_budget: int,
+    fill_budget: bool = False,
+    retrieval: str = 'vector'
 ) -> str:
     """Return a message for GPT, with relevant source texts pulled from a dataframe."""
-    strings, relatednesses = strings_ranked_by_relatedness(query, df)
+    # 'vector' ranks by embedding only (the default), 'lexical' by BM25 only, 'hybrid' fuses both
+    strings, relatednesses = retrieval_modes[retrieval](query, df)
     introduction = 'Use the New Orleans Code of Ordinaces provided below to answer the subsequent question. ' \
                    'If the answer cannot be found in the articles, say so, ' \
                    'then try to answer the question as best you can anyways'
     question = f"\n\nQuestion: {query}"
+    article_header = '\n\nNew Orleans Ordinance Codes:\n"""\n'
+    article_footer = '\n"""'
+    # Each article is tokenized once (or read from the store), the wrapper and question only once per message
+    wrapper_tokens = num_tokens(article_header + article_footer, model=model)
+    article_tokens = [count + wrapper_tokens for count in index_for(df).token_counts(strings)]
+    available = token_budget - num_tokens(introduction + question, model=model)
+    chosen = pack_articles(article_tokens, available, fill_budget=fill_budget)
+
     message = introduction
-    for string in strings:
-        next_article = f'\n\nNew Orleans Ordinance Codes:\n"""\n{string}\n"""'
-        if (
-            num_tokens(message + next_article + question, model=model)
-            > token_budget
-        ):
-            break
-        else:
-            message += next_article
+    for i in chosen:
+        message += f'{article_header}{strings[i]}{article_footer}'
     return message + question
 
 
 def ask(
     query: str,
-    df: pd.DataFrame = df,
+    df: pd.DataFrame = None,
     model: str = GPT_MODEL,
     token_budget: int = token_budget,
     print_message: bool = False,
+    fill_budget: bool = False,
+    retrieval: str = 'vector',
 ) -> str:
-    """Answers a query using GPT and a dataframe of relevant texts and embeddings."""
-    message = query_message(query, df, model=model, token_budget=token_budget)
+    """Answers a query using GPT and a dataframe of relevant texts and embeddings (the ordinance store by default)."""
+    if df is None:
+        df = get_corpus()
+    message = query_message(query, df, model=model, token_budget=token_budget, fill_budget=fill_budget,
+                            retrieval=retrieval)
     if print_message:
         print(message)
     messages = [
@@ -185,7 +849,7 @@ def ask(
                                       "If applicable reference specific articles, and provide the links. ."},
         {"role": "user", "content": message},
     ]
-    response = client.chat.completions.create(
+    response = get_client().chat.completions.create(
         model=model,
         messages=messages,
         temperature=0
@@ -207,7 +871,7 @@ def ask(
     return response_message
 
 
-#relatedness_score("what happens if my license is invalid", df)
+#relatedness_score("what happens if my license is invalid", get_corpus())
 
 #answer = ask("What ordinances reference religion", print_message=True)
 #print(answer)
@@ -0,0 +1,90 @@
+"""
+Compare truncated/quantized embedding modes against the full float32 search
+Reports memory per vector, query latency and recall@k, with and without the float32 re-rank.
+Queries are stored embeddings with a little noise added, so no API calls are made.
+
+usage: python evaluate_quantization.py [store_dir] [--queries 200] [--k 10] [--rerank 400]
+"""
+import time
+import argparse
+
+import numpy as np
+
+import embeddings
+from quantize import QuantizedIndex
+
+# (mode, dimensions) pairs evaluated, None keeps all dimensions
+configurations = [
+    ('float32', None),
+    ('float32', 1024),
+    ('float32', 256),
+    ('int8', None),
+    ('int8', 1024),
+    ('int8', 256),
+    ('binary', None),
+    ('binary', 1024),
+]
+
+
+def exact_top_k(index, queries, k):
+    return [set(embeddings.top_k_indices(index.matrix @ query, k).tolist()) for query in queries]
+
+
+def evaluate(index, quantized, queries, baseline, k, rerank):
+    """Return (ms per query, recall@k) for candidate selection alone and with the float32 re-rank."""
+    results = {}
+    for label, n_candidates in (('quantized only', k), ('with re-rank', rerank)):
+        recall = 0
+        start = time.perf_counter()
+        for query, expected in zip(queries, baseline):
+            if n_candidates > k:
+                candidates = quantized.candidates(query, n_candidates)
+                scores = index.matrix[candidates] @ query
+                candidates = candidates[embeddings.top_k_indices(scores, k)]
+            else:
+                candidates = embeddings.top_k_indices(quantized.scores(query), k)
+            recall += len(expected & set(candidates.tolist())) / k
+        elapsed = (time.perf_counter() - start) / len(queries) * 1000
+        results[label] = (elapsed, recall / len(queries))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('store_dir', nargs='?', default=embeddings.store_path)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rerank', type=int, default=embeddings.default_rerank_candidates)
+    parser.add_argument('--noise', type=float, default=0.3)
+    args = parser.parse_args()
+
+    index = embeddings.load_embedding_store(args.store_dir, mmap=False)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(index), size=min(args.queries, len(index)), replace=False)
+    noise = rng.normal(scale=args.noise / np.sqrt(index.matrix.shape[1]), size=(len(rows), index.matrix.shape[1]))
+    queries = embeddings.normalize_embeddings(index.matrix[rows] + noise)
+
+    start = time.perf_counter()
+    baseline = exact_top_k(index, queries, args.k)
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+    full_bytes = index.matrix.shape[1] * 4
+    print(f'{len(index)} vectors, {len(queries)} queries, recall@{args.k}, re-rank over {args.rerank} candidates\n')
+    print(f"{'mode':<8} {'dims':>5} {'bytes/vec':>10} {'MB':>8} {'ms/q':>7} {'recall':>7} "
+          f"{'ms/q rerank':>12} {'recall rerank':>14}")
+    print(f"{'exact':<8} {index.matrix.shape[1]:>5} {full_bytes:>10} {full_bytes * len(index) / 1e6:>8.1f} "
+          f"{exact_ms:>7.2f} {1.0:>7.3f}")
+
+    for mode, dimensions in configurations:
+        if dimensions is not None and dimensions > index.matrix.shape[1]:
+            continue
+        quantized = QuantizedIndex.build(index.matrix, mode=mode, dimensions=dimensions)
+        results = evaluate(index, quantized, queries, baseline, args.k, args.rerank)
+        alone_ms, alone_recall = results['quantized only']
+        rerank_ms, rerank_recall = results['with re-rank']
+        print(f'{mode:<8} {quantized.dimensions:>5} {quantized.bytes_per_vector:>10} '
+              f'{quantized.bytes_per_vector * len(index) / 1e6:>8.1f} {alone_ms:>7.2f} {alone_recall:>7.3f} '
+              f'{rerank_ms:>12.2f} {rerank_recall:>14.3f}')
+
+
+if __name__ == "__main__":
+    main()
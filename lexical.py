@@ -0,0 +1,95 @@
+import re
+from collections import Counter
+
+import numpy as np
+
+# Ordinance and statute references such as 154:383, 32:414.1 or 32:53A (the code itself writes Sec. 154-383). A
+# reference has a single separator, so dates (2017-08-01) and longer chains are not references
+code_reference_pattern = re.compile(r'(?<![\d:-])(?<!\d\.)\d+[:-]\d+(?:\.\d+)*[a-z]?(?![a-z\d:-]|\.\d)', re.IGNORECASE)
+# Clock times (10:30, 9:05) have the same shape as a reference, and are left out
+time_pattern = re.compile(r'(?:[01]?\d|2[0-3]):[0-5]\d')
+word_pattern = re.compile(r'[a-z0-9]+')
+
+
+def code_references(text: str) -> list[str]:
+    """Return the code references in a text, lowercased and written with colons."""
+    return [reference.lower().replace('-', ':') for reference in code_reference_pattern.findall(text)
+            if not time_pattern.fullmatch(reference)]
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase words, keeping each code reference as a single token as well."""
+    text = str(text).lower()
+    return code_references(text) + word_pattern.findall(text)
+
+
+def reciprocal_rank_fusion(rankings, k: int = 60, top_n: int = 100) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Combine several rankings with reciprocal rank fusion, each row scores sum(1 / (k + rank))
+    :param rankings: lists of row indices, best first
+    :param k: damping constant, larger values flatten the difference between top and lower ranks
+    :param top_n: number of rows returned
+    :return: (rows, fused scores), best first
+    """
+    fused = Counter()
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            fused[int(row)] += 1 / (k + rank)
+    # Ties are broken by row so the result is deterministic
+    best = sorted(fused.items(), key=lambda item: (-item[1], item[0]))[:top_n]
+    return np.array([row for row, _ in best], dtype=np.intp), np.array([score for _, score in best])
+
+
+class BM25Index:
+    """
+    An inverted index over a list of texts, scored with Okapi BM25
+    """
+    def __init__(self, texts, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        postings = {}
+        lengths = np.empty(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append((row, frequency))
+
+        # Store each term's postings as arrays of rows and term frequencies
+        self.postings = {term: (np.array([row for row, _ in entries], dtype=np.intp),
+                                np.array([frequency for _, frequency in entries], dtype=np.float32))
+                         for term, entries in postings.items()}
+        self.n_docs = len(texts)
+        self.lengths = lengths
+        self.average_length = float(lengths.mean()) if len(texts) else 0.0
+        self.idf = {term: float(np.log(1 + (self.n_docs - len(rows) + 0.5) / (len(rows) + 0.5)))
+                    for term, (rows, _) in self.postings.items()}
+
+    def scores(self, query: str) -> np.ndarray:
+        """Return the BM25 score of every text for a query."""
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        length_norm = self.k1 * (1 - self.b + self.b * self.lengths / (self.average_length or 1))
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            rows, frequencies = self.postings[term]
+            # Each row appears once per term, so plain fancy-index addition is safe
+            scores[rows] += self.idf[term] * frequencies * (self.k1 + 1) / (frequencies + length_norm[rows])
+        return scores
+
+    def search(self, query: str, top_n: int = 100) -> tuple[np.ndarray, np.ndarray]:
+        """Return (rows, scores) of the top_n texts matching the query, best first. Rows scoring 0 are left out."""
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_n:
+            matched = matched[np.argpartition(-scores[matched], top_n - 1)[:top_n]]
+        order = np.lexsort((matched, -scores[matched]))
+        return matched[order], scores[matched[order]]
+
+    def rows_with_references(self, references) -> np.ndarray:
+        """Return the rows containing every one of the given code references, in corpus order."""
+        rows = None
+        for reference in references:
+            matches = self.postings.get(reference.lower().replace('-', ':'), (np.empty(0, dtype=np.intp), None))[0]
+            rows = matches if rows is None else np.intersect1d(rows, matches)
+        return rows if rows is not None else np.empty(0, dtype=np.intp)
@@ -1,13 +1,14 @@
 import os
+import asyncio
 import logging
+from io import BytesIO
 from dotenv import load_dotenv
 
 # Import the pandas library
 import pandas as pd
 
-# Import openpyxl and the column_index_from_string function
+# Import openpyxl
 from openpyxl import load_workbook
-from openpyxl.utils import column_index_from_string
 from openpyxl.utils.dataframe import dataframe_to_rows
 
 # Import python-docx
@@ -18,50 +19,70 @@ from docx.shared import Pt, Inches
 import methods
 import analysis
 import embeddings
+import artifacts
+import workbooks
+
+from openai.types.chat import ChatCompletionMessage
 
 import telegram
-from telegram import Update, Bot
+from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
-# Create a logger
+# Create a logger, its file handler is added by configure_logging when the bot starts
 logger = logging.getLogger(__name__)
 
-# Set the level for the logger
-logger.setLevel(logging.INFO)
+load_dotenv()  # This method will load the .env file
+
+telegram_api_key = os.getenv('TELEGRAM_API_KEY')
+chat_id = '6310217725'
+# seconds between edits of a streamed reply, and the longest message Telegram accepts
+stream_edit_interval = 1.5
+telegram_message_limit = 4096
+# shown in place of the placeholder when a completion streams no text
+empty_reply_text = "Sorry, I couldn't come up with an answer to that. Could you try asking it another way?"
 
-# Create a file handler
-handler = logging.FileHandler('logfile.log')
+# text of the memo, math sheet, Summary and source files, read when a question first needs them
+_project_files = None
 
-# Set the formatter for the handler
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
 
-# Add the handler to the logger
-logger.addHandler(handler)
+def configure_logging():
+    # Set the level for the logger
+    logger.setLevel(logging.INFO)
 
-load_dotenv()  # This method will load the .env file
+    # Create a file handler
+    handler = logging.FileHandler('logfile.log')
 
-telegram_api_key = os.getenv('TELEGRAM_API_KEY')
-bot = Bot(token=telegram_api_key)
-chat_id = '6310217725'
+    # Set the formatter for the handler
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
 
+    # Add the handler to the logger
+    logger.addHandler(handler)
 
-print('Messaging Filters Configured')
-print('------\nListening For Messages...\n------\n')
-memo_text = analysis.get_text_from_word('files/memo.docx')
-math_sheet = analysis.get_text_from_word('files/Math_Calculations_Work.docx')
 
-# Load the Excel file
-wb = load_workbook('files/excel.xlsx')
-summary = wb['Summary']
-table = analysis.get_text_from_ws(summary)
+def get_project_files():
+    """
+    Return the text of the memo, math sheet, Summary sheet, messager.py, methods.py and analysis.py, read on first use
+    Only the summary fallback of answer_question needs them, so a process that never answers from them (such as the
+    chart worker, which imports this module as its __main__) doesn't read them.
+    """
+    global _project_files
+    if _project_files is None:
+        memo_text = analysis.get_text_from_word('files/memo.docx')
+        math_sheet = analysis.get_text_from_word('files/Math_Calculations_Work.docx')
 
-mes_text = analysis.get_text_from_python('messager.py')
-methods_text = analysis.get_text_from_python('methods.py')
-analysis_text = analysis.get_text_from_python('analysis.py')
+        # Load the Excel file
+        wb = load_workbook('files/excel.xlsx', read_only=True)
+        table = analysis.get_text_from_ws(wb['Summary'])
+        wb.close()
+
+        mes_text = analysis.get_text_from_python('messager.py')
+        methods_text = analysis.get_text_from_python('methods.py')
+        analysis_text = analysis.get_text_from_python('analysis.py')
+        _project_files = (memo_text, math_sheet, table, mes_text, methods_text, analysis_text)
+        logger.info('Files Loaded')
+    return _project_files
 
-logger.info('Files Loaded')
-logger.info('\n------\nListening For Messages...\n------\n')
 
 # Define a `/start` command handler.
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -69,7 +90,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     print(launch_user)
     message_text = f'{launch_user.first_name} {launch_user.last_name} has launched the bot. (@{launch_user.username})'
 
-    await bot.send_message(chat_id=chat_id, text=message_text)
+    await context.bot.send_message(chat_id=chat_id, text=message_text)
     text = (
         f"Hello, I am a bot that generates memos for the City of New Orleans Office of Performance and Accountability. "
         f"Right now I am configured to produce Traffic Citation Revenue Analysis Memos detailed in the document below. "
@@ -121,6 +142,86 @@ async def get_memo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.info(f'Memo Generated by {launch_user.first_name} {launch_user.last_name}')
 
 
+def answer_question(question, model, on_text=None):
+    """
+    Answer a question from the embedded project artifacts, one embedding lookup and one completion.
+    Falls back to summarizing every project file while the artifacts haven't been embedded yet.
+    on_text streams the answer, it is called with the text received so far.
+    Questions close to one already answered from the same memo and workbook get the earlier answer.
+    """
+    answer = artifacts.cached_answer(question)
+    if answer is not None:
+        return ChatCompletionMessage(role='assistant', content=answer)
+
+    context = artifacts.retrieve_context(question)
+    if context is not None:
+        # Questions that aren't about the project are answered without project details
+        if not artifacts.is_question_relevant(question, context):
+            context = ''
+        results = analysis.get_context_completion(question, model, context, on_text)
+    else:
+        results = analysis.get_completion(question, model, *get_project_files(), on_text)
+    # Only answers drawn from the retrieved artifacts are reused, not off-topic replies or the summary fallback
+    if context and results.content and results.content.strip():
+        artifacts.remember_answer(question, results.content)
+    return results
+
+
+class StreamedReply:
+    """
+    A Telegram message edited in place while an answer streams in
+    update() can be called from any thread. Edits are spaced at least stream_edit_interval seconds apart to stay under
+    Telegram's rate limits, and only the latest text is sent.
+    """
+    def __init__(self, message, loop):
+        self.message = message
+        self.loop = loop
+        self.text = ''
+        self.shown = message.text
+        self.last_edit = 0.0
+        self.pending = None
+
+    def update(self, text):
+        self.text = text
+        self.loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        if self.pending is None or self.pending.done():
+            self.pending = self.loop.create_task(self._edit_later())
+
+    async def _edit_later(self):
+        await asyncio.sleep(max(0.0, self.last_edit + stream_edit_interval - self.loop.time()))
+        await self._edit(self.text[:telegram_message_limit])
+
+    async def _edit(self, text):
+        if not text.strip() or text == self.shown:
+            return True
+        try:
+            await self.message.edit_text(text)
+            self.shown = text
+        except telegram.error.RetryAfter as e:
+            # Wait as long as Telegram asks, the next update (or finish) sends the latest text
+            retry_after = e.retry_after
+            await asyncio.sleep(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+        except telegram.error.BadRequest as e:
+            logger.error(f"Error: editing the streamed reply failed... {e}")
+        self.last_edit = self.loop.time()
+        return text == self.shown
+
+    async def finish(self, text):
+        """Show the complete answer, sending whatever doesn't fit in one message as follow-up messages."""
+        if self.pending is not None:
+            self.pending.cancel()
+        # Never leave the placeholder up, even if nothing was streamed
+        if not text or not text.strip():
+            text = empty_reply_text
+        # Retry once if Telegram asked us to slow down, the final text must get through
+        if not await self._edit(text[:telegram_message_limit]):
+            await self._edit(text[:telegram_message_limit])
+        for start in range(telegram_message_limit, len(text), telegram_message_limit):
+            await self.message.reply_text(text[start:start + telegram_message_limit])
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     from_user = update.message.from_user
     print(f"From: {from_user}")
@@ -133,20 +234,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if received_text.startswith("/"):
             return
         else:
+            # Reply straight away and fill the message in as the answer streams
+            placeholder = await update.message.reply_text('Thinking...')
+            reply = StreamedReply(placeholder, asyncio.get_running_loop())
             try:
                 #results = embeddings.ask(received_text, print_message=True)
-                results = analysis.get_completion(received_text, analysis.gpt4, memo_text, math_sheet,
-                                                  table, mes_text, methods_text, analysis_text)
+                results = await asyncio.to_thread(answer_question, received_text, analysis.gpt4, reply.update)
                 logger.info(f"GPT4 Message: {results}")
             except Exception as e:
                 print(f"Error: GPT4 Failed... {e}")
                 logger.error(f"Error: GPT4 Failed... {e}")
-                results = analysis.get_completion(received_text, analysis.gpt3, memo_text, math_sheet,
-                                                  table, mes_text, methods_text, analysis_text)
+                results = await asyncio.to_thread(answer_question, received_text, analysis.gpt3, reply.update)
                 logger.info(f"GPT3 Message: {results}")
 
             print(f"Results: {results}")
-            await update.message.reply_text(results.content)
+            await reply.finish(results.content)
     else:
         # Handle non-text messages or notify the user accordingly
         print("Received a non-text message.")
@@ -187,74 +289,32 @@ def generate_memo(excel_path, memo_file, workbook_file):
     """
     Modification of the original run.py file to generate a memo. Designed to be used by a telegram bot.
     """
-    # Load the Excel file
+    # Parse the Excel file, or load it from the sheet cache when the same file was parsed before. The Data sheet is
+    # streamed, keeping the citations issued by the City Police and counting the codes of every agency on the way
     filepath = excel_path
-    wb = load_workbook(filepath)
+    search_text = workbooks.nopd_agency
+    upload = workbooks.load_upload(filepath, agency=search_text)
 
-    # Load the sheets
-    data = wb['Data']
-    summary = wb['Summary']
-    violation_types = wb['Violation Types']
+    # Load the sheets. The Summary is a copy so the results can be written to it
+    data = upload.data
+    summary = upload.summary
+    violation_types = upload.violation_types
     print('Sheets Loaded')
     print(violation_types)
 
-    # Search for citations issued by the City Police
-    search_text = '01 - CITY POLICE'
-    column_to_search = 'B'
-    # Convert the column letter to an index (e.g., 'A' -> 1)
-    column_index = column_index_from_string(column_to_search)
-    index = 0
     # A list to hold your calculations
     math_doc = methods.MathDoc('Math Calculations Work')
 
-    number_of_months = analysis.get_months(summary['A1'].value)
-    number_of_months = int(number_of_months.content)
-
-    # Check if 'NOPD Citations' sheet exists, if not create it
-    if "NOPD Citations" not in wb.sheetnames:
-        nopd_citations = wb.create_sheet("NOPD Citations")
-        # Assuming the first row contains headers, copy them first
-        headers = [cell.value for cell in data[1]]
-        nopd_citations.append(headers)
-
-        # Iterate through all rows in the data sheet
-        for row in data.iter_rows(min_row=2):  # Start from row 2 to skip headers
-            if row[column_index - 1].value == search_text:  #
-                # Check if the cell in your target column matches search_text
-                nopd_citations.append([cell.value for cell in row])  # Append the entire row to NOPD Citations sheet
-    else:
-        nopd_citations = wb["NOPD Citations"]  # Get the existing 'NOPD Citations' sheet
-
-    nopd_data_df = analysis.chart_citations(nopd_citations, 'NOPD')
-
-    # Use ExcelWriter to write to a specific sheet without overwriting other sheets
-    with pd.ExcelWriter('files/excel.xlsx', engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-        nopd_data_df.to_excel(writer, sheet_name='NOPD Citations', index=False)
-
-        # Create a dataframe that contains the violation types and their reference codes
-        # Set display options to show all columns and rows
-        pd.set_option('display.max_columns', None)
-        pd.set_option('display.max_rows', None)
-        violation_types_df = pd.DataFrame(columns=['violation',
-                                                   'local_ref',
-                                                   'state_ref',
-                                                   'local_fine',
-                                                   'state_fine',
-                                                   'local_citations',
-                                                   'local_citation_revenue',
-                                                   'state_citations',
-                                                   'state_citation_revenue',
-                                                   'nopd_local_citations',
-                                                   'nopd_local_citation_revenue',
-                                                   'nopd_state_citations',
-                                                   'nopd_state_citation_revenue',
-                                                   'nopd_total_citations',
-                                                   'nopd_total_citation_revenue',
-                                                   'nopd_revenue_local_as_state'
-                                                   'nopd_total_revenue_local_as_state',
-                                                   'nopd_lost_revenue'])
-
-    # Iterate through each row in the worksheet and add the data to the dataframe
+    violation_table = analysis.build_violation_table(violation_types, summary)
+    nopd_data_df, nopd_charts = analysis.chart_citations(data.citations, 'NOPD', violation_table)
+    number_of_months = analysis.get_number_of_months(summary['A1'].value, nopd_data_df['Violation Date'])
+
+    # Set display options to show all columns and rows
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.max_rows', None)
+
+    # Collect the local and state reference codes of each violation, in the order of the Summary sheet
+    references = {}
     for row in violation_types.iter_rows(min_row=2, values_only=True):
         if row[0] is None:
             break
@@ -266,163 +326,39 @@ def generate_memo(excel_path, memo_file, workbook_file):
             violation_type = 'local_ref'
         else:
             violation_type = 'state_ref'
+        references.setdefault(violation, {})[violation_type] = violation_ref
 
-        # Check if the violation already exists in the dataframe
-        if violation in violation_types_df['violation'].values:
-            # Update the existing row with the new reference code
-            existing_row = violation_types_df[violation_types_df['violation'] == violation].index[0]
-            violation_types_df.at[existing_row, violation_type] = violation_ref
-        else:
-            # Add a new row to the dataframe with the new violation and reference code
-            new_row = {'violation': violation, violation_type: violation_ref}
-            violation_types_df = violation_types_df._append(new_row, ignore_index=True)
-
-    print(violation_types_df[['violation', 'local_ref', 'state_ref']])
-
-    for index, row in violation_types_df.iterrows():
-        # Access Methods that counts the total number of local citations,
-        # calculates the revenue generated, writes to the Summary sheet,
-        # and updates the dataframe. See methods file for more details
-        local_fine, count, rev = methods.total_citations_local(data, summary, row['local_ref'], index)
-        violation_types_df.at[index, 'local_fine'] = local_fine
-        violation_types_df.at[index, 'local_citations'] = count
-        violation_types_df.at[index, 'local_citation_revenue'] = rev
-
-        # Access Methods that counts the total number of state citations,
-        # calculates the revenue generated, writes to the Summary sheet,
-        # and updates the dataframe. See methods file for more details
-        state_fine, count, rev = methods.total_citations_state(data, summary, row['state_ref'], index)
-        violation_types_df.at[index, 'state_fine'] = state_fine
-        violation_types_df.at[index, 'state_citations'] = count
-        violation_types_df.at[index, 'state_citation_revenue'] = rev
-
-        # Access Methods that counts the number of local citations issued by nopd,
-        # calculates the revenue generated, writes to the Summary sheet,
-        # and updates the dataframe. See methods file for more details
-        local_fine, count, rev = methods.nopd_citations_local(nopd_citations, summary, row['local_ref'], index)
-        violation_types_df.at[index, 'nopd_local_citations'] = count
-        violation_types_df.at[index, 'nopd_local_citation_revenue'] = rev
-
-        # Access Methods that counts the number of state citations issued by nopd,
-        # calculates the revenue generated, writes to the Summary sheet,
-        # and updates the dataframe. See methods file for more details
-        state_fine, count, rev = methods.nopd_citations_state(nopd_citations, summary, row['state_ref'], index)
-        violation_types_df.at[index, 'nopd_state_citations'] = count
-        violation_types_df.at[index, 'nopd_state_citation_revenue'] = rev
-
-        # Access Methods that calculates the total number of citations issued by NOPD,
-
-        fine_difference, total_citations, total_revenue, citation_difference, \
-            total_difference_rev, total_nopd_citations, total_nopd_revenue, nopd_revenue_local_as_state, \
-            total_nopd_revenue_local_as_state, nopd_lost_revenue = methods.perform_calculation(math_doc, violation_types_df.at[
-                                                                                                            index,
-                                                                                                            'violation'
-                                                                                                        ],
-                                                                           violation_types_df.at[index, 'local_fine'],
-                                                                           violation_types_df.at[index, 'state_fine'],
-                                                                           violation_types_df.at[
-                                                                               index, 'local_citations'],
-                                                                           violation_types_df.at[
-                                                                               index, 'state_citations'],
-                                                                           violation_types_df.at[
-                                                                               index, 'local_citation_revenue'],
-                                                                           violation_types_df.at[
-                                                                               index, 'state_citation_revenue'],
-                                                                           violation_types_df.at[
-                                                                               index, 'nopd_local_citations'],
-                                                                           violation_types_df.at[
-                                                                               index, 'nopd_state_citations'],
-                                                                           violation_types_df.at[
-                                                                               index, 'nopd_local_citation_revenue'],
-                                                                           violation_types_df.at[
-                                                                               index, 'nopd_state_citation_revenue'])
-
-        # Update the dataframe with the total citations and revenue lost
-        violation_types_df.at[index, 'nopd_total_citations'] = total_nopd_citations
-        violation_types_df.at[index, 'nopd_total_citation_revenue'] = total_nopd_revenue
-        violation_types_df.at[index, 'nopd_revenue_local_as_state'] = nopd_revenue_local_as_state
-        violation_types_df.at[index, 'nopd_total_revenue_local_as_state'] = total_nopd_revenue_local_as_state
-        violation_types_df.at[index, 'nopd_lost_revenue'] = nopd_lost_revenue
-        # Write the lost revenue to the Summary sheet
-        methods.write(summary, 'H', index, nopd_lost_revenue)
+    refs_df = pd.DataFrame([{'violation': violation,
+                             'local_ref': refs.get('local_ref'),
+                             'state_ref': refs.get('state_ref')} for violation, refs in references.items()])
+    print(refs_df)
 
-    print(violation_types_df)
+    # Every code counted by issuing agency while the data was streamed. The NOPD counts come from the Data sheet's
+    # agency column, not from any NOPD Citations sheet already in the upload
+    total_counts, nopd_counts = methods.split_count_index(data.counts, search_text)
 
-    # Total Columns in the dataframe
-    sum_local_citations = violation_types_df['local_citations'].sum()
-    sum_local_citation_revenue = violation_types_df['local_citation_revenue'].sum()
-    sum_state_citations = violation_types_df['state_citations'].sum()
-    sum_state_citation_revenue = violation_types_df['state_citation_revenue'].sum()
-    sum_nopd_local_citations = violation_types_df['nopd_local_citations'].sum()
-    sum_nopd_local_citation_revenue = violation_types_df['nopd_local_citation_revenue'].sum()
-    sum_nopd_state_citations = violation_types_df['nopd_state_citations'].sum()
-    sum_nopd_state_citation_revenue = violation_types_df['nopd_state_citation_revenue'].sum()
-    sum_nopd_total_citations = violation_types_df['nopd_total_citations'].sum()
-    sum_nopd_total_citation_revenue = violation_types_df['nopd_total_citation_revenue'].sum()
-    sum_nopd_revenue_local_as_state = violation_types_df['nopd_revenue_local_as_state'].sum()
-    sum_total_nopd_revenue_local_as_state = violation_types_df['nopd_total_revenue_local_as_state'].sum()
-    sum_nopd_lost_revenue = violation_types_df['nopd_lost_revenue'].sum()
-
-    # Calculate the average monthly lost revenue
-    average_monthly_revenue_lost = sum_nopd_lost_revenue / number_of_months
-    print(f"\nThe average monthly lost revenue is: {average_monthly_revenue_lost}")
-    methods.write(summary, 'B', 14, average_monthly_revenue_lost)
-
-    # Calculate the annualized lost revenue
-    annualized_lost_revenue = sum_nopd_lost_revenue / (number_of_months / 12)
-    print(f"The annualized lost revenue is: {annualized_lost_revenue}")
-    methods.write(summary, 'B', 15, annualized_lost_revenue)
-
-    # Calculate the estimated annual revenue impact
+    # Calculate the revenue of every violation at once. The fines are in the Summary sheet, in the same order
     collection_rate = methods.read_cell_value(summary, 'B19')
-    print(f"The collection rate is: {collection_rate}")
-    estimated_annual_revenue_impact = annualized_lost_revenue * collection_rate
-    print(f"The estimated annual revenue impact is: {estimated_annual_revenue_impact}\n")
-    methods.write(summary, 'B', 17, estimated_annual_revenue_impact)
-
-    # Create a DataFrame with the calculation results
-    data = {
-        'Description': ['Average Monthly Lost Revenue', 'Annualized Lost Revenue', 'Collection Rate',
-                        'Estimated Annual Revenue Impact'],
-        'Value': [average_monthly_revenue_lost, annualized_lost_revenue, collection_rate,
-                  estimated_annual_revenue_impact]
-    }
-    results_df = pd.DataFrame(data)
-
-    # Update the dataframe with the totals
-    totals_df = pd.DataFrame(columns=[
-        'sum_local_citations', 'sum_local_citation_revenue',
-        'sum_state_citations', 'sum_state_citation_revenue',
-        'sum_nopd_local_citations', 'sum_nopd_local_citation_revenue',
-        'sum_nopd_state_citations', 'sum_nopd_state_citation_revenue',
-        'sum_nopd_total_citations', 'sum_nopd_total_citation_revenue',
-        'sum_nopd_revenue_local_as_state',
-        'sum_nopd_total_revenue_local_as_state', 'sum_nopd_lost_revenue'])
-    totals_df.at[0, 'sum_local_citations'] = sum_local_citations
-    totals_df.at[0, 'sum_local_citation_revenue'] = sum_local_citation_revenue
-    totals_df.at[0, 'sum_state_citations'] = sum_state_citations
-    totals_df.at[0, 'sum_state_citation_revenue'] = sum_state_citation_revenue
-    totals_df.at[0, 'sum_nopd_local_citations'] = sum_nopd_local_citations
-    totals_df.at[0, 'sum_nopd_local_citation_revenue'] = sum_nopd_local_citation_revenue
-    totals_df.at[0, 'sum_nopd_state_citations'] = sum_nopd_state_citations
-    totals_df.at[0, 'sum_nopd_state_citation_revenue'] = sum_nopd_state_citation_revenue
-    totals_df.at[0, 'sum_nopd_total_citations'] = sum_nopd_total_citations
-    totals_df.at[0, 'sum_nopd_total_citation_revenue'] = sum_nopd_total_citation_revenue
-    totals_df.at[0, 'sum_nopd_revenue_local_as_state'] = sum_nopd_revenue_local_as_state
-    totals_df.at[0, 'sum_total_nopd_revenue_local_as_state'] = sum_total_nopd_revenue_local_as_state
-    totals_df.at[0, 'sum_nopd_lost_revenue'] = sum_nopd_lost_revenue
-
-    # Transpose the DataFrame
-    totals_df_transposed = totals_df.T
-
-    # you need to reset the index so that it becomes a regular column in the DataFrame
-    totals_df_transposed.reset_index(inplace=True)
-
-    # rename the columns to reflect the change
-    totals_df_transposed.columns = ['Type of Total', 'Value']
-
-    methods.MathDoc.add_dataframe(math_doc, totals_df_transposed)
-    methods.perform_final_calculation(math_doc, sum_nopd_lost_revenue, number_of_months, collection_rate)
+    revenue = methods.calculate_revenue(
+        refs_df['violation'],
+        [summary.cell(row=index + 3, column=2).value for index in range(len(refs_df))],
+        [summary.cell(row=index + 3, column=3).value for index in range(len(refs_df))],
+        refs_df['local_ref'].map(total_counts),
+        refs_df['state_ref'].map(total_counts),
+        refs_df['local_ref'].map(nopd_counts),
+        refs_df['state_ref'].map(nopd_counts),
+        number_of_months,
+        collection_rate)
+    methods.write_revenue_to_summary(summary, revenue)
+    methods.narrate_revenue(math_doc, revenue)
+
+    violation_types_df = pd.concat([refs_df[['local_ref', 'state_ref']], revenue.violations], axis=1)
+    print(violation_types_df)
+    print(f"\n{revenue.impact}\n")
+
+    # Data frames with the revenue impact and the totals, for the memo
+    results_df = revenue.impact.rename_axis('Description').reset_index(name='Value')
+    totals_df = pd.DataFrame({name: [value] for name, value in revenue.totals.items()})
 
     # DataFrame for citations
     citations_df_by_violation = violation_types_df[['violation',
@@ -457,7 +393,7 @@ def generate_memo(excel_path, memo_file, workbook_file):
                                        columns=citations_df_by_violation.columns)
 
     # Append the totals row to the `citations_df_by_violation` DataFrame
-    citations_df_by_violation = citations_df_by_violation._append(citation_totals_row, ignore_index=True)
+    citations_df_by_violation = pd.concat([citations_df_by_violation, citation_totals_row], ignore_index=True)
 
     # DataFrame for revenue
     revenue_df_by_violation = violation_types_df[['violation',
@@ -468,7 +404,7 @@ def generate_memo(excel_path, memo_file, workbook_file):
     # Create a DataFrame for total revenue
     revenue_df = totals_df[['sum_nopd_local_citation_revenue', 'sum_nopd_state_citation_revenue',
                             'sum_nopd_total_citation_revenue', 'sum_nopd_revenue_local_as_state',
-                            'sum_total_nopd_revenue_local_as_state', 'sum_nopd_lost_revenue']]
+                            'sum_nopd_total_revenue_local_as_state', 'sum_nopd_lost_revenue']]
 
     # Rename the columns as needed
     revenue_df = revenue_df.rename(columns={
@@ -476,7 +412,7 @@ def generate_memo(excel_path, memo_file, workbook_file):
         'sum_nopd_state_citation_revenue': 'NOPD State Revenue',
         'sum_nopd_total_citation_revenue': 'NOPD Total Revenue',
         'sum_nopd_revenue_local_as_state': 'NOPD Revenue Local as State',
-        'sum_total_nopd_revenue_local_as_state': 'Total NOPD Revenue Local as State',
+        'sum_nopd_total_revenue_local_as_state': 'Total NOPD Revenue Local as State',
         'sum_nopd_lost_revenue': 'NOPD Lost Revenue'
         # Add more columns as needed
     })
@@ -490,7 +426,7 @@ def generate_memo(excel_path, memo_file, workbook_file):
                                       columns=revenue_df_by_violation.columns)
 
     # Append the totals row to the `citations_df_by_violation` DataFrame
-    revenue_df_by_violation = revenue_df_by_violation._append(revenue_totals_row, ignore_index=True)
+    revenue_df_by_violation = pd.concat([revenue_df_by_violation, revenue_totals_row], ignore_index=True)
 
     # Rename the columns as needed
     revenue_df_by_violation = revenue_df_by_violation.rename(columns={
@@ -502,13 +438,6 @@ def generate_memo(excel_path, memo_file, workbook_file):
         'nopd_total_revenue_local_as_state': 'Total NOPD Revenue Local as State',
         'nopd_lost_revenue': 'NOPD Lost Revenue'})
 
-    # Write the totals to the Summary sheet
-    methods.write(summary, 'D', 11, sum_local_citations)
-    methods.write(summary, 'E', 11, sum_state_citations)
-    methods.write(summary, 'F', 11, sum_nopd_local_citations)
-    methods.write(summary, 'G', 11, sum_nopd_state_citations)
-    methods.write(summary, 'H', 11, sum_nopd_lost_revenue)
-
     # Load the template Word document
     doc = Document('files/For Review Memo Template.docx')
 
@@ -636,7 +565,7 @@ def generate_memo(excel_path, memo_file, workbook_file):
     methods.write_table(doc, citations_df, False, 'Total Citations')
 
     doc.add_paragraph()
-    doc.add_picture('files/NOPD_citations_plot.png', width=Inches(6))
+    doc.add_picture(BytesIO(nopd_charts.result()['citations']), width=Inches(6))
 
     try:
         memo_citation_table = analysis.get_memo_completion('Briefly summarize only the citation and total citation data, '
@@ -675,7 +604,7 @@ def generate_memo(excel_path, memo_file, workbook_file):
     methods.write_table(doc, revenue_df, True, 'Total Revenue')
 
     doc.add_paragraph()
-    doc.add_picture('files/NOPD_revenue_plot.png', width=Inches(6))
+    doc.add_picture(BytesIO(nopd_charts.result()['revenue']), width=Inches(6))
 
     try:
         memo_revenue_table = analysis.get_memo_completion('Briefly summarize only the revenue and total revenue data'
@@ -803,23 +732,34 @@ def generate_memo(excel_path, memo_file, workbook_file):
     # Save the document after all calculations are added
     math_doc.save_doc('files/Math_Calculations_Work.docx')
 
-    # Save the changes to the Excel file
-    wb.save(workbook_file)
+    # Save the upload with the filled in Summary and the NOPD citations, sheet by sheet
+    workbooks.save_workbook(filepath, workbook_file, {'Summary': summary}, citations=data.citations)
     # Save the changes to the Word document
     doc.save(memo_file)
 
-    # Close the workbook
-    wb.close()
+    # Re-embed the regenerated memo, math sheet and workbook for answering questions
+    artifacts.refresh_artifacts_in_background()
 
     print('Memo has been created and saved to the following location: ', filepath)
 
     return
 
 
+async def warm_up(application: Application) -> None:
+    # Load the ordinance embeddings and embed any changed project artifacts in the background once the bot is up
+    embeddings.warm_up_in_background()
+    artifacts.refresh_artifacts_in_background()
+
+
 def main() -> None:
     """Start the bot."""
+    configure_logging()
+    print('Messaging Filters Configured')
+    print('------\nListening For Messages...\n------\n')
+    logger.info('\n------\nListening For Messages...\n------\n')
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(telegram_api_key).build()
+    application = Application.builder().token(telegram_api_key).post_init(warm_up).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("get_memo", get_memo))
@@ -1,11 +1,18 @@
+from collections import Counter
+from numbers import Number
+from typing import NamedTuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+
 from openpyxl.utils import column_index_from_string
 
 from docx import Document
 from docx.oxml import parse_xml, OxmlElement
 from docx.oxml.ns import nsdecls, qn
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.table import WD_TABLE_ALIGNMENT
-from docx.shared import Pt, Inches, RGBColor
+from docx.shared import Emu
+from docx.table import Table
 
 
 class MathDoc:
@@ -25,96 +32,226 @@ class MathDoc:
         write_table(self.doc, df, money, title)
 
     def add_dataframe(self, df):
-        # Add a dataframe to the document
-        table = self.doc.add_table(rows=df.shape[0] + 1, cols=df.shape[1])
-        table.style = 'Table Grid'
-        for i in range(df.shape[1]):
-            # Convert header to string to ensure compatibility
-            table.cell(0, i).text = str(df.columns[i])
-        for i in range(df.shape[0]):
-            for j in range(df.shape[1]):
-                # Convert each cell's value to string to ensure compatibility
-                table.cell(i + 1, j).text = str(df.iloc[i, j])
+        # Add a dataframe to the document as a plain grid, see add_table_xml
+        return add_table_xml(self.doc, df, formatted=False)
 
     def save_doc(self, file_name):
         # Save the document to the given file name
         self.doc.save(file_name)
 
 
-def perform_calculation(math_doc, violation, local_fine, state_fine, local, state, local_rev, state_rev,
-                        nopd_local, nopd_state, nopd_local_rev, nopd_state_rev):
+# Columns of RevenueModel.violations and their types, in order
+revenue_columns = {
+    'violation': 'object',
+    'local_fine': 'float64',
+    'state_fine': 'float64',
+    'local_citations': 'int64',
+    'local_citation_revenue': 'float64',
+    'state_citations': 'int64',
+    'state_citation_revenue': 'float64',
+    'nopd_local_citations': 'int64',
+    'nopd_local_citation_revenue': 'float64',
+    'nopd_state_citations': 'int64',
+    'nopd_state_citation_revenue': 'float64',
+    'fine_difference': 'float64',
+    'total_citations': 'int64',
+    'total_revenue': 'float64',
+    'citation_difference': 'int64',
+    'total_difference_revenue': 'float64',
+    'nopd_total_citations': 'int64',
+    'nopd_total_citation_revenue': 'float64',
+    'nopd_revenue_local_as_state': 'float64',
+    'nopd_total_revenue_local_as_state': 'float64',
+    'nopd_lost_revenue': 'float64',
+}
+# Columns summed into RevenueModel.totals, each total is named sum_<column>
+total_columns = ['local_citations', 'local_citation_revenue', 'state_citations', 'state_citation_revenue',
+                 'nopd_local_citations', 'nopd_local_citation_revenue', 'nopd_state_citations',
+                 'nopd_state_citation_revenue', 'nopd_total_citations', 'nopd_total_citation_revenue',
+                 'nopd_revenue_local_as_state', 'nopd_total_revenue_local_as_state', 'nopd_lost_revenue']
+
+
+class RevenueModel(NamedTuple):
     """
-    Perform a series of calculations and add them to the math_doc
+    The results of calculate_revenue
+    violations: one row per violation with the columns and types in revenue_columns
+    totals: the sum of each column in total_columns, indexed sum_<column>
+    impact: average monthly and annualized lost revenue, the collection rate and the estimated annual impact
+    """
+    violations: pd.DataFrame
+    totals: pd.Series
+    impact: pd.Series
+    number_of_months: int
+    collection_rate: float
+
+
+def calculate_revenue(violations, local_fines, state_fines, local_citations, state_citations,
+                      nopd_local_citations, nopd_state_citations, number_of_months, collection_rate):
+    """
+    Calculate the revenue, and the revenue NOPD lost by writing local instead of state citations, for every violation
+    at once. Every argument but the last two is a sequence with one entry per violation.
+    :param violations: violation names
+    :param local_fines:
+    :param state_fines:
+    :param local_citations: citations written under the local code by every department
+    :param state_citations: citations written under the state code by every department
+    :param nopd_local_citations: local citations written by NOPD
+    :param nopd_state_citations: state citations written by NOPD
+    :param number_of_months: number of months the citations cover
+    :param collection_rate: share of the fines that is actually collected
+    :return: RevenueModel
+    """
+    local_fine = np.asarray(local_fines, dtype=np.float64)
+    state_fine = np.asarray(state_fines, dtype=np.float64)
+    local = np.asarray(local_citations, dtype=np.int64)
+    state = np.asarray(state_citations, dtype=np.int64)
+    nopd_local = np.asarray(nopd_local_citations, dtype=np.int64)
+    nopd_state = np.asarray(nopd_state_citations, dtype=np.int64)
+
+    local_rev = local * local_fine
+    state_rev = state * state_fine
+    nopd_local_rev = nopd_local * local_fine
+    nopd_state_rev = nopd_state * state_fine
+    fine_difference = state_fine - local_fine
+    citation_difference = local - state
+    nopd_revenue_local_as_state = nopd_local * state_fine
+
+    violations = pd.DataFrame({
+        'violation': list(violations),
+        'local_fine': local_fine,
+        'state_fine': state_fine,
+        'local_citations': local,
+        'local_citation_revenue': local_rev,
+        'state_citations': state,
+        'state_citation_revenue': state_rev,
+        'nopd_local_citations': nopd_local,
+        'nopd_local_citation_revenue': nopd_local_rev,
+        'nopd_state_citations': nopd_state,
+        'nopd_state_citation_revenue': nopd_state_rev,
+        'fine_difference': fine_difference,
+        'total_citations': local + state,
+        'total_revenue': local_rev + state_rev,
+        'citation_difference': citation_difference,
+        'total_difference_revenue': citation_difference * fine_difference,
+        'nopd_total_citations': nopd_local + nopd_state,
+        'nopd_total_citation_revenue': nopd_local_rev + nopd_state_rev,
+        'nopd_revenue_local_as_state': nopd_revenue_local_as_state,
+        'nopd_total_revenue_local_as_state': nopd_state_rev + nopd_revenue_local_as_state,
+        'nopd_lost_revenue': nopd_revenue_local_as_state - nopd_local_rev,
+    }).astype(revenue_columns)
+
+    # object dtype so the citation totals stay integers next to the revenue totals
+    totals = pd.Series({f'sum_{column}': violations[column].sum() for column in total_columns}, dtype=object)
+    average_monthly_revenue_lost = totals['sum_nopd_lost_revenue'] / number_of_months
+    annualized_lost_revenue = totals['sum_nopd_lost_revenue'] / (number_of_months / 12)
+    impact = pd.Series({
+        'Average Monthly Lost Revenue': average_monthly_revenue_lost,
+        'Annualized Lost Revenue': annualized_lost_revenue,
+        'Collection Rate': collection_rate,
+        'Estimated Annual Revenue Impact': annualized_lost_revenue * collection_rate,
+    }, dtype='float64')
+    return RevenueModel(violations, totals, impact, number_of_months, collection_rate)
+
+
+def write_revenue_to_summary(summary, revenue):
+    """
+    Write the counts and lost revenue of each violation, their totals and the revenue impact to the Summary sheet
+    Cells that already hold a value are left as they are.
+    :param summary:
+    :param revenue: RevenueModel
+    :return:
+    """
+    for index, row in enumerate(revenue.violations.itertuples(index=False)):
+        write(summary, 'D', index, row.local_citations)
+        write(summary, 'E', index, row.nopd_local_citations)
+        write(summary, 'F', index, row.state_citations)
+        write(summary, 'G', index, row.nopd_state_citations)
+        write(summary, 'H', index, row.nopd_lost_revenue)
+
+    # The totals row, below the violations
+    totals = revenue.totals
+    write(summary, 'D', 11, totals['sum_local_citations'])
+    write(summary, 'E', 11, totals['sum_nopd_local_citations'])
+    write(summary, 'F', 11, totals['sum_state_citations'])
+    write(summary, 'G', 11, totals['sum_nopd_state_citations'])
+    write(summary, 'H', 11, totals['sum_nopd_lost_revenue'])
+
+    write(summary, 'B', 14, revenue.impact['Average Monthly Lost Revenue'])
+    write(summary, 'B', 15, revenue.impact['Annualized Lost Revenue'])
+    write(summary, 'B', 17, revenue.impact['Estimated Annual Revenue Impact'])
+
+
+def narrate_calculation(math_doc, row):
+    """
+    Write out the calculations for one violation
     :param math_doc:
-    :param violation:
-    :param local_fine:
-    :param state_fine:
-    :param local:
-    :param state:
-    :param local_rev:
-    :param state_rev:
-    :param nopd_local:
-    :param nopd_state:
-    :param nopd_local_rev:
-    :param nopd_state_rev:
+    :param row: a row of RevenueModel.violations
     :return:
     """
-    MathDoc.add_math_calculation(math_doc, f"Violation: {violation}")
+    MathDoc.add_math_calculation(math_doc, f"Violation: {row.violation}")
 
-    fine_difference = state_fine - local_fine
     MathDoc.add_math_calculation(math_doc, f"Fine Difference: \n"
                                            f"State Fine - Local Fine = Fine Difference\n "
-                                           f"{state_fine} - {local_fine} = {fine_difference}\n"
-                                           f"The state fine is {fine_difference} more than the local fine.\n\n")
+                                           f"{row.state_fine} - {row.local_fine} = {row.fine_difference}\n"
+                                           f"The state fine is {row.fine_difference} more than the local fine.\n\n")
 
-    total_citations = local + state
     MathDoc.add_math_calculation(math_doc, f"Total Citations (All Dept): \n"
                                            f"Sum(Local Citations) + Sum(State Citations) = Total Citations\n "
-                                           f"{local} + {state} = {total_citations}\n\n")
+                                           f"{row.local_citations} + {row.state_citations} = {row.total_citations}\n\n")
 
-    total_revenue = local_rev + state_rev
     MathDoc.add_math_calculation(math_doc, f"Total Revenue (All Dept): \n"
                                            f"Sum(Local Revenue) + Sum(State Revenue) = Total Revenue\n "
-                                           f"{local_rev} + {state_rev} = {total_revenue}\n\n")
+                                           f"{row.local_citation_revenue} + {row.state_citation_revenue} = "
+                                           f"{row.total_revenue}\n\n")
 
-    citation_difference = local - state
     MathDoc.add_math_calculation(math_doc, f"Local Citations that could have been State Citations: \n"
                                            f"Sum(Local Citations) - Sum(State Citations) = Local Citations that could have been State Citations\n "
-                                           f"{local} - {state} = {citation_difference}\n")
+                                           f"{row.local_citations} - {row.state_citations} = {row.citation_difference}\n")
 
-    total_difference_rev = citation_difference * fine_difference
     MathDoc.add_math_calculation(math_doc, f"Local Revenue that could have been State Revenue: \n"
                                            f"Local Citations that could have been State Citations * Fine Difference = Local Revenue that could have been State Revenue\n "
-                                           f"{citation_difference} * {fine_difference} = {total_difference_rev}\n")
+                                           f"{row.citation_difference} * {row.fine_difference} = {row.total_difference_revenue}\n")
 
-    total_nopd_citations = nopd_local + nopd_state
     MathDoc.add_math_calculation(math_doc, f"Total NOPD Citations: \n"
                                            f"Sum NOPD Local Citations + Sum NOPD State Citations = Total NOPD Citations\n "
-                                           f"{nopd_local} + {nopd_state} = {total_nopd_citations}\n\n")
+                                           f"{row.nopd_local_citations} + {row.nopd_state_citations} = "
+                                           f"{row.nopd_total_citations}\n\n")
 
-    total_nopd_revenue = nopd_local_rev + nopd_state_rev
-    MathDoc.add_math_calculation(math_doc, f"Total NOPD Revenue: \n"  
+    MathDoc.add_math_calculation(math_doc, f"Total NOPD Revenue: \n"
                                            f"Sum NOPD Local Revenue + Sum NOPD State Revenue = Total NOPD Revenue\n "
-                                           f"{nopd_local_rev} + {nopd_state_rev} = {total_nopd_revenue}\n")
+                                           f"{row.nopd_local_citation_revenue} + {row.nopd_state_citation_revenue} = "
+                                           f"{row.nopd_total_citation_revenue}\n")
 
-    nopd_revenue_local_as_state = nopd_local * state_fine
     MathDoc.add_math_calculation(math_doc, f"NOPD Local Citations as State Citations: \n"
-                                             f"Sum NOPD Local Citations * State Fine = NOPD Local Citations as State Citations\n "
-                                           f" State ({nopd_local} * {state_fine}) = {nopd_revenue_local_as_state}\n")
+                                           f"Sum NOPD Local Citations * State Fine = NOPD Local Citations as State Citations\n "
+                                           f" State ({row.nopd_local_citations} * {row.state_fine}) = "
+                                           f"{row.nopd_revenue_local_as_state}\n")
 
-    total_nopd_revenue_local_as_state = nopd_state_rev + (nopd_local * state_fine)
     MathDoc.add_math_calculation(math_doc, f"NOPD Local Citations as State Citations: \n"
                                            f"Sum NOPD Local Citations * State Fine = NOPD Local Citations as State Citations\n "
-                                           f" State ({nopd_local} * {state_fine}) = {total_nopd_revenue_local_as_state}\n")
+                                           f" State ({row.nopd_local_citations} * {row.state_fine}) = "
+                                           f"{row.nopd_total_revenue_local_as_state}\n")
 
-    nopd_lost_revenue = nopd_revenue_local_as_state - nopd_local_rev
     MathDoc.add_math_calculation(math_doc, f"NOPD Lost Revenue: \n"
                                            f"NOPD Local Citations as State Citations - NOPD Local Revenue = NOPD Lost Revenue\n "
-                                           f"{nopd_revenue_local_as_state} - {nopd_local_rev} = {nopd_lost_revenue}\n")
+                                           f"{row.nopd_revenue_local_as_state} - {row.nopd_local_citation_revenue} = "
+                                           f"{row.nopd_lost_revenue}\n")
+
+
+def narrate_revenue(math_doc, revenue):
+    """
+    Write out every calculation behind a RevenueModel: each violation, the totals and the revenue impact
+    :param math_doc:
+    :param revenue: RevenueModel
+    :return:
+    """
+    for row in revenue.violations.itertuples(index=False):
+        narrate_calculation(math_doc, row)
 
-    return fine_difference, total_citations, total_revenue, citation_difference, total_difference_rev, \
-        total_nopd_citations, total_nopd_revenue, nopd_revenue_local_as_state, total_nopd_revenue_local_as_state, \
-        nopd_lost_revenue
+    totals = revenue.totals.rename_axis('Type of Total').reset_index(name='Value')
+    MathDoc.add_dataframe(math_doc, totals)
+    perform_final_calculation(math_doc, revenue.totals['sum_nopd_lost_revenue'], revenue.number_of_months,
+                              revenue.collection_rate)
 
 
 def perform_final_calculation(math_doc, sum_nopd_lost_revenue, number_of_months, collection_rate):
@@ -194,6 +331,33 @@ def count_rows_with_text(worksheet, column_letter, search_text):
 
     return count
 
+def split_count_index(counts, agency):
+    """
+    Split a count index keyed by (agency, code) into the counts of every agency and of one agency
+    :param counts: Counter of (agency, code) -> number of rows
+    :param agency: issuing agency, e.g. '01 - CITY POLICE'
+    :return: (Counter of code -> rows of every agency, Counter of code -> rows of the agency)
+    """
+    total_counts = Counter()
+    agency_counts = Counter()
+    for (row_agency, code), count in counts.items():
+        total_counts[code] += count
+        if row_agency == agency:
+            agency_counts[code] += count
+    return total_counts, agency_counts
+
+def count_citations(data, violation_ref, counts=None):
+    """
+    Count the rows of column D that match a violation code, from a count index when one is given
+    :param data:
+    :param violation_ref:
+    :param counts: Counter of code -> rows from split_count_index
+    :return:
+    """
+    if counts is not None:
+        return counts[violation_ref]
+    return count_rows_with_text(data, 'D', violation_ref)
+
 def read_cell_value(sheet, cell_address):
     """
     Read the value of a cell
@@ -225,13 +389,14 @@ def write_cell_value(sheet, cell_address, value):
         print(f"The cell {cell.coordinate} has been updated to {value}.")
 
 
-def total_citations_local(data, summary, violation_ref, index):
+def total_citations_local(data, summary, violation_ref, index, counts=None):
     """
     Count the total number of local citations, calculate revenue, and write to the Summary sheet
     :param data:
     :param summary:
     :param violation_ref:
     :param index:
+    :param counts: Counter of code -> rows from split_count_index, saves scanning the sheet
     :return:
     """
     # Count the total number of local citations, calculate revenue, and write to the Summary sheet
@@ -241,7 +406,7 @@ def total_citations_local(data, summary, violation_ref, index):
     local_fine = summary.cell(row=index, column=2).value
 
     # Count the total number of local citations
-    total_local_citation_count = count_rows_with_text(data, 'D', violation_ref)
+    total_local_citation_count = count_citations(data, violation_ref, counts)
     # Write the total number of local citations to the Summary sheet
     write_cell_value(summary, f'D{index}', total_local_citation_count)
 
@@ -250,13 +415,14 @@ def total_citations_local(data, summary, violation_ref, index):
     # Return the total number of local citations and the total revenue
     return local_fine, total_local_citation_count, total_local_citation_rev
 
-def total_citations_state(data, summary, violation_ref, index):
+def total_citations_state(data, summary, violation_ref, index, counts=None):
     """
     Count the total number of local citations, calculate revenue, and write to the Summary sheet
     :param data:
     :param summary:
     :param violation_ref:
     :param index:
+    :param counts: Counter of code -> rows from split_count_index, saves scanning the sheet
     :return:
     """
     # Count the total number of local citations, calculate revenue, and write to the Summary sheet
@@ -266,7 +432,7 @@ def total_citations_state(data, summary, violation_ref, index):
     state_fine = summary.cell(row=index, column=3).value
 
     # Count the total number of local citations
-    total_state_citation_count = count_rows_with_text(data, 'D', violation_ref)
+    total_state_citation_count = count_citations(data, violation_ref, counts)
     # Write the total number of local citations to the Summary sheet
     write_cell_value(summary, f'F{index}', total_state_citation_count)
 
@@ -276,13 +442,14 @@ def total_citations_state(data, summary, violation_ref, index):
     return state_fine, total_state_citation_count, total_state_citation_rev
 
 
-def nopd_citations_local(data, summary, violation_ref, index):
+def nopd_citations_local(data, summary, violation_ref, index, counts=None):
     """
     Count the total number of local citations, calculate revenue, and write to the Summary sheet
     :param data:
     :param summary:
     :param violation_ref:
     :param index:
+    :param counts: Counter of code -> rows from split_count_index, saves scanning the sheet
     :return:
     """
     # Count the total number of local citations, calculate revenue, and write to the Summary sheet
@@ -292,7 +459,7 @@ def nopd_citations_local(data, summary, violation_ref, index):
     local_fine = summary.cell(row=index, column=2).value
 
     # Count the total number of local citations
-    total_local_citation_count = count_rows_with_text(data, 'D', violation_ref)
+    total_local_citation_count = count_citations(data, violation_ref, counts)
     # Write the total number of local citations to the Summary sheet
     write_cell_value(summary, f'E{index}', total_local_citation_count)
 
@@ -302,13 +469,14 @@ def nopd_citations_local(data, summary, violation_ref, index):
     return local_fine, total_local_citation_count, total_local_citation_rev
 
 
-def nopd_citations_state(data, summary, violation_ref, index):
+def nopd_citations_state(data, summary, violation_ref, index, counts=None):
     """
     Count the total number of local citations, calculate revenue, and write to the Summary sheet
     :param data:
     :param summary:
     :param violation_ref:
     :param index:
+    :param counts: Counter of code -> rows from split_count_index, saves scanning the sheet
     :return:
     """
     # Count the total number of local citations, calculate revenue, and write to the Summary sheet
@@ -318,7 +486,7 @@ def nopd_citations_state(data, summary, violation_ref, index):
     state_fine = summary.cell(row=index, column=3).value
 
     # Count the total number of local citations
-    total_state_citation_count = count_rows_with_text(data, 'D', violation_ref)
+    total_state_citation_count = count_citations(data, violation_ref, counts)
     # Write the total number of local citations to the Summary sheet
     write_cell_value(summary, f'G{index}', total_state_citation_count)
 
@@ -354,80 +522,94 @@ def write(sheet, column, index, value):
     # Write the total number of local citations to the Summary sheet
     write_cell_value(sheet, f'{column}{index}', value)
     
+# Pieces of table XML shared by every cell, see add_table_xml
+_centered = '<w:pPr><w:jc w:val="center"/></w:pPr>'
+_title_cell = '<w:tcPr><w:tcW w:type="dxa" w:w="{width}"/><w:gridSpan w:val="{span}"/><w:shd w:fill="000080"/></w:tcPr>'
+_title_run = '<w:rPr><w:b/><w:color w:val="FFFFFF"/></w:rPr>'
+_header_cell = '<w:tcPr><w:tcW w:type="dxa" w:w="1440"/><w:shd w:fill="D3D3D3"/></w:tcPr>'
+_header_run = '<w:rPr><w:rFonts w:ascii="Arial" w:hAnsi="Arial"/><w:b/><w:sz w:val="20"/></w:rPr>'
+_plain_cell = '<w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr>'
+
+
+def _run_text(text):
+    """Return the w:t (with w:tab and w:br) elements of a run holding text."""
+    parts = []
+    for i, line in enumerate(text.split('\n')):
+        if i:
+            parts.append('<w:br/>')
+        for j, piece in enumerate(line.split('\t')):
+            if j:
+                parts.append('<w:tab/>')
+            if piece:
+                space = ' xml:space="preserve"' if piece != piece.strip() else ''
+                parts.append(f'<w:t{space}>{escape(piece)}</w:t>')
+    return ''.join(parts) or '<w:t/>'
+
+
+def _cell(properties, text, run_properties='', paragraph_properties=''):
+    return f'<w:tc>{properties}<w:p>{paragraph_properties}<w:r>{run_properties}{_run_text(text)}</w:r></w:p></w:tc>'
+
+
+def add_table_xml(doc, df, money=False, title=None, formatted=True):
+    """
+    Add a DataFrame to the end of a document as a table, built as one piece of XML instead of cell by cell
+    :param doc: python-docx Document
+    :param df:
+    :param money: format numbers as currency
+    :param title: text of the title row spanning the table, only used when formatted
+    :param formatted: centered, fixed-width table with a dark blue title row and a grey Arial header
+                      (write_table), otherwise a plain grid with a header row (MathDoc.add_dataframe)
+    :return: the python-docx Table
+    """
+    n_cols = df.shape[1]
+    # Column widths in twips, the text width of the last section split the same way python-docx's add_table does
+    section = doc.sections[-1]
+    width = Emu((section.page_width - section.left_margin - section.right_margin) // n_cols).twips
+    style = doc.styles['Table Grid'].style_id
+    layout = '<w:jc w:val="center"/><w:tblLayout w:type="fixed"/>' if formatted else ''
+    cell = _plain_cell.format(width=width)
+
+    rows = []
+    if formatted:
+        rows.append(_cell(_title_cell.format(width=width * n_cols, span=n_cols), f"{title}", _title_run, _centered))
+        rows.append(''.join(_cell(_header_cell, str(column), _header_run, _centered) for column in df.columns))
+    else:
+        rows.append(''.join(_cell(cell, str(column)) for column in df.columns))
+
+    paragraph = _centered if formatted else ''
+    columns = [df.iloc[:, j].to_numpy() for j in range(n_cols)]
+    for values in zip(*columns):
+        texts = []
+        for value in values:
+            # Check if the value is a number and should be formatted as currency
+            if money and isinstance(value, Number):
+                texts.append(f"${value:,.2f}")
+            else:
+                texts.append(str(value))
+        rows.append(''.join(_cell(cell, text, paragraph_properties=paragraph) for text in texts))
+
+    grid = ''.join(f'<w:gridCol w:w="{width}"/>' for _ in range(n_cols))
+    body = ''.join(f'<w:tr>{row}</w:tr>' for row in rows)
+    tbl = parse_xml(f'<w:tbl {nsdecls("w")}><w:tblPr><w:tblStyle w:val="{style}"/><w:tblW w:type="auto" w:w="0"/>'
+                    f'{layout}<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" '
+                    f'w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr><w:tblGrid>{grid}</w:tblGrid>{body}</w:tbl>')
+    # Tables go at the end of the body, before the final section properties
+    body = doc.element.body
+    section_properties = body.find(qn('w:sectPr'))
+    if section_properties is not None:
+        section_properties.addprevious(tbl)
+    else:
+        body.append(tbl)
+    return Table(tbl, doc)
+
+
 def write_table(doc, df, money, title):
     """
-    Add a table to the Word document with an additional row for headers
+    Add a table to the Word document with a title row and a header row, see add_table_xml
     :param doc:
     :param df:
     :param money:
     :param title:
     :return:
     """
-    # Add a table to the Word document with an additional row for headers
-    table = doc.add_table(df.shape[0] + 2, df.shape[1])
-
-    table.alignment = WD_TABLE_ALIGNMENT.CENTER
-
-    # Set autofit to false so we can set widths as needed
-    table.autofit = False
-
-    # Define the style for the table - you can customize this as needed
-    table.style = 'Table Grid'
-
-    # Merge the cells in the first row to create a title cell
-    title_cell = table.cell(0, 0)
-    title_cell.merge(table.cell(0, df.shape[1] - 1))
-    title_cell.text = f"{title}"
-    title_cell.paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER  # Center alignment
-
-    # Set the background color of the title cell to dark blue
-    shading_elm = parse_xml(r'<w:shd {} w:fill="000080"/>'.format(nsdecls('w')))
-    title_cell._tc.get_or_add_tcPr().append(shading_elm)
-
-    # Set the font of the title cell to bold and white
-    for paragraph in title_cell.paragraphs:
-        for run in paragraph.runs:
-            run.font.bold = True  # Set the font to bold
-            run.font.color.rgb = RGBColor(255, 255, 255)  # Set the font color to white
-
-    # Add the column headers from the DataFrame and format them for readability
-    for i, column in enumerate(df.columns):
-        cell = table.cell(1, i)
-        cell.text = column
-        paragraph = cell.paragraphs[0]
-        run = paragraph.runs[0]
-        run.font.bold = True
-        run.font.size = Pt(10)  # Set font size for readability
-        run.font.name = 'Arial'  # Choose a clear and readable font type
-        paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER  # Center alignment
-        cell.width = Inches(1)  # Set the width of the cell
-
-        # Set the background color to a light shade for contrast (e.g., light gray)
-        shading_elm = parse_xml(r'<w:shd {} w:fill="D3D3D3"/>'.format(nsdecls('w')))
-        cell._tc.get_or_add_tcPr().append(shading_elm)
-
-    # Set the header row formatting (dark blue background with white text)
-    for i, cell in enumerate(table.rows[0].cells):
-        # Set the font color to white and bold
-        cell.paragraphs[0].runs[0].font.color.rgb = RGBColor(255, 255, 255)
-        cell.paragraphs[0].runs[0].font.bold = True
-
-        # Set the background color to dark blue
-        shading_elm = parse_xml(r'<w:shd {} w:fill="000080"/>'.format(nsdecls('w')))
-        cell._tc.get_or_add_tcPr().append(shading_elm)
-
-    # Add the data from the DataFrame to the table with dollar signs
-    for i in range(df.shape[0]):  # Loop over rows
-        for j in range(df.shape[1]):  # Loop over columns
-            cell = table.cell(i + 2, j)  # '+2' to account for title and header rows
-            value = df.iloc[i, j]
-            # Check if the value is a number and should be formatted as currency
-            if money == True:
-                if isinstance(value, (int, float)):
-                    cell.text = f"${value:,.2f}"  # Format the number as currency with 2 decimal places
-                else:
-                    cell.text = str(value)
-            else:
-                cell.text = str(value)
-            cell.paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER  # Center alignment
-
+    return add_table_xml(doc, df, money, title)
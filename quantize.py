@@ -0,0 +1,118 @@
+import os
+import json
+
+import numpy as np
+
+# number of set bits in every byte value, for hamming distances between packed binary codes
+_popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def truncate(matrix, dimensions):
+    """Keep the first dimensions of each (Matryoshka) embedding and renormalize the rows."""
+    truncated = np.asarray(matrix[:, :dimensions], dtype=np.float32)
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return truncated / norms
+
+
+class QuantizedIndex:
+    """
+    Compressed copy of an embedding matrix used to pick candidates for a float32 re-rank
+    mode is 'float32' (truncation only), 'int8' (one scale per dimension) or 'binary' (sign bits, hamming distance).
+    """
+    modes = ('float32', 'int8', 'binary')
+
+    def __init__(self, mode, dimensions, codes, scale=None):
+        if mode not in self.modes:
+            raise ValueError(f"mode must be one of {self.modes}, not {mode}")
+        self.mode = mode
+        self.dimensions = dimensions
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def build(cls, matrix, mode='int8', dimensions=None, chunk_size=10000):
+        """
+        Quantize a normalized embedding matrix
+        :param matrix: normalized float32 matrix (can be memory-mapped)
+        :param mode: 'float32', 'int8' or 'binary'
+        :param dimensions: truncate to this many leading dimensions first, defaults to all of them
+        :param chunk_size: rows converted at a time
+        :return: QuantizedIndex
+        """
+        dimensions = dimensions or matrix.shape[1]
+        n = matrix.shape[0]
+        scale = None
+        if mode == 'int8':
+            # Symmetric per-dimension scale so the largest value in each dimension maps to 127
+            scale = np.zeros(dimensions, dtype=np.float32)
+            for start in range(0, n, chunk_size):
+                chunk = truncate(matrix[start:start + chunk_size], dimensions)
+                scale = np.maximum(scale, np.abs(chunk).max(axis=0))
+            scale = np.where(scale > 0, scale / 127, 1).astype(np.float32)
+            codes = np.empty((n, dimensions), dtype=np.int8)
+        elif mode == 'binary':
+            codes = np.empty((n, (dimensions + 7) // 8), dtype=np.uint8)
+        else:
+            codes = np.empty((n, dimensions), dtype=np.float32)
+
+        for start in range(0, n, chunk_size):
+            chunk = truncate(matrix[start:start + chunk_size], dimensions)
+            if mode == 'int8':
+                codes[start:start + chunk_size] = np.clip(np.round(chunk / scale), -127, 127)
+            elif mode == 'binary':
+                codes[start:start + chunk_size] = np.packbits(chunk > 0, axis=1)
+            else:
+                codes[start:start + chunk_size] = chunk
+        return cls(mode, dimensions, codes, scale)
+
+    @property
+    def bytes_per_vector(self):
+        return self.codes.shape[1] * self.codes.dtype.itemsize
+
+    def scores(self, query, chunk_size=4096):
+        """Approximate similarity of a normalized full-length query against every row (higher is closer)."""
+        query = truncate(np.asarray(query, dtype=np.float32).reshape(1, -1), self.dimensions)[0]
+        if self.mode == 'binary':
+            bits = np.packbits(query > 0)
+            scores = np.empty(self.codes.shape[0], dtype=np.float32)
+            for start in range(0, self.codes.shape[0], chunk_size):
+                distances = _popcount[np.bitwise_xor(self.codes[start:start + chunk_size], bits)].sum(axis=1)
+                scores[start:start + chunk_size] = -distances.astype(np.float32)
+            return scores
+        if self.mode == 'int8':
+            # (codes * scale) @ query == codes @ (scale * query); convert the codes a chunk at a time
+            query = query * self.scale
+            scores = np.empty(self.codes.shape[0], dtype=np.float32)
+            for start in range(0, self.codes.shape[0], chunk_size):
+                scores[start:start + chunk_size] = self.codes[start:start + chunk_size].astype(np.float32) @ query
+            return scores
+        return self.codes @ query
+
+    def candidates(self, query, n_candidates):
+        """Return the n_candidates rows with the highest approximate score, in corpus order."""
+        scores = self.scores(query)
+        n_candidates = min(n_candidates, scores.shape[0])
+        return np.sort(np.argpartition(-scores, n_candidates - 1)[:n_candidates])
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'codes': self.codes}
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+        for name, array in arrays.items():
+            path = os.path.join(directory, f'{name}.npy')
+            with open(f'{path}.tmp', 'wb') as file:
+                np.save(file, array)
+            os.replace(f'{path}.tmp', path)
+        with open(os.path.join(directory, 'quantized.json'), 'w') as file:
+            json.dump({'mode': self.mode, 'dimensions': self.dimensions}, file)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, 'quantized.json')) as file:
+            info = json.load(file)
+        codes = np.load(os.path.join(directory, 'codes.npy'), mmap_mode='r' if mmap else None)
+        scale_path = os.path.join(directory, 'scale.npy')
+        scale = np.load(scale_path) if os.path.exists(scale_path) else None
+        return cls(info['mode'], info['dimensions'], codes, scale)
@@ -0,0 +1,107 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class QueryEmbeddingCache:
+    """
+    A two-tier cache of query embeddings: an in-process LRU in front of a sqlite file on disk
+    """
+    def __init__(self, path, max_memory_entries=1024, max_disk_bytes=256 * 1024 * 1024):
+        """
+        :param path: sqlite file for the on-disk tier, or None to only cache in memory
+        :param max_memory_entries: number of embeddings kept in the in-process LRU
+        :param max_disk_bytes: total size of the embeddings kept on disk before the least recently used are evicted
+        """
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        # hit/miss counters for each tier
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.connection = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            # The bot calls in from worker threads, every access goes through self.lock
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS query_embeddings ('
+                                    'model TEXT, query TEXT, embedding BLOB, last_used REAL, '
+                                    'PRIMARY KEY (model, query))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS query_embeddings_last_used '
+                                    'ON query_embeddings (last_used)')
+            self.connection.commit()
+
+    def get(self, model, query):
+        """Return the cached embedding for a normalized query, or None."""
+        key = (model, query)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+            if self.connection is not None:
+                row = self.connection.execute('SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?',
+                                              key).fetchone()
+                if row is not None:
+                    self.connection.execute('UPDATE query_embeddings SET last_used = ? WHERE model = ? AND query = ?',
+                                            (time.time(), model, query))
+                    self.connection.commit()
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, model, query, embedding):
+        """Store the embedding of a normalized query in both tiers."""
+        key = (model, query)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            self._remember(key, embedding)
+            if self.connection is not None:
+                self.connection.execute('INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)',
+                                        (model, query, embedding.tobytes(), time.time()))
+                self._evict_disk()
+                self.connection.commit()
+        return embedding
+
+    def stats(self):
+        """Return the hit/miss counters and the number of cached entries."""
+        with self.lock:
+            disk_entries = 0
+            if self.connection is not None:
+                disk_entries = self.connection.execute('SELECT COUNT(*) FROM query_embeddings').fetchone()[0]
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                    'memory_entries': len(self.memory), 'disk_entries': disk_entries}
+
+    def _remember(self, key, embedding):
+        # Add to the in-process LRU, dropping the least recently used entry when full
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # Delete the least recently used rows until the stored embeddings fit in max_disk_bytes
+        total = self.connection.execute('SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM query_embeddings').fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self.connection.execute('SELECT rowid, LENGTH(embedding) FROM query_embeddings ORDER BY last_used')
+        expired = []
+        for rowid, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            expired.append((rowid,))
+            total -= size
+        self.connection.executemany('DELETE FROM query_embeddings WHERE rowid = ?', expired)
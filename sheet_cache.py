@@ -0,0 +1,121 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+
+import pyarrow as pa
+
+
+class SheetCache:
+    """
+    An on-disk cache of parsed workbook sheets, a directory of Arrow IPC files per upload named by a key such as the
+    upload's SHA-256
+    The files are uncompressed and read through a memory map. Numeric and date columns without missing values, text
+    (pandas' Arrow-backed str dtype) and categoricals stay views of the map, while nullable extension columns (Int64,
+    Float64, boolean) are copied into pandas memory. Whole uploads are evicted least recently used first once the
+    cache is larger than max_disk_bytes.
+    """
+    def __init__(self, path, max_disk_bytes=512 * 1024 * 1024):
+        """
+        :param path: directory the parsed uploads are stored in
+        :param max_disk_bytes: total size of the stored files before the least recently used uploads are evicted
+        """
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def file_key(file_path, chunk_size=1024 * 1024) -> str:
+        """Return the SHA-256 of a file's contents, read in chunks."""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key, names):
+        """
+        Return name -> DataFrame of the named tables stored for a key, or None unless all of them are
+        Columns that convert without a copy are read-only views of the memory-mapped files.
+        """
+        directory = os.path.join(self.path, key)
+        paths = {name: os.path.join(directory, f'{name}.arrow') for name in names}
+        with self.lock:
+            if not all(os.path.exists(path) for path in paths.values()):
+                self.misses += 1
+                return None
+            tables = {}
+            for name, path in paths.items():
+                with pa.memory_map(path) as source:
+                    # One block per column, so columns that can be views of the map aren't copied into a shared block
+                    table = pa.ipc.open_file(source).read_all()
+                    tables[name] = table.to_pandas(split_blocks=True, self_destruct=True)
+                    del table
+            # The directory's modification time orders the uploads for eviction
+            os.utime(directory)
+            self.hits += 1
+            return tables
+
+    def put(self, key, tables):
+        """
+        Store name -> DataFrame tables for a key, next to any tables already stored for it
+        If a table can't be written the error is raised, and a directory created for the key is removed again.
+        """
+        directory = os.path.join(self.path, key)
+        with self.lock:
+            created = not os.path.isdir(directory)
+            os.makedirs(directory, exist_ok=True)
+            try:
+                for name, df in tables.items():
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    path = os.path.join(directory, f'{name}.arrow')
+                    with pa.OSFile(f'{path}.tmp', 'wb') as sink:
+                        with pa.ipc.new_file(sink, table.schema) as writer:
+                            writer.write_table(table)
+                    os.replace(f'{path}.tmp', path)
+            except BaseException:
+                # Leave no empty directory or partly written file behind for stats() and get() to find
+                if created:
+                    shutil.rmtree(directory, ignore_errors=True)
+                else:
+                    for entry in os.scandir(directory):
+                        if entry.name.endswith('.tmp'):
+                            os.remove(entry.path)
+                raise
+            os.utime(directory)
+            self._evict(keep=key)
+
+    def stats(self):
+        """Return the hit/miss counters, the number of stored uploads and their size on disk."""
+        with self.lock:
+            sizes = self._sizes()
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(sizes), 'bytes': sum(size for size, _ in sizes.values())}
+
+    def _sizes(self):
+        # key -> (bytes, last used) of every stored upload
+        sizes = {}
+        for key in os.listdir(self.path):
+            directory = os.path.join(self.path, key)
+            if os.path.isdir(directory):
+                size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+                sizes[key] = (size, os.stat(directory).st_mtime)
+        return sizes
+
+    def _evict(self, keep=None):
+        # Delete the least recently used uploads until they fit in max_disk_bytes
+        sizes = self._sizes()
+        total = sum(size for size, _ in sizes.values())
+        for key, (size, _) in sorted(sizes.items(), key=lambda item: item[1][1]):
+            if total <= self.max_disk_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= size
+            print(f"Evicted the parsed sheets of {key} from the cache, last used {time.ctime(sizes[key][1])}")
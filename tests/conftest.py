@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import base64
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+stub_dimensions = 64
+
+
+def stub_embedding(text):
+    """A fixed vector for a text: each word adds a direction picked by its hash, so texts sharing words are similar."""
+    vector = np.zeros(stub_dimensions, dtype=np.float32)
+    for word in str(text).lower().split():
+        digest = hashlib.sha256(word.encode()).digest()
+        vector[digest[0] % stub_dimensions] += 1
+    if not vector.any():
+        vector[0] = 1
+    return vector
+
+
+class StubEncoding:
+    """Stands in for a tiktoken encoding without downloading it: every UTF-8 byte is a token."""
+    def encode(self, text):
+        return list(text.encode('utf-8'))
+
+    def decode(self, tokens):
+        return bytes(tokens).decode('utf-8', errors='ignore')
+
+
+class StubEmbeddingsHandler(BaseHTTPRequestHandler):
+    # Answers POST /v1/embeddings like the OpenAI API, with stub_embedding vectors
+    requests = []
+    # return the items last to first, each still carrying its index, like the API is allowed to
+    reverse = False
+    # requests containing one of these inputs fail with a 400, which the client doesn't retry
+    fail_inputs = set()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        self.requests.append(inputs)
+        if self.fail_inputs.intersection(inputs):
+            self.send_error(400, 'stub failure')
+            return
+        data = []
+        for i, text in enumerate(inputs):
+            vector = stub_embedding(text)
+            # The client asks for base64 unless an encoding_format is given
+            if body.get('encoding_format', 'float') == 'base64':
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        if self.reverse:
+            data.reverse()
+        response = json.dumps({'object': 'list', 'data': data, 'model': body['model'],
+                               'usage': {'prompt_tokens': 0, 'total_tokens': 0}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_tokenizer(monkeypatch):
+    """Count tokens with StubEncoding, so nothing needs the cl100k_base download."""
+    import embeddings
+    monkeypatch.setattr(embeddings, 'encoding_for', lambda model: StubEncoding())
+
+
+@pytest.fixture
+def embeddings_server(monkeypatch, stub_tokenizer):
+    """Run the stub embeddings server and point embeddings.py at it through OPENAI_BASE_URL."""
+    import embeddings
+    from query_cache import QueryEmbeddingCache
+
+    StubEmbeddingsHandler.requests = []
+    StubEmbeddingsHandler.reverse = False
+    StubEmbeddingsHandler.fail_inputs = set()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubEmbeddingsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('OPENAI_BASE_URL', f'http://127.0.0.1:{server.server_address[1]}/v1')
+    monkeypatch.setenv('OPENAI_API_KEY', 'stub')
+    # A fresh client picks up the base URL, and an in-memory query cache keeps the tests off the disk
+    monkeypatch.setattr(embeddings, '_client', None)
+    monkeypatch.setattr(embeddings, '_query_cache', QueryEmbeddingCache(None))
+    try:
+        yield StubEmbeddingsHandler
+    finally:
+        server.shutdown()
+        server.server_close()
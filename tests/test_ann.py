@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+
+import embeddings
+from ann import IVFIndex
+from conftest import stub_embedding
+
+
+def clustered_corpus(n=2000, dimensions=32, n_clusters=40, seed=0):
+    # Normalized vectors scattered around a few directions, the shape real embeddings have
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dimensions))
+    vectors = centers[rng.integers(n_clusters, size=n)] + 0.4 * rng.normal(size=(n, dimensions))
+    return embeddings.normalize_embeddings(vectors)
+
+
+def test_ivf_recall_at_the_default_n_probe(tmp_path):
+    matrix = clustered_corpus()
+    index = embeddings.EmbeddingIndex([str(i) for i in range(len(matrix))], matrix, normalized=True)
+    IVFIndex.build(matrix).save(str(tmp_path / 'ivf'))
+    index.ann = IVFIndex.load(str(tmp_path / 'ivf'))
+    assert index.ann.n_lists == int(4 * np.sqrt(len(matrix)))
+    assert sorted(index.ann.rows) == list(range(len(matrix)))
+
+    queries = clustered_corpus(n=50, seed=1)
+    # Only a fraction of the corpus is scored for a query
+    assert len(index.ann.candidates(queries[0], embeddings.default_n_probe)) < len(matrix) // 2
+    found = 0
+    for query in queries:
+        exact, _ = index.search_rows(query, top_n=10)
+        approximate, scores = index.search_rows(query, top_n=10, n_probe=embeddings.default_n_probe)
+        assert list(scores) == sorted(scores, reverse=True)
+        found += len(set(exact) & set(approximate))
+    assert found / (10 * len(queries)) >= 0.9
+
+
+class FailingIndex:
+    # An approximate index that must not be used
+    n_lists = 1
+
+    def candidates(self, query, n_probe):
+        raise AssertionError('the approximate index was used')
+
+
+def test_exact_search_and_the_fallback_without_an_index(embeddings_server, tmp_path):
+    texts = ['parking fines and meters', 'noise at night', 'dogs on a leash in parks', 'fireworks permits']
+    store_dir = str(tmp_path / 'store')
+    embeddings.save_embedding_store(store_dir, texts, [stub_embedding(text) for text in texts])
+    index = embeddings.load_embedding_store(store_dir)
+    assert index.ann is None
+    exact = embeddings.strings_ranked_by_relatedness('parking fines', index, top_n=4, exact=True)
+    # Without an approximate index, the default n_probe search scans every row
+    assert embeddings.strings_ranked_by_relatedness('parking fines', index, top_n=4) == exact
+    assert exact[0][0] == 'parking fines and meters'
+
+    index.ann = FailingIndex()
+    assert embeddings.strings_ranked_by_relatedness('parking fines', index, top_n=4, exact=True) == exact
+
+
+def test_rewriting_a_store_removes_its_stale_index(stub_tokenizer, tmp_path):
+    matrix = clustered_corpus(n=200)
+    texts = [f'article {i}' for i in range(len(matrix))]
+    store_dir = str(tmp_path / 'store')
+    embeddings.save_embedding_store(store_dir, texts, matrix)
+    embeddings.build_ann_index(store_dir)
+    assert embeddings.load_embedding_store(store_dir).ann is not None
+
+    embeddings.save_embedding_store(store_dir, texts[:100], matrix[:100])
+    assert not os.path.exists(os.path.join(store_dir, 'ivf'))
+    assert embeddings.load_embedding_store(store_dir).ann is None
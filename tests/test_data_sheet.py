@@ -0,0 +1,39 @@
+import pandas as pd
+from openpyxl import Workbook
+
+import workbooks
+
+nopd_agency = '01 - CITY POLICE'
+
+
+def data_sheet(n_rows):
+    wb = Workbook()
+    data = wb.active
+    data.title = 'Data'
+    data.append(['Case Number', 'Issuing Agency ', 'Violation Date', 'Violation Cited (State/Local Code Reference)', None])
+    for i in range(n_rows):
+        agency = nopd_agency if i % 3 else '02 - STATE POLICE'
+        code = '154:401' if i % 2 else 32.58
+        data.append([f'A{i}', agency, None if i % 7 else f'2017-08-{i % 28 + 1:02}', code, None])
+    return data
+
+
+def test_chunks_join_into_the_same_frame(monkeypatch):
+    whole = workbooks.stream_data_sheet(data_sheet(100))
+    monkeypatch.setattr(workbooks, 'chunk_rows', 7)
+    chunked = workbooks.stream_data_sheet(data_sheet(100))
+    pd.testing.assert_frame_equal(chunked.citations, whole.citations)
+    assert chunked.counts == whole.counts
+    assert list(chunked.citations.columns) == ['Case Number', 'Issuing Agency ', 'Violation Date',
+                                               'Violation Cited (State/Local Code Reference)']
+    assert isinstance(chunked.citations['Issuing Agency '].dtype, pd.CategoricalDtype)
+
+
+def test_no_kept_rows():
+    wb = Workbook()
+    data = wb.active
+    data.append(['Case Number', 'Issuing Agency '])
+    data.append(['A1', '02 - STATE POLICE'])
+    sheet = workbooks.stream_data_sheet(data)
+    assert len(sheet.citations) == 0 and sheet.rows == 1
+    assert list(sheet.citations.columns) == ['Case Number', 'Issuing Agency ']
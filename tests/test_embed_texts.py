@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import openai
+import pytest
+from openpyxl import Workbook
+
+import embeddings
+from conftest import StubEncoding, stub_embedding
+
+
+def corpus_texts(n):
+    # Texts of different lengths, so batches are cut by tokens as well as by inputs
+    return [f'Sec. {154 + i}: ' + 'word ' * (i % 5) + f'article {i}' for i in range(n)]
+
+
+def expected_rows(inputs):
+    return np.asarray([stub_embedding(text) for text in inputs], dtype=np.float32)
+
+
+def test_pack_batches_respects_both_limits():
+    counts = [5, 5, 5, 20, 1, 1, 1, 12, 0]
+    batches = embeddings.pack_batches(counts, max_tokens=12, max_inputs=2)
+    assert batches[0] == (0, 2) and batches[-1][1] == len(counts)
+    for (start, stop), (next_start, _) in zip(batches, batches[1:]):
+        assert stop == next_start
+    for start, stop in batches:
+        assert stop - start <= 2
+        # A single input over the token limit still gets a request of its own
+        assert sum(counts[start:stop]) <= 12 or stop - start == 1
+    assert (3, 4) in batches
+
+
+def test_embed_texts_requests_stay_under_the_limits(embeddings_server, tmp_path):
+    texts = corpus_texts(20)
+    matrix = embeddings.embed_texts(texts, str(tmp_path), max_tokens=60, max_inputs=3)
+    assert len(embeddings_server.requests) > 20 // 3
+    for inputs in embeddings_server.requests:
+        assert len(inputs) <= 3
+        assert sum(len(StubEncoding().encode(text)) for text in inputs) <= 60
+    inputs = [embeddings.remove_stuff(text) for text in texts]
+    assert sorted(text for request in embeddings_server.requests for text in request) == sorted(inputs)
+    np.testing.assert_array_equal(matrix, expected_rows(inputs))
+
+
+def test_embed_texts_reorders_items_by_index(embeddings_server, tmp_path):
+    embeddings_server.reverse = True
+    texts = corpus_texts(7)
+    matrix = embeddings.embed_texts(texts, str(tmp_path), max_inputs=4)
+    np.testing.assert_array_equal(matrix, expected_rows([embeddings.remove_stuff(text) for text in texts]))
+
+
+def test_embed_texts_resumes_with_the_missing_batches(embeddings_server, tmp_path):
+    texts = corpus_texts(12)
+    inputs = [embeddings.remove_stuff(text) for text in texts]
+    batches = embeddings.pack_batches([len(StubEncoding().encode(text)) for text in inputs], max_inputs=2)
+    # The run is interrupted by a failing request halfway through
+    embeddings_server.fail_inputs = {inputs[6]}
+    with pytest.raises(openai.BadRequestError):
+        embeddings.embed_texts(texts, str(tmp_path), max_in_flight=1, max_inputs=2)
+    done = {tuple(int(row) for row in name.split('-')[:2]) for name in os.listdir(tmp_path) if name.endswith('.npy')}
+    missing = [batch for batch in batches if batch not in done]
+    assert done and next(batch for batch in batches if batch[0] <= 6 < batch[1]) in missing
+
+    embeddings_server.fail_inputs = set()
+    embeddings_server.requests.clear()
+    matrix = embeddings.embed_texts(texts, str(tmp_path), max_in_flight=1, max_inputs=2)
+    assert embeddings_server.requests == [inputs[start:stop] for start, stop in missing]
+    np.testing.assert_array_equal(matrix, expected_rows(inputs))
+
+
+def test_create_embedding_df_writes_a_store(embeddings_server, tmp_path):
+    excel_path = str(tmp_path / 'codes.xlsx')
+    wb = Workbook()
+    sheet = wb.active
+    sheet.append(['New Orleans Code of Ordinances'])
+    sheet.append(['Section', 'Title', 'Text'])
+    sheet.append(['Sec. 154-383', 'Parking', 'No parking, ever.'])
+    sheet.append(['Sec. 154-401', None, 'Meters run from 8 to 6'])
+    sheet.append(['Sec. 30-1', 'Dogs', 'Leash required'])
+    wb.save(excel_path)
+    store_dir = str(tmp_path / 'store')
+
+    embeddings.create_embedding_df(excel_path, store_dir)
+
+    index = embeddings.load_embedding_store(store_dir)
+    assert list(index.texts) == ['Sec. 154-383 Parking No parking, ever.', 'Sec. 154-401 Meters run from 8 to 6',
+                                 'Sec. 30-1 Dogs Leash required']
+    expected = embeddings.normalize_embeddings(expected_rows([embeddings.remove_stuff(text) for text in index.texts]))
+    np.testing.assert_allclose(index.matrix, expected, rtol=1e-6)
+    assert not os.path.exists(os.path.join(store_dir, 'batches'))
@@ -0,0 +1,81 @@
+import ast
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import embeddings
+
+
+def test_sync_embedding_store_only_embeds_changed_rows(embeddings_server, tmp_path):
+    store_dir = str(tmp_path / 'store')
+    texts = ['Sec 1 parking', 'Sec 2 meters', 'Sec 3 dogs', 'Sec 4 noise']
+    manifest = embeddings.sync_embedding_store(texts, store_dir)
+    assert manifest['unchanged'] == 0 and len(manifest['added']) == 4 and manifest['removed'] == []
+
+    # Mark the stored vectors of the rows that stay, to tell a reused vector from a re-embedded one
+    matrix = np.load(os.path.join(store_dir, 'embeddings.npy'))
+    marked = embeddings.normalize_embeddings(np.arange(2 * matrix.shape[1], dtype=np.float32).reshape(2, -1))
+    matrix[[0, 3]] = marked
+    np.save(os.path.join(store_dir, 'embeddings.npy'), matrix)
+    embeddings_server.requests.clear()
+
+    # Edit row 2, remove row 3 and add a row
+    edited = ['Sec 1 parking', 'Sec 2 meters and fees', 'Sec 4 noise', 'Sec 5 fireworks']
+    manifest = embeddings.sync_embedding_store(edited, store_dir, source='test')
+
+    assert manifest['rows'] == 4 and manifest['unchanged'] == 2
+    assert [entry['row'] for entry in manifest['added']] == [1, 3]
+    assert sorted(entry['text'] for entry in manifest['removed']) == ['Sec 2 meters', 'Sec 3 dogs']
+    with open(os.path.join(store_dir, 'manifest.json')) as file:
+        assert json.load(file) == manifest
+    assert [text for request in embeddings_server.requests for text in request] == \
+        ['Sec 2 meters and fees', 'Sec 5 fireworks']
+
+    index = embeddings.load_embedding_store(store_dir)
+    assert list(index.texts) == edited
+    np.testing.assert_allclose(index.matrix[[0, 2]], marked, rtol=1e-6)
+    assert not os.path.exists(os.path.join(store_dir, 'batches'))
+
+    # Nothing changed, nothing is embedded or rewritten
+    embeddings_server.requests.clear()
+    manifest = embeddings.sync_embedding_store(edited, store_dir)
+    assert manifest['unchanged'] == 4 and manifest['added'] == [] and embeddings_server.requests == []
+
+
+# Texts that a CSV round trip could mangle: commas, quotes, newlines and strings pandas reads as missing
+tricky_texts = ['Sec. 154-383, parking', 'He said "stop"', 'two\nlines', 'NA', 'null', '', 'Sec. 30-1']
+
+
+def test_embedding_store_round_trip(stub_tokenizer, tmp_path):
+    store_dir = str(tmp_path / 'store')
+    vectors = np.random.default_rng(0).normal(size=(len(tricky_texts), 16)) * 5
+    embeddings.save_embedding_store(store_dir, tricky_texts, vectors)
+
+    index = embeddings.load_embedding_store(store_dir)
+    assert list(index.texts) == tricky_texts
+    assert index.matrix.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(index.matrix, axis=1), 1, rtol=1e-6)
+    np.testing.assert_allclose(index.matrix, vectors / np.linalg.norm(vectors, axis=1, keepdims=True), rtol=1e-5)
+    assert isinstance(index.matrix, np.memmap) and not index.matrix.flags.writeable
+    assert list(index.metadata['n_tokens']) == [len(text.encode('utf-8')) for text in tricky_texts]
+    assert not isinstance(embeddings.load_embedding_store(store_dir, mmap=False).matrix, np.memmap)
+
+
+def test_csv_migration_matches_literal_eval(stub_tokenizer, tmp_path):
+    csv_path = str(tmp_path / 'cityembeddings.csv')
+    vectors = np.random.default_rng(1).normal(size=(len(tricky_texts), 8))
+    # The old format: one stringified list of floats per row
+    pd.DataFrame({'text': tricky_texts, 'embedding': [str(vector.tolist()) for vector in vectors]}).to_csv(csv_path,
+                                                                                                        index=False)
+    store_dir = str(tmp_path / 'store')
+    embeddings.convert_csv_to_store(csv_path, store_dir, chunksize=3)
+
+    baseline = pd.read_csv(csv_path, keep_default_na=False)
+    expected = embeddings.normalize_embeddings([ast.literal_eval(value) for value in baseline['embedding']])
+    index = embeddings.load_embedding_store(store_dir)
+    assert list(index.texts) == list(baseline['text']) == tricky_texts
+    np.testing.assert_array_equal(index.matrix, expected)
+    with open(os.path.join(store_dir, 'info.json')) as file:
+        assert json.load(file)['rows'] == len(tricky_texts)
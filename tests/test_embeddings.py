@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+import embeddings
+from conftest import stub_embedding
+
+
+def test_embed_query_uses_the_stub_server(embeddings_server):
+    vector = embeddings.embed_query('Parking fines')
+    assert np.allclose(vector, stub_embedding(embeddings.normalize_query('Parking fines')))
+    # The second request is answered by the query cache
+    embeddings.embed_query('Parking fines')
+    assert len(embeddings_server.requests) == 1
+
+
+def test_search_against_the_stub_server(embeddings_server):
+    texts = ['parking fines and meters', 'noise at night', 'dogs on a leash in parks']
+    df = pd.DataFrame({'text': texts, 'embedding': [stub_embedding(text) for text in texts]})
+    strings, relatednesses = embeddings.strings_ranked_by_relatedness('parking fines', df, top_n=3, exact=True)
+    assert strings[0] == 'parking fines and meters'
+    assert list(relatednesses) == sorted(relatednesses, reverse=True)
+
+
+def test_queries_differing_in_case_share_the_embedding_of_the_key(embeddings_server):
+    first = embeddings.embed_query('Parking  FINES')
+    second = embeddings.embed_query('parking fines')
+    assert np.array_equal(first, second)
+    assert embeddings_server.requests == [['parking fines']]
+
+
+def test_warm_up_skips_a_missing_corpus(embeddings_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(embeddings, 'store_path', str(tmp_path / 'store'))
+    monkeypatch.setattr(embeddings, 'embedding_path', str(tmp_path / 'missing.csv'))
+    monkeypatch.setattr(embeddings, '_corpus', None)
+    embeddings.warm_up()
+    assert embeddings._corpus is None
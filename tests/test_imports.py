@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_modules_import_without_start_up_work(tmp_path):
+    # The chart worker re-imports messager.py as its main module, which must not open files or create clients
+    env = {key: value for key, value in os.environ.items() if key not in ('OPENAI_API_KEY', 'TELEGRAM_API_KEY')}
+    script = (f"import sys; sys.path.insert(0, {repo!r}); import messager, analysis, charts; "
+              "assert messager.logger.handlers == [] and messager._project_files is None; "
+              "assert analysis._performance_task is None")
+    subprocess.run([sys.executable, '-c', script], cwd=tmp_path, env=env, check=True)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,25 @@
+import pytest
+
+from lexical import BM25Index, code_references, tokenize
+
+
+@pytest.mark.parametrize('text, references', [
+    ('What is the fine under 154:383?', ['154:383']),
+    ('Sec. 154-383 and R.S. 32:414.1', ['154:383', '32:414.1']),
+    ('Cited for 32:53A.', ['32:53a']),
+    ('See Sec.154-383', ['154:383']),
+    ('Version 1.154:383', []),
+    ('Speeding under 32:58 at 10:30 on 2017-08-01', ['32:58']),
+    ('Stopped at 9:05 or 23:59', []),
+    ('Issued 2017-08-01', []),
+    ('Between 08-01 and 1-2-3', ['08:01']),
+])
+def test_code_references(text, references):
+    assert code_references(text) == references
+
+
+def test_dates_and_times_do_not_score_as_references():
+    index = BM25Index(['Sec. 154-383 parking', 'Citations issued 2017-08-01 at 10:30'])
+    assert '2017:08:01' not in tokenize('2017-08-01')
+    assert list(index.rows_with_references(['154:383'])) == [0]
+    assert len(index.rows_with_references(['10:30'])) == 0
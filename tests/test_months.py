@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+
+import analysis
+
+
+@pytest.mark.parametrize('header, months', [
+    ('Citations (Aug 2017-Aug 2018)', 13),
+    ('Citations (August 2017 to August 2018)', 13),
+    ('Citations (Aug-Dec 2017)', 5),
+    ('Citations (Nov-Feb 2018)', 4),
+    ('Citations (08/2017 - 08/2018)', 13),
+    ('Citations (Jan 2018 - Dec 2018)', 12),
+    ('Citations (January 2018 through December 2018)', 12),
+    ('Citations (01/2018 - 12/2018)', 12),
+    ('Citations to August 2018', None),
+    ('Citations', None),
+])
+def test_parse_months(header, months):
+    assert analysis.parse_months(header) == months
+
+
+def test_header_and_dates_of_the_same_period_agree():
+    dates = pd.Series(['2017-08-01', '2018-02-14', '2018-08-31'])
+    assert analysis.months_spanned(dates) == 13
+    assert analysis.get_number_of_months('Citations (Aug 2017-Aug 2018)', dates) == 13
+
+
+def test_the_dates_win_when_the_header_disagrees(monkeypatch):
+    monkeypatch.setattr(analysis, 'months_from_llm', lambda cell_value: pytest.fail('the LLM was asked'))
+    dates = pd.Series(['2018-01-03', '2018-06-30'])
+    assert analysis.get_number_of_months('Citations (Jan 2018 - Dec 2018)', dates) == 6
+    assert analysis.get_number_of_months('Citations (Jan 2018 - Jun 2018)', dates) == 6
+    assert analysis.get_number_of_months('Citations', dates) == 6
+    assert analysis.get_number_of_months('Citations (Jan 2018 - Dec 2018)', pd.Series([], dtype=object)) == 12
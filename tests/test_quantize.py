@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import embeddings
+from conftest import stub_embedding
+from quantize import QuantizedIndex
+
+
+def separated_corpus(n_groups=30, group_size=10, dimensions=64, seed=0):
+    # Groups of close vectors around far apart directions, so the top group_size of a query is one whole group
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_groups, dimensions))
+    vectors = np.repeat(centers, group_size, axis=0) + 0.05 * rng.normal(size=(n_groups * group_size, dimensions))
+    return embeddings.normalize_embeddings(vectors), embeddings.normalize_embeddings(centers)
+
+
+@pytest.mark.parametrize('mode, dimensions, bytes_per_vector', [
+    ('float32', 32, 128),
+    ('int8', None, 64),
+    ('binary', None, 8),
+])
+def test_quantized_candidates_rerank_to_the_exact_top_k(tmp_path, mode, dimensions, bytes_per_vector):
+    matrix, queries = separated_corpus()
+    index = embeddings.EmbeddingIndex([str(i) for i in range(len(matrix))], matrix, normalized=True)
+    QuantizedIndex.build(matrix, mode=mode, dimensions=dimensions).save(str(tmp_path / 'quantized'))
+    index.quantized = QuantizedIndex.load(str(tmp_path / 'quantized'))
+    assert index.quantized.mode == mode and index.quantized.bytes_per_vector == bytes_per_vector
+
+    for query in queries:
+        exact_rows, exact_scores = index.search_rows(query, top_n=10)
+        rows, scores = index.search_rows(query, top_n=10, rerank=30)
+        assert list(rows) == list(exact_rows)
+        # Candidates are re-ranked with the float32 matrix, not scored with the compressed codes
+        np.testing.assert_allclose(scores, exact_scores, rtol=1e-6)
+
+
+class FailingQuantizedIndex:
+    # A quantized index that must not be used
+    def candidates(self, query, n_candidates):
+        raise AssertionError('the quantized index was used')
+
+
+def test_exact_search_bypasses_the_quantized_index(embeddings_server):
+    texts = ['parking fines and meters', 'noise at night', 'dogs on a leash in parks', 'fireworks permits']
+    index = embeddings.EmbeddingIndex(texts, [stub_embedding(text) for text in texts])
+    exact = embeddings.strings_ranked_by_relatedness('parking fines', index, top_n=4, exact=True)
+    index.quantized = FailingQuantizedIndex()
+    assert embeddings.strings_ranked_by_relatedness('parking fines', index, top_n=4, exact=True) == exact
+    with pytest.raises(AssertionError, match='quantized index was used'):
+        embeddings.strings_ranked_by_relatedness('parking fines', index, top_n=4)
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        QuantizedIndex.build(separated_corpus()[0], mode='int4')
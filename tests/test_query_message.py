@@ -0,0 +1,68 @@
+import pytest
+
+import embeddings
+from conftest import StubEncoding
+
+article_header = '\n\nNew Orleans Ordinance Codes:\n"""\n'
+
+
+@pytest.mark.parametrize('budget, fill_budget, chosen', [
+    (12, False, [0, 1, 2]),
+    (12, True, [0, 1, 2]),
+    (11, False, [0, 1]),
+    (11, True, [0, 1, 3]),
+    (7, False, [0, 1]),
+    (6, False, [0]),
+    (6, True, [0, 3]),
+    (3, True, [1]),
+    (0, True, []),
+])
+def test_pack_articles(budget, fill_budget, chosen):
+    assert embeddings.pack_articles([4, 3, 5, 1], budget, fill_budget=fill_budget) == chosen
+
+
+class RecordingEncoding(StubEncoding):
+    # Remembers what was tokenized
+    def __init__(self):
+        self.texts = []
+
+    def encode(self, text):
+        self.texts.append(text)
+        return super().encode(text)
+
+
+@pytest.fixture
+def ranked_store(monkeypatch, tmp_path):
+    # A store whose articles always rank short, long, short
+    encoding = RecordingEncoding()
+    monkeypatch.setattr(embeddings, 'encoding_for', lambda model: encoding)
+    texts = ['Sec 1 short article', 'Sec 2 ' + 'long article ' * 10, 'Sec 3 also short']
+    store_dir = str(tmp_path / 'store')
+    embeddings.save_embedding_store(store_dir, texts, [[1, 0], [0.9, 0.1], [0.8, 0.2]])
+    monkeypatch.setitem(embeddings.retrieval_modes, 'vector', lambda query, df: (texts, (0.9, 0.8, 0.7)))
+    encoding.texts.clear()
+    return embeddings.load_embedding_store(store_dir), texts, encoding
+
+
+def articles_in(message, texts):
+    return [text for text in texts if f'{article_header}{text}\n"""' in message]
+
+
+def test_query_message_packs_to_the_budget_with_stored_token_counts(ranked_store):
+    index, texts, encoding = ranked_store
+    query = 'parking'
+    assert list(index.metadata['n_tokens']) == [len(text) for text in texts]
+    # With no room for articles the message is the introduction and question, whose tokens the budget pays first
+    empty = embeddings.query_message(query, index, 'gpt', 0)
+    assert articles_in(empty, texts) == []
+    wrapper = len(article_header + '\n"""')
+    short, long, _ = (len(text) + wrapper for text in texts)
+
+    # Exactly enough for the first two articles
+    budget = len(empty) + short + long
+    assert articles_in(embeddings.query_message(query, index, 'gpt', budget), texts) == texts[:2]
+    assert articles_in(embeddings.query_message(query, index, 'gpt', budget - 1), texts) == texts[:1]
+    assert articles_in(embeddings.query_message(query, index, 'gpt', budget - 1, fill_budget=True), texts) == \
+        [texts[0], texts[2]]
+    # The articles' token counts come from the store, only the wrapper and question are tokenized
+    assert not any(text in encoded for encoded in encoding.texts for text in texts)
@@ -0,0 +1,89 @@
+import os
+import tracemalloc
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+from openpyxl import Workbook
+
+import workbooks
+from sheet_cache import SheetCache
+
+nopd_agency = '01 - CITY POLICE'
+
+
+@pytest.fixture
+def sheet_cache(monkeypatch, tmp_path):
+    cache = SheetCache(str(tmp_path / 'sheets'))
+    monkeypatch.setattr(workbooks, '_sheet_cache', cache)
+    return cache
+
+
+def write_upload(path):
+    # An upload whose case numbers and codes mix numbers and text
+    wb = Workbook()
+    summary = wb.active
+    summary.title = 'Summary'
+    summary.append(['Violation', 'Total'])
+    data = wb.create_sheet('Data')
+    data.append(['Case Number', 'Issuing Agency ', 'Violation Date', 'Violation Cited (State/Local Code Reference)'])
+    for i in range(12):
+        agency = nopd_agency if i % 3 else '02 - STATE POLICE'
+        case = 17000 + i if i % 2 else f'A-{i}'
+        code = '154:401' if i % 4 else 32.58
+        data.append([case, agency, None, code])
+    violation_types = wb.create_sheet('Violation Types')
+    violation_types.append(['Code', 'Violation'])
+    violation_types.append(['154:401', 'Parking'])
+    wb.save(path)
+
+
+def test_mixed_type_columns_are_cached(sheet_cache, tmp_path):
+    path = str(tmp_path / 'upload.xlsx')
+    write_upload(path)
+    parsed = workbooks.load_upload(path)
+    assert sheet_cache.stats()['entries'] == 1
+    cached = workbooks.load_upload(path)
+    assert sheet_cache.hits == 1
+    assert cached.data.counts == parsed.data.counts
+    pd.testing.assert_frame_equal(cached.data.citations, parsed.data.citations)
+    assert {type(code) for code in cached.data.citations.iloc[:, 3]} == {str, float}
+    assert list(cached.data.citations.columns) == list(parsed.data.citations.columns)
+
+
+def test_failed_put_leaves_no_entry(sheet_cache):
+    tables = {'good': pd.DataFrame({'a': [1, 2]}), 'bad': pd.DataFrame({'a': [object()]})}
+    with pytest.raises(Exception):
+        sheet_cache.put('key', tables)
+    assert not os.path.exists(os.path.join(sheet_cache.path, 'key'))
+    assert sheet_cache.stats()['entries'] == 0
+
+
+def test_parse_settings_change_the_key(sheet_cache, monkeypatch, tmp_path):
+    path = str(tmp_path / 'upload.xlsx')
+    write_upload(path)
+    key = workbooks.upload_key(path, sheet_cache)
+    monkeypatch.setattr(workbooks, 'category_ratio', 0.25)
+    assert workbooks.upload_key(path, sheet_cache) != key
+    monkeypatch.setattr(workbooks, 'parse_format', workbooks.parse_format + 1)
+    monkeypatch.setattr(workbooks, 'category_ratio', 0.5)
+    assert workbooks.upload_key(path, sheet_cache) != key
+
+
+def test_get_keeps_numeric_and_text_columns_in_the_memory_map(sheet_cache):
+    n = 1_000_000
+    sheet_cache.put('key', {'table': pd.DataFrame({'number': pd.Series(range(n), dtype='int64'),
+                                                    'row': pd.Series(range(n), dtype='int64'),
+                                                    'text': pd.Series([f'case {i}' for i in range(n)], dtype='str')})})
+    # Joined blocks are allocated by Arrow, everything else pandas copies is seen by tracemalloc
+    arrow_before = pa.total_allocated_bytes()
+    tracemalloc.start()
+    try:
+        df = sheet_cache.get('key', ['table'])['table']
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # 16 MB of integers and about 14 MB of text would be copied otherwise
+    assert peak < 1_000_000 and pa.total_allocated_bytes() - arrow_before < 1_000_000
+    assert df['number'].iloc[-1] == n - 1 and df['text'].iloc[-1] == f'case {n - 1}'
+    assert not df['number'].to_numpy().flags.writeable
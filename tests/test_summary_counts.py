@@ -0,0 +1,78 @@
+import os
+
+import pytest
+from openpyxl import Workbook, load_workbook
+
+import methods
+import workbooks
+
+sample_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'CLEAN_Innovation Manager Performance Task - Sample Data.xlsx')
+nopd_agency = '01 - CITY POLICE'
+
+
+def violation_references(violation_types):
+    # (local_ref, state_ref) of each violation, in the order of the Summary sheet
+    references = {}
+    for code, violation in violation_types.iter_rows(min_row=2, max_col=2, values_only=True):
+        if code is None:
+            break
+        scope = 'local' if str(code).startswith('154') else 'state'
+        references.setdefault(violation, {})[scope] = str(code)
+    return [(refs.get('local'), refs.get('state')) for refs in references.values()]
+
+
+def fill_summary(wb, data, nopd, counts=None, nopd_counts=None):
+    # Write the four citation counts of every violation to the Summary sheet, as generate_memo did per code
+    summary = wb['Summary']
+    for index, (local_ref, state_ref) in enumerate(violation_references(wb['Violation Types'])):
+        methods.total_citations_local(data, summary, local_ref, index, counts)
+        methods.total_citations_state(data, summary, state_ref, index, counts)
+        methods.nopd_citations_local(nopd, summary, local_ref, index, nopd_counts)
+        methods.nopd_citations_state(nopd, summary, state_ref, index, nopd_counts)
+    return {cell.coordinate: cell.value for row in summary.iter_rows() for cell in row}
+
+
+def nopd_sheet(wb):
+    # The City Police rows of the Data sheet, the way generate_memo used to copy them
+    sheet = wb.create_sheet('NOPD Citations')
+    for row in wb['Data'].iter_rows(values_only=True):
+        if row[1] in (nopd_agency, 'Issuing Agency '):
+            sheet.append(row)
+    return sheet
+
+
+@pytest.mark.skipif(not os.path.exists(sample_path), reason='sample workbook not found')
+def test_count_index_fills_the_same_summary_as_scanning():
+    scanned_wb = load_workbook(sample_path)
+    scanned = fill_summary(scanned_wb, scanned_wb['Data'], nopd_sheet(scanned_wb))
+
+    indexed_wb = load_workbook(sample_path)
+    data = workbooks.stream_data_sheet(indexed_wb['Data'], agency=nopd_agency)
+    total_counts, nopd_counts = methods.split_count_index(data.counts, nopd_agency)
+    indexed = fill_summary(indexed_wb, None, None, total_counts, nopd_counts)
+
+    assert indexed == scanned
+    assert any(isinstance(value, int) and value > 0 for coordinate, value in indexed.items()
+               if coordinate[0] == 'E')
+
+
+def test_nopd_counts_come_from_the_data_sheet_not_an_existing_nopd_sheet():
+    wb = Workbook()
+    data = wb.active
+    data.title = 'Data'
+    data.append(['Case Number', 'Issuing Agency ', 'Violation Date', 'Violation Cited (State/Local Code Reference)'])
+    data.append(['A1', nopd_agency, None, '154:401'])
+    data.append(['A2', nopd_agency, None, '154:401'])
+    data.append(['A3', '02 - STATE POLICE', None, '154:401'])
+    data.append(['A4', nopd_agency, None, '32:58'])
+    # A stale NOPD Citations sheet left in the upload, holding a single citation
+    stale = wb.create_sheet('NOPD Citations')
+    stale.append(['Case Number', 'Issuing Agency ', 'Violation Date', 'Violation Cited (State/Local Code Reference)'])
+    stale.append(['A1', nopd_agency, None, '154:401'])
+
+    total_counts, nopd_counts = methods.split_count_index(workbooks.stream_data_sheet(data).counts, nopd_agency)
+    assert total_counts['154:401'] == 3
+    assert nopd_counts['154:401'] == 2
+    assert nopd_counts['32:58'] == 1
+    assert methods.count_rows_with_text(stale, 'D', '154:401') == 1
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+from docx import Document
+
+import methods
+
+
+def test_write_table_formats_numpy_integers_as_currency():
+    doc = Document()
+    df = pd.DataFrame({'Violation': ['Improper turn'], 'Citations': np.array([1500], dtype=np.int64),
+                       'Revenue': [236250.0]})
+    table = methods.write_table(doc, df, True, 'Revenue by Violation Type')
+    assert [[cell.text for cell in row.cells] for row in table.rows] == [
+        ['Revenue by Violation Type'] * 3,
+        ['Violation', 'Citations', 'Revenue'],
+        ['Improper turn', '$1,500.00', '$236,250.00'],
+    ]
+    # The table goes before the section properties that end the body
+    assert doc.element.body[-1].tag.endswith('sectPr')
+    assert len(doc.tables) == 1
+
+
+def test_add_dataframe_writes_a_plain_grid():
+    math_doc = methods.MathDoc('Math')
+    math_doc.add_dataframe(pd.DataFrame({'a': [1, 2], 'b': ['x & y', '<z>']}))
+    table = math_doc.doc.tables[0]
+    assert [[cell.text for cell in row.cells] for row in table.rows] == [['a', 'b'], ['1', 'x & y'], ['2', '<z>']]
@@ -0,0 +1,391 @@
+import os
+import re
+import json
+import hashlib
+import xml.etree.ElementTree as ET
+import zipfile
+from collections import Counter
+from copy import copy
+from datetime import datetime
+from typing import NamedTuple
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.worksheet.worksheet import Worksheet
+
+from sheet_cache import SheetCache
+
+# Citations of this agency are analyzed, the Data sheet holds every agency
+nopd_agency = '01 - CITY POLICE'
+nopd_sheet = 'NOPD Citations'
+# columns of the Data sheet holding the issuing agency and the violation code
+data_agency_column = 'B'
+data_code_column = 'D'
+# text columns with fewer distinct values than this share of their rows are stored as categoricals
+category_ratio = 0.5
+# kept rows are packed into a compact frame every chunk_rows rows, so at most one chunk is held as Python objects
+chunk_rows = 50000
+# parsed uploads, named by the SHA-256 of the uploaded file and of the settings it was parsed with
+sheet_cache_path = 'downloads/sheets'
+# bump when the tables stored in the sheet cache change, so uploads parsed before are parsed again
+parse_format = 2
+# cell values are stored in the column of their type, anything else is stored as text
+value_columns = {int: 'integer', float: 'number', bool: 'boolean', datetime: 'date', str: 'text'}
+value_dtypes = {'integer': 'Int64', 'number': 'Float64', 'boolean': 'boolean', 'date': 'datetime64[us]',
+                'text': 'string'}
+
+_sheet_cache = None
+
+
+class DataSheet(NamedTuple):
+    """The citations of one agency from the Data sheet, and the code counts of every agency"""
+    citations: pd.DataFrame
+    # (agency, code) -> number of citations, split with methods.split_count_index
+    counts: Counter
+    rows: int
+
+
+class Upload(NamedTuple):
+    """The sheets of an uploaded workbook that the memo is calculated from"""
+    data: DataSheet
+    # writable copies holding the values of the Summary and Violation Types sheets
+    summary: Worksheet
+    violation_types: Worksheet
+
+
+def _categorize(series) -> pd.Series:
+    # Store a text column with repeated values as a categorical
+    if pd.api.types.is_string_dtype(series.dtype) and len(series) and series.nunique() < category_ratio * len(series):
+        return series.astype('category')
+    return series
+
+
+def _compact_chunk(columns) -> pd.DataFrame:
+    # A chunk of kept rows as a typed frame, its columns numbered like the sheet's
+    return pd.DataFrame({i: _categorize(pd.Series(values)) for i, values in enumerate(columns)})
+
+
+def _concat_column(parts) -> pd.Series:
+    # Join one column of every chunk, merging the categories when each chunk stored it as a categorical
+    if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+        try:
+            return pd.Series(union_categoricals(parts, sort_categories=True))
+        except TypeError:
+            # Categories of mixed types can't be sorted, astype('category') keeps them in order of appearance too
+            return pd.Series(union_categoricals(parts))
+    parts = [part.astype(part.cat.categories.dtype) if isinstance(part.dtype, pd.CategoricalDtype) else part
+             for part in parts]
+    return _categorize(pd.concat(parts, ignore_index=True))
+
+
+def compact_frame(headers, chunks) -> pd.DataFrame:
+    """
+    Join the chunks of kept rows into one DataFrame, leaving out unnamed empty columns
+    :param headers: column names, None for columns without a header
+    :param chunks: frames from _compact_chunk
+    :return: DataFrame, repeated strings stored as categoricals
+    """
+    if not chunks:
+        chunks = [_compact_chunk([[] for _ in headers])]
+    columns = {i: _concat_column([chunk[i] for chunk in chunks]) for i in range(len(headers))}
+    kept = [i for i in columns if headers[i] is not None or columns[i].notna().any()]
+    df = pd.DataFrame({i: columns[i] for i in kept})
+    df.columns = [headers[i] for i in kept]
+    return df
+
+
+def stream_data_sheet(worksheet, agency=nopd_agency, agency_column=data_agency_column,
+                      code_column=data_code_column) -> DataSheet:
+    """
+    Read the Data sheet row by row, keeping only the citations of one agency
+    Rows of other agencies are only counted, and the kept rows are packed into typed columns every chunk_rows rows,
+    so memory grows with the compact size of the agency's citations rather than the file. Open the workbook with
+    read_only=True for the rows to be streamed from disk.
+    :param worksheet: Data sheet, headers in the first row
+    :param agency: issuing agency whose citations are kept
+    :param agency_column: column letter of the issuing agency
+    :param code_column: column letter of the violation code
+    :return: DataSheet
+    """
+    agency_index = column_index_from_string(agency_column) - 1
+    code_index = column_index_from_string(code_column) - 1
+    rows = worksheet.iter_rows(values_only=True)
+    headers = list(next(rows, ()))
+    columns = [[] for _ in headers]
+    chunks = []
+    counts = Counter()
+    n_rows = 0
+    for row in rows:
+        n_rows += 1
+        row_agency = row[agency_index] if agency_index < len(row) else None
+        counts[(row_agency, row[code_index] if code_index < len(row) else None)] += 1
+        if row_agency == agency:
+            for i, values in enumerate(columns):
+                values.append(row[i] if i < len(row) else None)
+            if len(columns[0]) >= chunk_rows:
+                chunks.append(_compact_chunk(columns))
+                columns = [[] for _ in headers]
+    if headers and columns[0]:
+        chunks.append(_compact_chunk(columns))
+    citations = compact_frame(headers, chunks)
+    print(f"Streamed {n_rows} rows of {worksheet.title}, kept {len(citations)} citations of {agency}")
+    return DataSheet(citations, counts, n_rows)
+
+
+def _sheet_layout(archive, path):
+    # Column widths, custom row heights and merged cells, which read-only worksheets don't expose
+    widths, heights, merged = {}, {}, []
+    with archive.open(path) as file:
+        for _, element in ET.iterparse(file):
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 'col' and element.get('width') is not None:
+                for column in range(int(element.get('min')), int(element.get('max')) + 1):
+                    widths[get_column_letter(column)] = float(element.get('width'))
+            elif tag == 'row':
+                if element.get('customHeight') in ('1', 'true') and element.get('ht') is not None:
+                    heights[int(element.get('r'))] = float(element.get('ht'))
+                element.clear()
+            elif tag == 'mergeCell':
+                merged.append(element.get('ref'))
+    return widths, heights, merged
+
+
+def _write_sheet(target, source, layout, replacement=None):
+    # Stream the rows of a read-only sheet into a write-only one, with the values of replacement where it has any
+    widths, heights, merged = layout
+    for letter, width in widths.items():
+        target.column_dimensions[letter].width = width
+    for row, height in heights.items():
+        target.row_dimensions[row].height = height
+
+    styles = {}
+    n_rows = 0
+    for n_rows, row in enumerate(source.iter_rows(), start=1):
+        cells = []
+        for column, source_cell in enumerate(row, start=1):
+            value = source_cell.value
+            if replacement is not None:
+                value = replacement.cell(row=n_rows, column=column).value
+            cell = WriteOnlyCell(target, value)
+            # Gaps in a row are EmptyCells, which have no style
+            if getattr(source_cell, 'has_style', False):
+                # Styles are registered with the new workbook once, then shared by every cell using them
+                style_id = source_cell._style_id
+                if style_id not in styles:
+                    cell.font = copy(source_cell.font)
+                    cell.fill = copy(source_cell.fill)
+                    cell.border = copy(source_cell.border)
+                    cell.alignment = copy(source_cell.alignment)
+                    cell.protection = copy(source_cell.protection)
+                    cell.number_format = source_cell.number_format
+                    styles[style_id] = copy(cell._style)
+                else:
+                    cell._style = copy(styles[style_id])
+            cells.append(cell)
+        if replacement is not None:
+            cells.extend(replacement.cell(row=n_rows, column=column).value
+                         for column in range(len(cells) + 1, replacement.max_column + 1))
+        target.append(cells)
+    # Rows written to the replacement below the end of the source sheet
+    if replacement is not None:
+        for row in replacement.iter_rows(min_row=n_rows + 1, values_only=True):
+            target.append(row)
+
+    for cell_range in merged:
+        target.merged_cells.add(cell_range)
+
+
+def _write_frame(target, df):
+    target.append(list(df.columns))
+    for row in df.astype(object).itertuples(index=False, name=None):
+        target.append([None if pd.isna(value) else value for value in row])
+
+
+def save_workbook(source_path, target_path, replacements=None, citations=None):
+    """
+    Save a copy of an uploaded workbook without loading it into memory, streaming every sheet into a write-only workbook
+    :param source_path: the uploaded workbook
+    :param target_path: where the copy is saved
+    :param replacements: sheet title -> worksheet whose values replace the sheet's, e.g. the filled in Summary
+    :param citations: DataFrame written to the NOPD Citations sheet, replacing it if the upload has one
+    :return:
+    """
+    replacements = replacements or {}
+    source = load_workbook(source_path, read_only=True)
+    target = Workbook(write_only=True)
+    try:
+        with zipfile.ZipFile(source_path) as archive:
+            for worksheet in source.worksheets:
+                sheet = target.create_sheet(worksheet.title)
+                if worksheet.title == nopd_sheet and citations is not None:
+                    _write_frame(sheet, citations)
+                    continue
+                layout = _sheet_layout(archive, worksheet._worksheet_path)
+                _write_sheet(sheet, worksheet, layout, replacements.get(worksheet.title))
+        if citations is not None and nopd_sheet not in source.sheetnames:
+            _write_frame(target.create_sheet(nopd_sheet), citations)
+        # Write next to the target first, the source may be the file being replaced
+        target.save(f'{target_path}.tmp')
+        os.replace(f'{target_path}.tmp', target_path)
+    finally:
+        source.close()
+
+
+def sheet_values(worksheet) -> pd.DataFrame:
+    """Return the cells of a worksheet that hold a value, one row per cell with the value in the column of its type."""
+    cells = {'row': [], 'column': [], **{name: [] for name in value_dtypes}}
+    for row, values in enumerate(worksheet.iter_rows(values_only=True), start=1):
+        for column, value in enumerate(values, start=1):
+            if value is None:
+                continue
+            kind = value_columns.get(type(value), 'text')
+            cells['row'].append(row)
+            cells['column'].append(column)
+            for name in value_dtypes:
+                cells[name].append((value if kind != 'text' else str(value)) if name == kind else None)
+    df = pd.DataFrame({'row': pd.array(cells['row'], dtype='int32'), 'column': pd.array(cells['column'], dtype='int32')})
+    for name, dtype in value_dtypes.items():
+        df[name] = pd.Series(cells[name], dtype=dtype)
+    return df
+
+
+def values_sheet(values, workbook, title) -> Worksheet:
+    """Write the cells from sheet_values into a new worksheet."""
+    worksheet = workbook.create_sheet(title)
+    kinds = list(value_dtypes)
+    for cell in values[['row', 'column'] + kinds].itertuples(index=False, name=None):
+        value = next(value for value in cell[2:] if not pd.isna(value))
+        if isinstance(value, pd.Timestamp):
+            value = value.to_pydatetime()
+        elif hasattr(value, 'item'):
+            value = value.item()  # numpy scalar
+        worksheet.cell(row=int(cell[0]), column=int(cell[1]), value=value)
+    return worksheet
+
+
+def _value_types(series):
+    # The value_columns kind of every value of a column holding more than one type of value, else None
+    values = series.cat.categories if isinstance(series.dtype, pd.CategoricalDtype) else series
+    if values.dtype != object:
+        return None
+    if len({type(value) for value in values if not pd.isna(value)}) < 2:
+        return None
+    return pd.Series([None if pd.isna(value) else value_columns.get(type(value), 'text') for value in series],
+                     dtype='category')
+
+
+def _typed_frame(df) -> pd.DataFrame:
+    """
+    Store columns mixing types of values (e.g. numeric and text case numbers) as text, for Arrow to store them
+    The kind of each value is kept in a column named __type_<position>, for _untyped_frame to convert the text back.
+    """
+    df = df.copy()
+    for position in range(df.shape[1]):
+        series = df.iloc[:, position]
+        kinds = _value_types(series)
+        if kinds is None:
+            continue
+        text = pd.Series([None if pd.isna(value) else str(value) for value in series], dtype='string')
+        df.isetitem(position, text.astype('category') if isinstance(series.dtype, pd.CategoricalDtype) else text)
+        df[f'__type_{position}'] = kinds.values
+    return df
+
+
+def _untyped_frame(df) -> pd.DataFrame:
+    # Undo _typed_frame, converting the text of every mixed column back to values of their kinds
+    converters = {'integer': int, 'number': float, 'boolean': lambda value: value == 'True',
+                  'date': datetime.fromisoformat, 'text': str}
+    type_columns = [name for name in df.columns if isinstance(name, str) and name.startswith('__type_')]
+    for name in type_columns:
+        position = int(name[len('__type_'):])
+        series = df.iloc[:, position]
+        values = pd.Series([None if pd.isna(kind) else converters[kind](value) for value, kind in zip(series, df[name])],
+                           dtype=object)
+        df.isetitem(position, values.astype('category') if isinstance(series.dtype, pd.CategoricalDtype) else values)
+    return df.drop(columns=type_columns)
+
+
+def _upload_tables(upload, agency):
+    # name -> DataFrame of everything Upload holds, for the sheet cache
+    counts = pd.DataFrame([(agency_name, code, count) for (agency_name, code), count in upload.data.counts.items()],
+                          columns=['agency', 'code', 'count'])
+    rows = pd.DataFrame({'rows': [upload.data.rows]})
+    return {_citations_table(agency): _typed_frame(upload.data.citations), 'counts': _typed_frame(counts),
+            'rows': rows, 'summary': sheet_values(upload.summary),
+            'violation_types': sheet_values(upload.violation_types)}
+
+
+def _citations_table(agency):
+    return 'citations-' + re.sub(r'\W+', '_', agency).strip('_')
+
+
+def _upload_from_tables(tables, agency) -> Upload:
+    counts = Counter()
+    for agency_name, code, count in _untyped_frame(tables['counts']).itertuples(index=False, name=None):
+        counts[(None if pd.isna(agency_name) else agency_name, None if pd.isna(code) else code)] = int(count)
+    data = DataSheet(_untyped_frame(tables[_citations_table(agency)]), counts, int(tables['rows']['rows'].iloc[0]))
+    workbook = Workbook()
+    return Upload(data, values_sheet(tables['summary'], workbook, 'Summary'),
+                  values_sheet(tables['violation_types'], workbook, 'Violation Types'))
+
+
+def upload_key(filepath, cache) -> str:
+    """Return the SHA-256 of an uploaded file's contents and of the settings it is parsed with."""
+    settings = {'file': cache.file_key(filepath), 'format': parse_format, 'category_ratio': category_ratio,
+                'agency_column': data_agency_column, 'code_column': data_code_column}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def read_upload(filepath, agency=nopd_agency) -> Upload:
+    """
+    Parse an uploaded workbook, streaming the Data sheet with stream_data_sheet
+    :param filepath: the uploaded workbook
+    :param agency: issuing agency whose citations are kept
+    :return: Upload
+    """
+    wb = load_workbook(filepath, read_only=True)
+    try:
+        data = stream_data_sheet(wb['Data'], agency=agency)
+        # Only cells with values are copied, the Violation Types sheet claims thousands of empty rows
+        workbook = Workbook()
+        summary = values_sheet(sheet_values(wb['Summary']), workbook, 'Summary')
+        violation_types = values_sheet(sheet_values(wb['Violation Types']), workbook, 'Violation Types')
+    finally:
+        wb.close()
+    return Upload(data, summary, violation_types)
+
+
+def get_sheet_cache() -> SheetCache:
+    """Return the cache of parsed uploads, opened on first use."""
+    global _sheet_cache
+    if _sheet_cache is None:
+        _sheet_cache = SheetCache(sheet_cache_path)
+    return _sheet_cache
+
+
+def load_upload(filepath, agency=nopd_agency) -> Upload:
+    """
+    Return the parsed sheets of an uploaded workbook, from the sheet cache when the same file was parsed before
+    :param filepath: the uploaded workbook
+    :param agency: issuing agency whose citations are kept
+    :return: Upload
+    """
+    cache = get_sheet_cache()
+    key = upload_key(filepath, cache)
+    names = [_citations_table(agency), 'counts', 'rows', 'summary', 'violation_types']
+    tables = cache.get(key, names)
+    if tables is not None:
+        print(f"Loaded the parsed sheets of {filepath} from the cache")
+        return _upload_from_tables(tables, agency)
+
+    upload = read_upload(filepath, agency)
+    try:
+        cache.put(key, _upload_tables(upload, agency))
+    except (pa.ArrowException, OSError) as e:
+        # The upload is just parsed again next time
+        print(f"Error: the parsed sheets of {filepath} could not be cached... {e}")
+    return upload